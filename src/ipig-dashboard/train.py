@@ -1,4 +1,4 @@
-import h5py, logging, argparse, getpass, pandas as pd, numpy as np
+import h5py, logging, argparse, getpass, os, sys, pandas as pd, numpy as np
 import matplotlib.pyplot as plt
 import torch, torchmetrics
 import torch.nn as nn
@@ -15,6 +15,10 @@ from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping, Learning
 from datetime import datetime
 from weakref import ReferenceType
 
+# Preprocessing is shared with the model service
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ipig-model'))
+from utils.preprocessing import get_pipeline
+
 
 INIT_LR = 1e-3
 EPOCH = 100
@@ -67,11 +71,8 @@ def preprocessing_data(arr, MEAN, STD, normalize=True):
     #     return (arr - arr.min()) / (arr.max() - arr.min())
     # else:
 
-    # Data standardization
-    if MEAN is None:
-        MEAN = arr.mean()
-        STD = arr.std()
-    return (arr - MEAN) / STD, MEAN, STD
+    # Data standardization, in place and chunk-wise in float32
+    return get_pipeline('ipig-h5-dense').fit_transform(arr, MEAN, STD)
 
 
 def get_data(path, no_sample, normalize=True, MEAN=None, STD=None):
@@ -8,12 +8,13 @@ from dash.dependencies import Input, Output
 from dash_bootstrap_templates import load_figure_template
 from dash.exceptions import PreventUpdate
 from train import get_data
+from utils.stats import load_stats
 
 AGG_DATA_POINTS = 100
 
 
 
-def generate_dump_data(length=100000):
+def generate_dump_data(length=100000, cache_dir=None, checkpoint_path='./model_checkpoint/LSTM.ckpt'):
     arr = np.array([0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35] * (length // 800))
     np.random.shuffle(arr)
     arr = np.repeat(arr.reshape(-1, 1), 100, axis=-1)
@@ -26,14 +27,21 @@ def generate_dump_data(length=100000):
     #     'pressure': np.sin(np.arange(0, arr.shape[0] / 5, 0.2)),
     #     'idx': np.arange(arr.shape[0]),
     # })
-    _, _, _, _, MEAN, STD = get_data('train_new.h5',
-                                     True,
-                                     True)
+    # Training stats come from the model sidecar, only scan the training set when the model has none
+    norm_stats = load_stats(checkpoint_path)
+    if norm_stats is not None:
+        MEAN, STD = norm_stats.mean, norm_stats.std
+    else:
+        _, _, _, _, MEAN, STD = get_data('train_new.h5',
+                                         True,
+                                         True,
+                                         cache_dir=cache_dir)
     train_inputs, train_cls_label, train_deposit_thickness, train_inner_diameter, _, _ = get_data('val_new.h5',
                                                                                                   True,
                                                                                                   True,
                                                                                                   MEAN,
-                                                                                                  STD)
+                                                                                                  STD,
+                                                                                                  cache_dir=cache_dir)
     print(f'MEAN = {MEAN}\nSTD = {STD}')
     train_deposit_thickness = np.sort(train_deposit_thickness.flatten())  # Sort deposit A-Z
     return pd.DataFrame({
@@ -0,0 +1,117 @@
+import os, sys, json, time, platform, argparse, multiprocessing as mp
+import torch
+
+from concurrent.futures import ProcessPoolExecutor
+from common import BACKBONES, build_model, num_feature
+from utils.profiling import max_rss_mb, measure_latency
+
+
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# Representative configurations, close to what we train
+REPRESENTATIVE_ARGS = {
+    'cnn': ['-nc', '2', '-ks', '3 3', '-oc', '8 16', '-co', '256'],
+    'lstm': ['--hidden_size', '256', '--bi_di'],
+    'unet': ['-ks', '3 3', '-oc', '64 128', '-co', '256'],
+    'mlp': ['-co', '256'],
+}
+
+
+def bench_backbone(backbone, batch_sizes, repeat, warmup, num_threads):
+    # Runs in its own process so the peak RSS is the one of this backbone only
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(42)
+    model = build_model(backbone, REPRESENTATIVE_ARGS[backbone]).eval()
+    result = {'num_params': sum(p.numel() for p in model.parameters()), 'batches': {}}
+
+    latencies = measure_latency(model, num_feature(backbone), batch_sizes, repeat, warmup, percentiles=(50, 99))
+    for b in batch_sizes:
+        p50 = latencies[f'latency_ms_b{b}']
+        result['batches'][str(b)] = {'p50_ms': p50, 'p99_ms': latencies[f'latency_ms_b{b}_p99'],
+                                     'throughput': b / p50 * 1e3}
+
+    result['peak_rss_mb'] = max_rss_mb()
+    return result
+
+
+def run(args):
+    ctx = mp.get_context('spawn')
+    results = {}
+    for backbone in args.backbones.split(','):
+        with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+            results[backbone] = pool.submit(bench_backbone, backbone, args.batch_sizes, args.repeat, args.warmup,
+                                            args.num_threads).result()
+    return {'meta': {'torch': torch.__version__, 'num_threads': args.num_threads, 'machine': platform.machine(),
+                     'processor': platform.processor(), 'python': platform.python_version(),
+                     'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'results': results}
+
+
+def compare(current, baseline, tolerance, metrics):
+    # Returns the list of regressions (backbone, batch, metric, baseline, current)
+    regressions = []
+    print(f'{"backbone":<8}{"batch":>7}' + ''.join(f'{m:>22}' for m in metrics))
+    for backbone, res in current['results'].items():
+        base = baseline['results'].get(backbone)
+        if base is None:
+            continue
+        for b, stats in res['batches'].items():
+            if b not in base['batches']:
+                continue
+            cells = []
+            for m in metrics:
+                old, new = base['batches'][b][m], stats[m]
+                ratio = new / old if old else float('inf')
+                cells.append(f'{old:8.3f} -> {new:8.3f}{"!" if ratio > 1 + tolerance else " "}')
+                if ratio > 1 + tolerance:
+                    regressions.append((backbone, b, m, old, new))
+            print(f'{backbone:<8}{b:>7}' + ''.join(f'{c:>22}' for c in cells))
+    return regressions
+
+
+def print_results(report):
+    print(f'{"backbone":<8}{"params":>10}{"RSS MB":>8}{"batch":>7}{"p50 ms":>10}{"p99 ms":>10}{"samples/s":>12}')
+    for backbone, res in report['results'].items():
+        for b, stats in res['batches'].items():
+            print(f'{backbone:<8}{res["num_params"]:>10}{res["peak_rss_mb"]:>8.0f}{b:>7}'
+                  f'{stats["p50_ms"]:>10.3f}{stats["p99_ms"]:>10.3f}{stats["throughput"]:>12.0f}')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backbones', default=','.join(BACKBONES), type=str, help='Comma separated backbones')
+    parser.add_argument('--batch_sizes', default=','.join(map(str, BATCH_SIZES)), type=str, help='Batch sizes')
+    parser.add_argument('--repeat', default=100, type=int, help='Timed runs per batch size')
+    parser.add_argument('--warmup', default=10, type=int, help='Untimed runs per batch size')
+    parser.add_argument('--num_threads', default=torch.get_num_threads(), type=int, help='Intra-op threads')
+    parser.add_argument('--output', default='bench_backbones.json', type=str, help='Result file')
+    parser.add_argument('--current', default=None, type=str, help='Compare this result file instead of running')
+    parser.add_argument('--compare', default=None, type=str, help='Baseline result file, fail on regression')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='Accepted latency increase (0.1 = 10%%)')
+    parser.add_argument('--gate_metrics', default='p50_ms,p99_ms', type=str, help='Metrics checked by the gate')
+    args = parser.parse_args()
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    if args.current is not None:
+        with open(args.current) as f:
+            report = json.load(f)
+    else:
+        report = run(args)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print_results(report)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.gate_metrics.split(','))
+        if regressions:
+            for backbone, b, m, old, new in regressions:
+                print(f'REGRESSION {backbone} batch={b} {m}: {old:.3f} -> {new:.3f} ({new / old - 1:+.1%})')
+            sys.exit(1)
+        print(f'No latency regression beyond {args.tolerance:.0%}')
@@ -0,0 +1,60 @@
+import json, argparse, torch
+import torch.nn as nn
+
+from common import BACKBONES, build_model, num_feature
+from bench_backbones import REPRESENTATIVE_ARGS
+from model import BruceModel
+from model.inference import optimize_for_inference
+from utils.profiling import measure_latency
+
+
+def randomize_batchnorm(model):
+    # Freshly built models have mean 0 / var 1 running stats, folding them would be trivially exact
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm1d):
+            m.running_mean.normal_(0, 0.5)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.normal_(1, 0.1)
+            m.bias.data.normal_(0, 0.1)
+    return model
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, type=str, help='Trained model, random weights otherwise')
+    parser.add_argument('--backbones', default=','.join(BACKBONES), type=str, help='Backbones without a checkpoint')
+    parser.add_argument('--batch_sizes', default='1,64,1024', type=str, help='Batch sizes')
+    parser.add_argument('--repeat', default=100, type=int, help='Timed runs per batch size')
+    parser.add_argument('--warmup', default=10, type=int, help='Untimed runs per batch size')
+    parser.add_argument('--output', default=None, type=str, help='Result file (JSON)')
+    args = parser.parse_args()
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(42)
+
+    if args.checkpoint is not None:
+        model = BruceModel.load_from_checkpoint(args.checkpoint)
+        models = {model.hparams.backbone: model}
+    else:
+        models = {b: randomize_batchnorm(build_model(b, REPRESENTATIVE_ARGS[b])) for b in args.backbones.split(',')}
+
+    results = {}
+    print(f'{"backbone":<10}{"batch":>7}{"original ms":>13}{"optimized ms":>14}{"speedup":>9}')
+    for backbone, model in models.items():
+        # Raises OptimizationMismatchError if the outputs differ
+        optimized = optimize_for_inference(model.eval())
+        results[backbone] = {}
+        before_ms = measure_latency(model, num_feature(backbone), args.batch_sizes, args.repeat, args.warmup)
+        after_ms = measure_latency(optimized, num_feature(backbone), args.batch_sizes, args.repeat, args.warmup)
+        for b in args.batch_sizes:
+            before, after = before_ms[f'latency_ms_b{b}'], after_ms[f'latency_ms_b{b}']
+            results[backbone][str(b)] = {'original_ms': before, 'optimized_ms': after, 'speedup': before / after}
+            print(f'{backbone:<10}{b:>7}{before:>13.3f}{after:>14.3f}{before / after:>9.2f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
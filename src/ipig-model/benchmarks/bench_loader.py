@@ -0,0 +1,66 @@
+import time, argparse, torch
+
+from common import BACKBONES, build_model, num_feature
+from torch.utils.data import DataLoader, TensorDataset
+from utils.loader import get_batch_loader
+
+
+def make_tensors(num_samples, backbone):
+    return [torch.randn(num_samples, num_feature(backbone)),
+            torch.randint(0, 2, (num_samples, 1)).float(),
+            torch.rand(num_samples),
+            torch.rand(num_samples, 1)]
+
+
+def get_loaders(tensors, batch_size):
+    return {
+        'tensor_dataset': DataLoader(TensorDataset(*tensors), batch_size=batch_size, shuffle=True),
+        'batch_loader': get_batch_loader(tensors, batch_size=batch_size, shuffle=True),
+    }
+
+
+def loader_throughput(loader, num_samples):
+    t0 = time.perf_counter()
+    for _ in loader:
+        pass
+    return num_samples / (time.perf_counter() - t0)
+
+
+def train_throughput(model, loader, num_steps):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    model.train()
+    seen, t0 = 0, time.perf_counter()
+    for step, (inputs, cls_labels, dt_labels, id_labels) in enumerate(loader):
+        if step == num_steps:
+            break
+        cls_out, dt_out, id_out = model(inputs)
+        cls_loss, rgs_loss, id_loss = model.loss(torch.sigmoid(cls_out), dt_out, id_out,
+                                                 cls_labels, dt_labels, id_labels)
+        optimizer.zero_grad()
+        (cls_loss + rgs_loss + id_loss).backward()
+        optimizer.step()
+        seen += inputs.shape[0]
+    return seen / (time.perf_counter() - t0)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', default=200000, type=int, help='Samples in the synthetic dataset')
+    parser.add_argument('--batch_size', default=128, type=int, help='Batch size')
+    parser.add_argument('--num_steps', default=200, type=int, help='Training steps per backbone')
+    parser.add_argument('--backbones', default=','.join(BACKBONES), type=str, help='Comma separated backbones')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(42)
+    print(f'{"backbone":<10}{"loader":<16}{"load samples/s":>16}{"train samples/s":>17}')
+
+    for backbone in args.backbones.split(','):
+        tensors = make_tensors(args.num_samples, backbone)
+        model = build_model(backbone, rgs_loss='mae')
+        for name, loader in get_loaders(tensors, args.batch_size).items():
+            load_sps = loader_throughput(loader, args.num_samples)
+            train_sps = train_throughput(model, loader, args.num_steps)
+            print(f'{backbone:<10}{name:<16}{load_sps:>16.0f}{train_sps:>17.0f}')
@@ -0,0 +1,74 @@
+import time, argparse, numpy as np, torch
+
+from common import build_model, num_feature
+from model import BruceModel
+from train import get_data
+from utils.precision import autocast, cpu_supports_bf16
+
+
+def get_inputs(args, backbone):
+    if args.val_path is None:
+        inputs = torch.randn(args.num_samples, num_feature(backbone))
+        return inputs, None
+    # Stats from the training set, as the model saw them
+    _, _, _, _, MEAN, STD = get_data(args.train_path, True, cache_dir=args.cache_dir)
+    inputs, _, dt_labels, _, _, _ = get_data(args.val_path, True, MEAN=MEAN, STD=STD, cache_dir=args.cache_dir)
+    return torch.as_tensor(inputs[:args.num_samples], dtype=torch.float32), \
+           torch.as_tensor(dt_labels[:args.num_samples], dtype=torch.float32)
+
+
+def run(model, inputs, precision, batch_size):
+    outputs = []
+    with torch.inference_mode(), autocast(precision):
+        model(inputs[:batch_size])  # warm up
+        t0 = time.perf_counter()
+        for batch in inputs.split(batch_size):
+            cls_out, dt_out, _ = model(batch)
+            outputs.append((torch.sigmoid(cls_out) >= 0.5).reshape(-1) * dt_out.reshape(-1))
+        elapsed = time.perf_counter() - t0
+    return torch.cat(outputs), inputs.shape[0] / elapsed
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, type=str, help='Trained model, random weights otherwise')
+    parser.add_argument('--backbones', default='cnn,unet,mlp', type=str, help='Backbones without a checkpoint')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data (stats)')
+    parser.add_argument('--val_path', default=None, type=str, help='Labelled data, synthetic inputs otherwise')
+    parser.add_argument('--cache_dir', default='./data_cache', type=str, help='Preprocessed data cache')
+    parser.add_argument('--num_samples', default=50000, type=int, help='Frames to score')
+    parser.add_argument('--batch_size', default=256, type=int, help='Inference batch size')
+    parser.add_argument('--max_mae_increase', default=0.005, type=float, help='Accepted MAE increase with bf16')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(42)
+    print(f'Native CPU bf16: {cpu_supports_bf16()}')
+
+    if args.checkpoint is not None:
+        model = BruceModel.load_from_checkpoint(args.checkpoint)
+        models = {model.hparams.backbone: model}
+    else:
+        models = {b: build_model(b) for b in args.backbones.split(',')}
+
+    print(f'{"backbone":<10}{"fp32 samples/s":>16}{"bf16 samples/s":>16}{"speedup":>9}'
+          f'{"fp32 MAE":>10}{"bf16 MAE":>10}{"max |diff|":>12}  adopt')
+    for backbone, model in models.items():
+        model.eval()
+        inputs, dt_labels = get_inputs(args, backbone)
+        out_fp32, sps_fp32 = run(model, inputs, 'fp32', args.batch_size)
+        out_bf16, sps_bf16 = run(model, inputs, 'bf16', args.batch_size)
+
+        diff = float((out_bf16 - out_fp32).abs().max())
+        if dt_labels is not None:
+            mae_fp32 = float((out_fp32 - dt_labels).abs().mean())
+            mae_bf16 = float((out_bf16 - dt_labels).abs().mean())
+        else:
+            # No labels: the fp32 outputs are the reference
+            mae_fp32, mae_bf16 = 0., float((out_bf16 - out_fp32).abs().mean())
+
+        adopt = sps_bf16 > sps_fp32 and mae_bf16 - mae_fp32 <= args.max_mae_increase
+        print(f'{backbone:<10}{sps_fp32:>16.0f}{sps_bf16:>16.0f}{sps_bf16 / sps_fp32:>9.2f}'
+              f'{mae_fp32:>10.4f}{mae_bf16:>10.4f}{diff:>12.2e}  {"yes" if adopt else "no"}')
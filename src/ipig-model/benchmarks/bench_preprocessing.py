@@ -0,0 +1,73 @@
+import os, sys, time, argparse, tracemalloc, numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.preprocessing import get_pipeline
+
+
+# Implementations before the shared engine, kept here as the reference
+def legacy_ipig_h5(arr):
+    MEAN = arr[arr != 0].mean()
+    STD = arr[arr != 0].std()
+    arr[arr != 0] = (arr[arr != 0] - MEAN) / STD
+    return arr
+
+
+def legacy_ipig_h5_dense(arr):
+    return (arr - arr.mean()) / arr.std()
+
+
+def legacy_ect_raw_csv(arr):
+    arr[arr > 1] = 0
+    return -(arr - arr.mean()) / arr.std()
+
+
+LEGACY = {
+    'ipig-h5': legacy_ipig_h5,
+    'ipig-h5-dense': legacy_ipig_h5_dense,
+    'ect-raw-csv': legacy_ect_raw_csv,
+}
+
+
+def make_frames(num_frames, num_feature, zero_rate, seed=42):
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(-0.5, 0.9, size=(num_frames, num_feature))
+    arr[rng.random(arr.shape) < zero_rate] = 0
+    return arr
+
+
+def measure(fn, arr):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn(arr)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', default=200000, type=int, help='Frames per run')
+    parser.add_argument('--num_feature', default=600, type=int, help='Values per frame')
+    parser.add_argument('--zero_rate', default=0.1, type=float, help='Fraction of zero readings')
+    parser.add_argument('--num_threads', default=None, type=int, help='Threads of the shared engine')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    scale = 1e6 / args.num_frames
+    print(f'{"pipeline":<16}{"impl":<10}{"s / 1M frames":>16}{"peak MB / 1M frames":>22}{"max abs diff":>16}')
+
+    for name, legacy_fn in LEGACY.items():
+        pipeline = get_pipeline(name)
+        # The float64 source is what h5py / pandas hand over
+        ref, t_legacy, m_legacy = measure(legacy_fn, make_frames(args.num_frames, args.num_feature, args.zero_rate))
+
+        src = make_frames(args.num_frames, args.num_feature, args.zero_rate).astype(np.float32)
+        (out, _, _), t_engine, m_engine = measure(lambda a: pipeline.fit_transform(a, num_threads=args.num_threads),
+                                                  src)
+
+        diff = float(np.abs(out - ref).max())
+        print(f'{name:<16}{"legacy":<10}{t_legacy * scale:>16.3f}{m_legacy * scale / 2 ** 20:>22.1f}{"":>16}')
+        print(f'{name:<16}{"engine":<10}{t_engine * scale:>16.3f}{m_engine * scale / 2 ** 20:>22.1f}{diff:>16.2e}')
@@ -0,0 +1,23 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from train import get_args
+from model import BruceModel
+
+
+BACKBONES = ('cnn', 'lstm', 'unet', 'mlp')
+
+
+def num_feature(backbone):
+    # The LSTM block reshapes frames to (10, 60), the other backbones take the 524 first readings
+    return 600 if backbone == 'lstm' else 524
+
+
+def get_hparams(backbone, argv=(), **overrides):
+    hparams = get_args(['--backbone', backbone, *argv]).__dict__
+    hparams.update(overrides)
+    return hparams
+
+
+def build_model(backbone, argv=(), **overrides):
+    return BruceModel(**get_hparams(backbone, argv, **overrides))
@@ -0,0 +1,74 @@
+import os, json, logging, argparse, numpy as np
+import torch
+import pytorch_lightning as pl
+
+from model import BruceModel
+from model.cascade import BruceGateModel, calibrate_threshold, cascade_report, gate_scores
+from train import get_data
+from utils.loader import get_batch_loader
+from utils.scoring import BruceScorer
+
+
+logger = logging.getLogger('model')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--checkpoint', required=True, type=str, help='Full model checkpoint (second stage)')
+    parser.add_argument('--output', default=None, type=str, help='Gate checkpoint, <checkpoint>.gate.ckpt by default')
+    parser.add_argument('--pool', default=4, type=int, help='Average pooling of the readings seen by the gate')
+    parser.add_argument('--hidden_size', default=16, type=int, help='Hidden size of the gate')
+    parser.add_argument('--pos_weight', default=4.0, type=float, help='Weight of deposit frames, favours recall')
+    parser.add_argument('--lr', default=1e-3, type=float, help='Learning rate')
+    parser.add_argument('--batch_size', default=1024, type=int, help='Batch size')
+    parser.add_argument('--num_epoch', default=3, type=int, help='Number of epoch')
+    parser.add_argument('--target_recall', default=0.995, type=float,
+                        help='Fraction of the frames flagged by the full model the gate must let through')
+    parser.add_argument('--calibration_fraction', default=0.5, type=float,
+                        help='Leading part of the validation set used to calibrate, the report uses the rest')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
+    parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path')
+    parser.add_argument('--no_sample', action='store_true', help='Use the full data')
+    parser.add_argument('--cache_dir', default=None, type=str, help='Memory-mapped cache of the preprocessed data')
+    parser.add_argument('--logging_level', default='INFO', type=str, help='Set logging level')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.logging_level)
+    torch.manual_seed(42)
+    output = args.output or os.path.splitext(args.checkpoint)[0] + '.gate.ckpt'
+
+    model = BruceModel.load_from_checkpoint(args.checkpoint).eval()
+    stats = getattr(model, 'norm_stats', None)
+    MEAN, STD = (stats.mean, stats.std) if stats is not None else (None, None)
+    train_inputs, train_cls, train_dt, train_id, MEAN, STD = get_data(args.train_path, args.no_sample, MEAN=MEAN,
+                                                                      STD=STD, cache_dir=args.cache_dir)
+    val_inputs, _, val_dt, _, _, _ = get_data(args.val_path, args.no_sample, MEAN=MEAN, STD=STD,
+                                              cache_dir=args.cache_dir)
+
+    # Train the gate on the deposit labels
+    gate = BruceGateModel(pool=args.pool, hidden_size=args.hidden_size, lr=args.lr, pos_weight=args.pos_weight)
+    train_loader = get_batch_loader([torch.as_tensor(x, dtype=torch.float32) for x in (train_inputs, train_cls)],
+                                    batch_size=args.batch_size, shuffle=True)
+    trainer = pl.Trainer(logger=False, enable_checkpointing=False, max_epochs=args.num_epoch,
+                         enable_model_summary=False)
+    trainer.fit(gate, train_loader)
+
+    # Calibrate on the frames the full model flags in a contiguous head of the validation set, the cascade must keep
+    # its positive predictions. The report runs on the tail, so its recall is out of sample
+    split = int(len(val_inputs) * args.calibration_fraction)
+    calib_inputs, test_inputs, test_dt = val_inputs[:split], val_inputs[split:], val_dt[split:]
+    flagged = BruceScorer(model).score(calib_inputs)['final_predicts'] > 0
+    gate.hparams.gate_threshold = calibrate_threshold(gate_scores(gate, calib_inputs), flagged, args.target_recall)
+    trainer.save_checkpoint(output, weights_only=True)
+
+    report = cascade_report(model, gate, test_inputs, test_dt)
+    report.update(calibration_frames=split, report_frames=len(test_inputs))
+    logger.info(report)
+    with open(os.path.splitext(output)[0] + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Gate {output}: threshold {report["gate_threshold"]:.4f}, {report["pass_rate"]:.1%} of the frames reach '
+          f'the backbone, {report["compute_saved"]:.1%} compute saved, MAE {report["full_mae"]:.4f} -> '
+          f'{report["cascade_mae"]:.4f}, recall of flagged frames {report["flagged_recall"]:.2%}')
@@ -0,0 +1,157 @@
+import os, json, time, logging, argparse, multiprocessing as mp, numpy as np, pandas as pd
+import torch
+import pytorch_lightning as pl
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from sklearn.model_selection import StratifiedGroupKFold
+from model import BruceModel
+from sweep import get_hparams, sample_space
+from train import get_data
+from utils.loader import get_batch_loader
+
+
+logger = logging.getLogger('model')
+
+ARRAYS = ('inputs', 'cls_label', 'deposit_thickness', 'inner_diameter')
+
+# Shared blocks attached by this worker process, kept open for the following folds
+_ATTACHED = {}
+
+
+def to_shared(arrays):
+    # Copy each array once into a named shared memory block, workers map the blocks instead of loading the data
+    blocks, specs = [], {}
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr, dtype=np.float32)
+        shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        specs[name] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def attach(specs):
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        if shm_name not in _ATTACHED:
+            _ATTACHED[shm_name] = SharedMemory(name=shm_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=_ATTACHED[shm_name].buf)
+    return arrays
+
+
+def run_fold(config_id, overrides, fold, train_idx, val_idx, specs, args, num_threads):
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(args.seed)
+    hparams = get_hparams(overrides, args.base_args)
+
+    arrays = attach(specs)
+    tensors = [torch.from_numpy(arrays[name]) for name in ARRAYS]
+    train_loader = get_batch_loader(tensors, batch_size=hparams['batch_size'], shuffle=True, indices=train_idx)
+    val_loader = get_batch_loader(tensors, batch_size=hparams['batch_size'], shuffle=False, indices=val_idx)
+    hparams['total_training_step'] = len(train_loader) * args.num_epoch
+
+    model = BruceModel(**hparams)
+    trainer = pl.Trainer(logger=False, enable_checkpointing=False, max_epochs=args.num_epoch,
+                         limit_train_batches=args.limit_train_batches, enable_progress_bar=False,
+                         enable_model_summary=False)
+    t0 = time.perf_counter()
+    trainer.fit(model, train_loader, val_loader)
+
+    # Metrics of the last validation epoch
+    return {'config': config_id, 'fold': fold,
+            **{k: json.dumps(v) if isinstance(v, list) else v for k, v in overrides.items()},
+            **{k: float(v) for k, v in trainer.callback_metrics.items() if k.startswith('val/')},
+            'train_time_s': time.perf_counter() - t0}
+
+
+def summarize(folds):
+    # Mean and standard deviation over the folds of every validation metric, per configuration
+    metrics = [c for c in folds.columns if c.startswith('val/') or c == 'train_time_s']
+    params = [c for c in folds.columns if c not in metrics and c != 'fold']
+    summary = folds.groupby(params, dropna=False)[metrics].agg(['mean', 'std'])
+    summary.columns = [f'{m}_{stat}' for m, stat in summary.columns]
+    summary['num_folds'] = folds.groupby(params, dropna=False).size()
+    return summary.reset_index()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--space', default='{}', type=str,
+                        help='Configurations, JSON file or inline JSON (same format as sweep.py), base args only by default')
+    parser.add_argument('--num_trials', default=None, type=int, help='Random configurations, full grid if not given')
+    parser.add_argument('--num_folds', default=5, type=int, help='Number of folds')
+    parser.add_argument('--num_workers', default=max(1, (os.cpu_count() or 1) // 4), type=int,
+                        help='Concurrent folds')
+    parser.add_argument('--block_rows', default=2000, type=int,
+                        help='Consecutive frames kept in the same fold, deposits are constant over hundreds of frames')
+    parser.add_argument('--num_epoch', default=5, type=int, help='Epochs per fold')
+    parser.add_argument('--limit_train_batches', default=1.0, type=float, help='Fraction of train batches per epoch')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
+    parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path, pooled with train')
+    parser.add_argument('--no_sample', action='store_true', help='Use the full data')
+    parser.add_argument('--cache_dir', default=None, type=str, help='Memory-mapped cache of the preprocessed data')
+    parser.add_argument('--base_args', default='', type=str, help='Extra train.py arguments for every configuration')
+    parser.add_argument('--output', default='./cv/folds.csv', type=str, help='Per-fold results, summary next to it')
+    parser.add_argument('--seed', default=42, type=int, help='Random seed')
+    parser.add_argument('--logging_level', default='INFO', type=str, help='Set logging level')
+    args = parser.parse_args()
+    args.base_args = args.base_args.split()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.logging_level)
+
+    space = json.load(open(args.space)) if os.path.exists(args.space) else json.loads(args.space)
+    configs = sample_space(space, args.num_trials, args.seed) if space else [{}]
+
+    # Train and validation files are pooled, standardized once with the train stats and put in shared memory
+    train = get_data(args.train_path, args.no_sample, cache_dir=args.cache_dir)
+    val = get_data(args.val_path, args.no_sample, MEAN=train[4], STD=train[5], cache_dir=args.cache_dir)
+    num_train, num_val = len(train[1]), len(val[1])
+    blocks, specs = to_shared({name: np.concatenate([np.asarray(train[i]), np.asarray(val[i])])
+                               for i, name in enumerate(ARRAYS)})
+    del train, val
+    cls_label = np.ndarray(specs['cls_label'][1], dtype=specs['cls_label'][2], buffer=blocks[1].buf).reshape(-1)
+    # Folds of contiguous blocks (never across the train/val files): a per-frame split puts near copies of the
+    # validation frames in the training fold
+    train_groups = np.arange(num_train) // args.block_rows
+    groups = np.concatenate([train_groups, train_groups[-1] + 1 + np.arange(num_val) // args.block_rows])
+    folds = list(StratifiedGroupKFold(args.num_folds, shuffle=True, random_state=args.seed)
+                 .split(np.zeros(len(cls_label)), cls_label, groups))
+    logger.info(f'{len(configs)} configurations x {args.num_folds} folds over {len(cls_label)} frames '
+                f'({groups[-1] + 1} blocks), {args.num_workers} at a time')
+
+    num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+    ctx = mp.get_context('spawn')
+    results = []
+    try:
+        with ProcessPoolExecutor(args.num_workers, mp_context=ctx) as pool:
+            futures = {pool.submit(run_fold, c, config, f, train_idx, val_idx, specs, args, num_threads): (c, f)
+                       for c, config in enumerate(configs) for f, (train_idx, val_idx) in enumerate(folds)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception(f'Configuration {futures[future][0]} fold {futures[future][1]} failed')
+                    continue
+                logger.info(result)
+                results.append(result)
+    finally:
+        del cls_label
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    if not results:
+        logger.error(f'All {len(configs) * len(folds)} folds failed, see the errors above')
+        raise SystemExit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    folds = pd.DataFrame(results).sort_values(['config', 'fold'])
+    folds.to_csv(args.output, index=False)
+    summary = summarize(folds).sort_values('val/rgs_loss_mean')
+    summary.to_csv(os.path.splitext(args.output)[0] + '_summary.csv', index=False)
+    print(summary.to_string(index=False))
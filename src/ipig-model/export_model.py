@@ -0,0 +1,34 @@
+import argparse
+
+from utils.registry import BruceModelRegistry
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--checkpoint', default=None, type=str, help='Lightning checkpoint to publish')
+    parser.add_argument('-n', '--name', default=None, type=str, help='Model name, the backbone by default')
+    parser.add_argument('--fp16', action='store_true', help='Store floating point weights in fp16')
+    parser.add_argument('--note', default=None, type=str, help='Free text stored with the version')
+    parser.add_argument('--registry', default='./model_registry', type=str, help='Registry folder')
+    parser.add_argument('--no_verify', action='store_true', help='Skip the checkpoint/registry output comparison')
+    parser.add_argument('--list', action='store_true', help='List the registered models and versions')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    registry = BruceModelRegistry(args.registry)
+
+    if args.checkpoint is not None:
+        entry = registry.publish(args.checkpoint, args.name, 'fp16' if args.fp16 else 'fp32', args.note)
+        if not args.no_verify:
+            # Publish, load back and compare the outputs with the checkpoint
+            registry.verify(args.checkpoint, entry['digest'])
+        print(f'Published {args.checkpoint} as version {entry["version"]} ({entry["digest"][:12]}, '
+              f'{entry["size_bytes"] / 2 ** 20:.1f} MB)')
+
+    if args.list or args.checkpoint is None:
+        for name in registry.names():
+            for entry in registry.versions(name):
+                print(f'{name}:{entry["version"]:<4}{entry["digest"][:12]}  {entry["dtype"]}  '
+                      f'{entry["size_bytes"] / 2 ** 20:8.1f} MB  {entry["created"]}  {entry["source"]}')
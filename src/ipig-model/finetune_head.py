@@ -0,0 +1,94 @@
+import os, time, logging, argparse
+import torch
+import pytorch_lightning as pl
+
+from model import BruceModel
+from model.head import compute_features, head_only
+from train import get_data
+from utils.cache import BruceDataCache, file_digest
+from utils.loader import get_batch_loader
+from utils.stats import stats_path
+
+
+logger = logging.getLogger('model')
+
+
+class EpochTimer(pl.Callback):
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._t0 = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module, unused=None):
+        self.last = time.perf_counter() - self._t0
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--checkpoint', required=True, type=str, help='Trained model, its core is frozen')
+    parser.add_argument('--output', default=None, type=str, help='Fine-tuned checkpoint, <checkpoint>-head.ckpt by default')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
+    parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path')
+    parser.add_argument('--no_sample', action='store_true', help='Use the full data')
+    parser.add_argument('--cache_dir', default='./data_cache', type=str, help='Preprocessed data and feature cache')
+    parser.add_argument('--num_epoch', default=20, type=int, help='Number of epoch')
+    parser.add_argument('--batch_size', default=1024, type=int, help='Batch size')
+    parser.add_argument('--lr', default=None, type=float, help='Learning rate, the checkpoint one by default')
+
+    # Head hparams that can change without touching the core
+    parser.add_argument('--pos_weight', default=None, type=float, help='Classification weight')
+    parser.add_argument('--rgs_loss', default=None, type=str, help='Regression loss: mae or smape')
+    parser.add_argument('--cls_only', default=None, type=int, help='1 to only train the classification')
+    parser.add_argument('--rgs_only', default=None, type=int, help='1 to only train the regressions')
+    parser.add_argument('--logging_level', default='INFO', type=str, help='Set logging level')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.logging_level)
+    torch.manual_seed(42)
+    output = args.output or os.path.splitext(args.checkpoint)[0] + '-head.ckpt'
+
+    # The loss functions are rebuilt from the overridden hparams, pos_weight is also a buffer of the state dict
+    overrides = {k: getattr(args, k) for k in ('lr', 'pos_weight', 'rgs_loss', 'cls_only', 'rgs_only')
+                 if getattr(args, k) is not None}
+    model = BruceModel.load_from_checkpoint(args.checkpoint, **overrides)
+    if args.pos_weight is not None:
+        model.cls_loss_fn.pos_weight.fill_(args.pos_weight)
+
+    stats = getattr(model, 'norm_stats', None)
+    MEAN, STD = (stats.mean, stats.std) if stats is not None else (None, None)
+    train_inputs, train_cls, train_dt, train_id, MEAN, STD = get_data(args.train_path, args.no_sample, MEAN=MEAN,
+                                                                      STD=STD, cache_dir=args.cache_dir)
+    val_inputs, val_cls, val_dt, val_id, _, _ = get_data(args.val_path, args.no_sample, MEAN=MEAN, STD=STD,
+                                                         cache_dir=args.cache_dir)
+
+    # Core outputs computed once, later runs on the same checkpoint and data only map the feature files
+    cache = BruceDataCache(args.cache_dir)
+    core_id = file_digest(args.checkpoint, args.cache_dir)
+    features = {}
+    for split, path, inputs in (('train', args.train_path, train_inputs), ('val', args.val_path, val_inputs)):
+        key = cache.key(path, 'ipig-h5', features_of=core_id, rows=int(inputs.shape[0]), mean=MEAN, std=STD)
+        features[split], core_time = compute_features(model, inputs, args.batch_size, cache, key)
+        logger.info(f'{split} features {features[split].shape} ({core_time:.1f}s in the core)')
+
+    as_tensors = lambda *xs: [torch.as_tensor(x, dtype=torch.float32) for x in xs]
+    train_loader = get_batch_loader(as_tensors(features['train'], train_cls, train_dt, train_id),
+                                    batch_size=args.batch_size, shuffle=True)
+    val_loader = get_batch_loader(as_tensors(features['val'], val_cls, val_dt, val_id),
+                                  batch_size=args.batch_size, shuffle=False)
+    model.total_training_step = len(train_loader) * args.num_epoch
+    model.warming_step = min(model.warming_step, model.total_training_step // 10)
+
+    timer = EpochTimer()
+    with head_only(model):
+        # Only intermediate_layer/output_layer are in the optimizer, the checkpoint is written with the core back
+        trainer = pl.Trainer(logger=False, enable_checkpointing=False, callbacks=[timer], max_epochs=args.num_epoch,
+                             enable_model_summary=False)
+        trainer.fit(model, train_loader, val_loader)
+    trainer.save_checkpoint(output, weights_only=True)
+    if stats is not None:
+        stats.save(stats_path(output))
+
+    metrics = {k: float(v) for k, v in trainer.callback_metrics.items() if k.startswith('val/')}
+    logger.info(f'Head epoch {timer.last:.2f}s on cached features, {metrics}')
+    print(f'Saved {output}')
@@ -0,0 +1,40 @@
+import time, argparse
+
+from utils.synthetic import generate_h5
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default='synthetic.h5', type=str, help='Output HDF5 file')
+    parser.add_argument('-n', '--num_frames', default=1000000, type=int, help='Number of frames')
+    parser.add_argument('--seed', default=42, type=int, help='Seed, the file only depends on it and the options')
+    parser.add_argument('--num_workers', default=None, type=int, help='Generator processes, #cpu - 1 by default')
+    parser.add_argument('--chunk_rows', default=16384, type=int, help='Frames generated per task')
+    parser.add_argument('--h5_chunk_rows', default=1024, type=int, help='HDF5 chunk size in frames')
+    parser.add_argument('--compression', default=None, type=str, help='HDF5 compression: gzip, lzf or none')
+    parser.add_argument('--pos_fraction', default=0.3, type=float, help='Fraction of frames with a deposit')
+    parser.add_argument('--mean_run', default=200, type=int, help='Mean length in frames of a constant deposit')
+    parser.add_argument('--distribution', default='levels', type=str,
+                        help='Thickness distribution: levels (simulator steps), uniform or lognormal')
+    parser.add_argument('--thickness_range', default='0.5,4.0', type=str, help='Min,max thickness (x10, as stored)')
+    parser.add_argument('--diameters', default='100,150,200', type=str, help='Inner diameters to draw from')
+    parser.add_argument('--dead_fraction', default=0.05, type=float, help='Fraction of dead (0) readings')
+    parser.add_argument('--noise', default=0.3, type=float, help='Std of the reading noise')
+    args = parser.parse_args()
+    args.thickness_range = [float(x) for x in args.thickness_range.split(',')]
+    args.diameters = tuple(float(x) for x in args.diameters.split(','))
+    args.compression = None if args.compression in (None, 'none') else args.compression
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    t0 = time.perf_counter()
+    low, high = args.thickness_range
+    generate_h5(args.output, args.num_frames, seed=args.seed, chunk_rows=args.chunk_rows,
+                num_workers=args.num_workers, h5_chunk_rows=args.h5_chunk_rows, compression=args.compression,
+                dead_fraction=args.dead_fraction, noise=args.noise, pos_fraction=args.pos_fraction,
+                mean_run=args.mean_run, distribution=args.distribution, low=low, high=high,
+                diameters=args.diameters)
+    elapsed = time.perf_counter() - t0
+    print(f'Wrote {args.num_frames} frames to {args.output} in {elapsed:.1f}s ({args.num_frames / elapsed:,.0f} frames/s)')
@@ -0,0 +1,120 @@
+import time, threading, numpy as np
+import torch
+import torch.nn as nn
+import pytorch_lightning as pl
+
+from utils.scoring import BruceScorer
+
+
+class BruceGateModel(pl.LightningModule):
+    """
+    First stage of the cascade: deposit / no deposit from the first 524 readings average pooled by `pool`, one small
+    hidden layer. A few thousand multiply-adds per frame, against hundreds of thousands for the backbones.
+    gate_threshold is calibrated after training and saved in the hparams.
+    """
+
+    def __init__(self, pool=4, hidden_size=16, lr=1e-3, pos_weight=1.0, gate_threshold=0.5, **kwargs):
+        super().__init__()
+        self.save_hyperparameters()
+        self.gate = nn.Sequential(
+            nn.AvgPool1d(pool),
+            nn.Flatten(),
+            nn.Linear(524 // pool, hidden_size),
+            nn.GELU(),
+            nn.Linear(hidden_size, 1),
+        )
+        self.loss_fn = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([pos_weight]))
+
+    def forward(self, inputs):
+        b, f = inputs.shape
+        return self.gate(inputs[:, :524].reshape(b, 1, -1).float())
+
+    def training_step(self, batch, batch_idx):
+        inputs, cls_labels = batch[0], batch[1]
+        loss = self.loss_fn(self(inputs), cls_labels.reshape(-1, 1).float())
+        self.log('train/gate_loss', loss.detach(), prog_bar=True)
+        return loss
+
+    def configure_optimizers(self):
+        return torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
+
+
+@torch.no_grad()
+def gate_scores(gate, inputs, batch_size=4096):
+    gate.eval()
+    out = np.empty(inputs.shape[0], dtype=np.float32)
+    with torch.inference_mode():
+        for s in range(0, inputs.shape[0], batch_size):
+            x = torch.as_tensor(inputs[s: s + batch_size], dtype=torch.float32)
+            out[s: s + batch_size] = torch.sigmoid(gate(x)).reshape(-1).numpy()
+    return out
+
+
+def calibrate_threshold(scores, positives, target_recall=0.995):
+    # Highest threshold that still lets `target_recall` of the positive frames through the gate
+    pos = np.sort(scores[np.asarray(positives, dtype=bool)])
+    if len(pos) == 0:
+        return 0.5
+    return float(pos[int(np.floor((1 - target_recall) * len(pos)))])
+
+
+class BruceCascadeScorer(BruceScorer):
+    """
+    BruceScorer with a gate in front: frames scored below gate_threshold skip the backbone and the regression head
+    (cls is the gate probability, dt, id and final are 0). Same outputs as BruceScorer, score() and score_to_file()
+    work unchanged.
+    """
+
+    def __init__(self, model, gate, gate_threshold=None, threshold=0.5, precision='fp32', num_threads=None):
+        super().__init__(model, threshold, precision, num_threads)
+        self.gate = gate.eval()
+        self.gate_threshold = gate.hparams.gate_threshold if gate_threshold is None else gate_threshold
+        self.num_frames, self.num_passed = 0, 0
+        self._lock = threading.Lock()
+
+    def predict_batch(self, inputs):
+        x = torch.as_tensor(inputs, dtype=torch.float32)
+        with torch.inference_mode():
+            cls = torch.sigmoid(self.gate(x).reshape(-1))
+            dt, id_ = torch.zeros_like(cls), torch.zeros_like(cls)
+            idx = torch.nonzero(cls >= self.gate_threshold).reshape(-1)
+            if idx.numel():
+                cls[idx], dt[idx], id_[idx], _ = super().predict_batch(x.index_select(0, idx))
+        with self._lock:
+            self.num_frames += x.shape[0]
+            self.num_passed += idx.numel()
+        return cls, dt, id_, (cls >= self.threshold) * dt
+
+    @property
+    def pass_rate(self):
+        return self.num_passed / max(self.num_frames, 1)
+
+
+def cascade_report(model, gate, inputs, dt_labels, batch_size=1024, threshold=0.5):
+    """
+    Full model against the cascade on the same frames: wall time, fraction of compute saved, fraction of frames
+    reaching the backbone, thickness MAE and recall of the frames the full model flags.
+    Both sides are the cls-gated thickness (final_predicts), which is what predict_data_kafka serves with a gate.
+    ungated_mae is the raw thickness of the full model, served without a gate.
+    """
+    dt_labels = np.asarray(dt_labels, dtype=np.float32).reshape(-1)
+    full, cascade = BruceScorer(model, threshold), BruceCascadeScorer(model, gate, threshold=threshold)
+
+    t0 = time.perf_counter()
+    full_out = full.score(inputs, batch_size)
+    full_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    cascade_out = cascade.score(inputs, batch_size)
+    cascade_time = time.perf_counter() - t0
+
+    flagged = full_out['final_predicts'] > 0
+    return {'gate_threshold': cascade.gate_threshold,
+            'pass_rate': cascade.pass_rate,
+            'full_time_s': full_time,
+            'cascade_time_s': cascade_time,
+            'compute_saved': 1 - cascade_time / full_time,
+            'ungated_mae': float(np.abs(full_out['dt_predicts'] - dt_labels).mean()),
+            'full_mae': float(np.abs(full_out['final_predicts'] - dt_labels).mean()),
+            'cascade_mae': float(np.abs(cascade_out['final_predicts'] - dt_labels).mean()),
+            'flagged_recall': float((cascade_out['final_predicts'][flagged] > 0).mean()) if flagged.any() else 1.,
+            'max_abs_diff': float(np.abs(cascade_out['final_predicts'] - full_out['final_predicts']).max())}
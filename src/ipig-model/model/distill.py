@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from model.model import BruceModel
+from utils.profiling import measure_latency
+from utils.scoring import BruceScorer
+
+
+TEACHER_KEYS = ('teacher_cls', 'teacher_dt', 'teacher_id')
+
+
+@torch.no_grad()
+def teacher_outputs_into(teacher, inputs, writers, batch_size=1024):
+    # Raw cls logits (the temperature is applied at training time), |dt| and id, one (n, 1) array each
+    teacher.eval()
+    with torch.inference_mode():
+        for s in range(0, inputs.shape[0], batch_size):
+            e = min(s + batch_size, inputs.shape[0])
+            outputs = teacher(torch.as_tensor(inputs[s:e], dtype=torch.float32))
+            for name, out in zip(TEACHER_KEYS, outputs):
+                writers[name][s:e] = out.reshape(-1, 1).numpy()
+    return writers
+
+
+def compute_teacher_outputs(teacher, inputs, batch_size=1024, cache=None, key=None):
+    """
+    Teacher outputs over the whole training set, computed once before the student training. With a BruceDataCache they
+    are materialized as memory-mapped .npy files, later runs with the same teacher and data skip the teacher entirely.
+    """
+    n = inputs.shape[0]
+    specs = {name: ((n, 1), np.float32) for name in TEACHER_KEYS}
+    if cache is None:
+        writers = {name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in specs.items()}
+        return teacher_outputs_into(teacher, inputs, writers, batch_size)
+
+    def fill(writers):
+        teacher_outputs_into(teacher, inputs, writers, batch_size)
+
+    arrays, _ = cache.load_or_build(key, lambda: specs, fill)
+    return arrays
+
+
+class BruceDistillModel(BruceModel):
+    """
+    Student trained on the labels and on the cached outputs of a teacher (batches carry 3 more tensors).
+
+    loss = distill_alpha * (soft cls loss + L1 to the teacher dt/id) + (1 - distill_alpha) * hard loss, the soft cls
+    loss being the BCE between tempered logits (scaled by T^2). Same parameters as BruceModel, the best checkpoint is
+    loaded back with BruceModel.load_from_checkpoint.
+    """
+
+    def distill_losses(self, batch):
+        # (total loss, cls, rgs, id, soft cls, soft rgs), shared by training_step and the auto-tune probes
+        inputs, cls_labels, dt_labels, id_labels, teacher_cls, teacher_dt, teacher_id = batch
+        cls_out, dt_out, id_out = self(inputs)
+
+        # Hard loss, same gating as BruceModel
+        cls_prob = torch.sigmoid(cls_out)
+        cls_loss, rgs_loss, id_loss = self.loss(cls_prob, dt_out * (cls_prob >= 0.5), id_out,
+                                                cls_labels, dt_labels, id_labels)
+        if self.cls_only:
+            hard_loss = cls_loss
+        elif self.rgs_only:
+            hard_loss = rgs_loss + id_loss
+        else:
+            hard_loss = cls_loss + rgs_loss + id_loss
+
+        # Soft loss against the teacher
+        t = self.distill_temperature
+        soft_cls = F.binary_cross_entropy_with_logits(cls_out / t, torch.sigmoid(teacher_cls / t)) * t ** 2
+        soft_rgs = F.l1_loss(dt_out, teacher_dt) + F.l1_loss(id_out, teacher_id)
+        loss = self.distill_alpha * (soft_cls + soft_rgs) + (1 - self.distill_alpha) * hard_loss
+        return loss, cls_loss, rgs_loss, id_loss, soft_cls, soft_rgs
+
+    def training_step(self, batch, batch_idx):
+        loss, cls_loss, rgs_loss, id_loss, soft_cls, soft_rgs = self.distill_losses(batch)
+        self.log('train/cls_loss', cls_loss.detach(), prog_bar=False)
+        self.log('train/rgs_loss', rgs_loss.detach(), prog_bar=True)
+        self.log('train/id_loss', id_loss.detach(), prog_bar=False)
+        self.log('train/soft_cls_loss', soft_cls.detach(), prog_bar=False)
+        self.log('train/soft_rgs_loss', soft_rgs.detach(), prog_bar=False)
+        self.log('lr', self.trainer.optimizers[0].param_groups[0]['lr'], logger=False, prog_bar=True, on_step=True,
+                 on_epoch=False)
+        return loss
+
+
+def distillation_report(teacher, student, inputs, dt_labels, cls_labels, batch_sizes=(1, 256), threshold=0.5):
+    """
+    Thickness MAE (of the gated prediction), accuracy and median CPU latency of the teacher and the student on the
+    same data, with the student speedup and accuracy gap.
+    """
+    dt_labels = np.asarray(dt_labels, dtype=np.float32).reshape(-1)
+    cls_labels = np.asarray(cls_labels, dtype=np.float32).reshape(-1)
+    report = {}
+    for name, model in (('teacher', teacher), ('student', student)):
+        out = BruceScorer(model, threshold).score(inputs)
+        report[f'{name}/mae'] = float(np.abs(out['final_predicts'] - dt_labels).mean())
+        report[f'{name}/accuracy'] = float(((out['cls'] >= threshold) == (cls_labels > 0.5)).mean())
+        report[f'{name}/num_params'] = sum(p.numel() for p in model.parameters())
+        latencies = measure_latency(model, inputs.shape[1], batch_sizes, warmup=5)
+        report.update({f'{name}/{k}': v for k, v in latencies.items()})
+
+    for b in batch_sizes:
+        report[f'speedup_b{b}'] = report[f'teacher/latency_ms_b{b}'] / report[f'student/latency_ms_b{b}']
+    report['mae_gap'] = report['student/mae'] - report['teacher/mae']
+    report['accuracy_gap'] = report['teacher/accuracy'] - report['student/accuracy']
+    return report
@@ -0,0 +1,50 @@
+import time, numpy as np
+import torch
+
+from contextlib import contextmanager
+from model.model import DumpCore
+
+
+@torch.no_grad()
+def core_features_into(core, inputs, writer, batch_size=1024):
+    # Eval mode: the cached features are the deterministic (no dropout) outputs of the core
+    core.eval()
+    with torch.inference_mode():
+        for s in range(0, inputs.shape[0], batch_size):
+            e = min(s + batch_size, inputs.shape[0])
+            writer[s:e] = core(torch.as_tensor(inputs[s:e], dtype=torch.float32)).reshape(e - s, -1).numpy()
+    return writer
+
+
+def compute_features(model, inputs, batch_size=1024, cache=None, key=None):
+    """
+    Outputs of model.core for every frame, (n, core_out) float32. With a BruceDataCache they are materialized once as a
+    memory-mapped .npy file, keyed by the checkpoint and the data. Returns (features, seconds spent in the core).
+    """
+    if model.hparams.backbone != 'lstm' and inputs.shape[1] > 524:
+        inputs = inputs[:, :524]
+    with torch.inference_mode():
+        num_features = model.core.eval()(torch.as_tensor(inputs[:2], dtype=torch.float32)).reshape(2, -1).shape[1]
+    specs = {'features': ((inputs.shape[0], num_features), np.float32)}
+
+    t0 = time.perf_counter()
+    if cache is None:
+        features = core_features_into(model.core, inputs, np.empty(*specs['features']), batch_size)
+    else:
+        def fill(writers):
+            core_features_into(model.core, inputs, writers['features'], batch_size)
+
+        arrays, _ = cache.load_or_build(key, lambda: specs, fill)
+        features = arrays['features']
+    return features, time.perf_counter() - t0
+
+
+@contextmanager
+def head_only(model):
+    # The core is swapped for DumpCore, the model then trains intermediate_layer/output_layer on cached features only
+    core = model.core
+    model.core = DumpCore()
+    try:
+        yield model
+    finally:
+        model.core = core
@@ -0,0 +1,91 @@
+import copy, types
+import torch
+import torch.nn as nn
+
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from model.model import BruceLSTMBlock
+
+
+class OptimizationMismatchError(ValueError):
+    pass
+
+
+class BrucePrecomputedLSTMBlock(nn.Module):
+    # BruceLSTMBlock with the position embedding of the 10 steps stored as a constant (10, 60) buffer
+    def __init__(self, block: BruceLSTMBlock):
+        super().__init__()
+        self.register_buffer('pos_matrix', block.pos_embedding.weight.detach().clone())
+        self.pre_norm = block.pre_norm
+        self.lstm = block.lstm
+
+    def forward(self, inputs):
+        return self.lstm(self.pre_norm(inputs.reshape(-1, 10, 60) + self.pos_matrix))
+
+
+def _fold_sequential(seq: nn.Sequential):
+    # Conv1d + BatchNorm1d pairs become one Conv1d, Dropout is dropped
+    layers, modules = [], list(seq)
+    i = 0
+    while i < len(modules):
+        m = modules[i]
+        if isinstance(m, nn.Conv1d) and i + 1 < len(modules) and isinstance(modules[i + 1], nn.BatchNorm1d):
+            layers.append(fuse_conv_bn_eval(m, modules[i + 1]))
+            i += 2
+            continue
+        if not isinstance(m, (nn.Dropout, nn.Identity)):
+            layers.append(m)
+        i += 1
+    return nn.Sequential(*layers)
+
+
+def _transform(module):
+    for name, child in list(module.named_children()):
+        if isinstance(child, BruceLSTMBlock):
+            setattr(module, name, BrucePrecomputedLSTMBlock(child))
+        elif isinstance(child, nn.Sequential):
+            _transform(child)
+            setattr(module, name, _fold_sequential(child))
+        elif isinstance(child, nn.Dropout):
+            setattr(module, name, nn.Identity())
+        else:
+            _transform(child)
+
+
+def _inference_forward(self, inputs):
+    # BruceModel.forward without the unsqueeze/transpose of the outputs, same values and shapes
+    if self.backbone != 'lstm' and inputs.shape[1] > 524:
+        inputs = inputs[:, :524]
+    outputs = self.output_layer(self.intermediate_layer(self.core(inputs))).float()
+    return outputs[:, 0:1], outputs[:, 1:2].abs(), outputs[:, 2:3]
+
+
+@torch.no_grad()
+def verify_equivalence(original, optimized, num_feature, batch_size=64, atol=1e-4, rtol=1e-4, seed=0):
+    x = torch.randn(batch_size, num_feature, generator=torch.Generator().manual_seed(seed))
+    for name, a, b in zip(('cls', 'dt', 'id'), original(x), optimized(x)):
+        if a.shape != b.shape or not torch.allclose(a, b, atol=atol, rtol=rtol):
+            diff = (a - b).abs().max().item() if a.shape == b.shape else f'shape {tuple(a.shape)} != {tuple(b.shape)}'
+            raise OptimizationMismatchError(f'Optimized model differs on {name}: max abs diff {diff}')
+    return True
+
+
+def optimize_for_inference(model, check=True):
+    """
+    Inference-only copy of a BruceModel, in eval mode and without gradients:
+    - BatchNorm1d folded into the preceding Conv1d (BruceStackedConv, BruceProcessingModule, UNet output)
+    - Dropout removed from the Sequentials, replaced by Identity elsewhere
+    - position embedding of BruceLSTMBlock precomputed instead of an Embedding lookup of arange(10) per call
+    - leaner forward, the abs of the thickness stays (it is part of the output)
+    With check=True the copy is compared with the original on random frames, OptimizationMismatchError otherwise.
+    The copy has a different module layout, train and save the original model.
+    """
+    model = model.eval()
+    optimized = copy.deepcopy(model)
+    _transform(optimized)
+    optimized.forward = types.MethodType(_inference_forward, optimized)
+    optimized.requires_grad_(False)
+    optimized.optimized_for_inference = True
+
+    if check:
+        verify_equivalence(model, optimized, 600 if model.hparams.backbone == 'lstm' else 524)
+    return optimized
@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class BruceValidationMetrics(nn.Module):
+    """
+    Streaming validation metrics kept as (non-persistent) buffers on the model device.
+
+    update() only runs tensor ops (bincount, sums), no .cpu() or Python loop per batch. Per-thickness histograms of the
+    predicted thickness are one 2-D bincount over (thickness class, prediction bin), thickness classes being the label
+    rounded to `resolution`. AUROC and the accuracy at 0.5 are computed from score histograms of the positive and
+    negative frames.
+    """
+
+    def __init__(self, hist_range=(0.0, 0.4), hist_bins=8, cls_bins=4, auroc_bins=1024, resolution=0.005,
+                 max_thickness=1.0):
+        super().__init__()
+        self.hist_range = hist_range
+        self.hist_bins = hist_bins
+        self.cls_bins = cls_bins
+        self.auroc_bins = auroc_bins
+        self.resolution = resolution
+        self.num_classes = int(round(max_thickness / resolution)) + 1
+
+        self.register_buffer('sums', torch.zeros(4, dtype=torch.float64), persistent=False)  # |e|, |o-t|, o+t, n
+        self.register_buffer('thickness_hist', torch.zeros(self.num_classes * hist_bins, dtype=torch.long),
+                             persistent=False)
+        self.register_buffer('class_count', torch.zeros(self.num_classes, dtype=torch.long), persistent=False)
+        self.register_buffer('cls_hist', torch.zeros(cls_bins, dtype=torch.long), persistent=False)
+        self.register_buffer('auroc_hist', torch.zeros(2 * auroc_bins, dtype=torch.long), persistent=False)
+
+    def reset(self):
+        for buf in self.buffers():
+            buf.zero_()
+
+    @staticmethod
+    def _bin(values, lo, hi, bins):
+        return ((values - lo) / (hi - lo) * bins).long().clamp_(0, bins - 1)
+
+    @torch.no_grad()
+    def update(self, cls_prob, dt_pred, dt_true, cls_label):
+        cls_prob, dt_pred = cls_prob.reshape(-1).float(), dt_pred.reshape(-1).float()
+        dt_true, cls_label = dt_true.reshape(-1).float(), cls_label.reshape(-1)
+
+        err = (dt_pred - dt_true).abs()
+        self.sums += torch.stack([err.sum(), err.sum(), (dt_pred + dt_true).sum(),
+                                  torch.tensor(float(err.numel()), device=err.device)]).double()
+
+        # np.histogram semantics: values outside hist_range are not counted
+        lo, hi = self.hist_range
+        classes = (dt_true / self.resolution).round().long().clamp_(0, self.num_classes - 1)
+        in_range = (dt_pred >= lo) & (dt_pred <= hi)
+        flat = classes * self.hist_bins + self._bin(dt_pred, lo, hi, self.hist_bins)
+        self.thickness_hist += torch.bincount(flat[in_range], minlength=self.thickness_hist.numel())
+        self.class_count += torch.bincount(classes, minlength=self.num_classes)
+
+        self.cls_hist += torch.bincount(self._bin(cls_prob, 0., 1., self.cls_bins), minlength=self.cls_bins)
+        positive = (cls_label > 0.5).long()
+        self.auroc_hist += torch.bincount(positive * self.auroc_bins + self._bin(cls_prob, 0., 1., self.auroc_bins),
+                                          minlength=2 * self.auroc_bins)
+
+    def sync(self, reduce_fn):
+        # reduce_fn(tensor) -> summed tensor across processes (e.g. trainer.training_type_plugin.reduce)
+        for buf in self.buffers():
+            buf.copy_(reduce_fn(buf))
+
+    def _auroc(self):
+        neg, pos = self.auroc_hist.view(2, self.auroc_bins).double()
+        if pos.sum() == 0 or neg.sum() == 0:
+            return float('nan')
+        # P(score_pos > score_neg) + 0.5 P(tie), ties being the same bin
+        neg_below = torch.cumsum(neg, 0) - neg
+        return float(((neg_below + 0.5 * neg) * pos).sum() / (pos.sum() * neg.sum()))
+
+    def _accuracy(self, threshold=0.5):
+        # Frames in bins >= threshold are predicted positive, exact for thresholds on a bin edge
+        neg, pos = self.auroc_hist.view(2, self.auroc_bins)
+        cut = int(round(threshold * self.auroc_bins))
+        total = int(neg.sum() + pos.sum())
+        return int(pos[cut:].sum() + neg[:cut].sum()) / total if total else float('nan')
+
+    def compute(self):
+        abs_err, num, den, n = self.sums.tolist()
+        scalars = {'mae': abs_err / max(n, 1), 'smape': num / den if den else float('nan'), 'auroc': self._auroc(),
+                   'accuracy': self._accuracy()}
+
+        hist_edges = np.linspace(*self.hist_range, self.hist_bins + 1)
+        thickness_hist = self.thickness_hist.view(self.num_classes, self.hist_bins).cpu().numpy()
+        histograms = {f'hist/{k * self.resolution:g}': (thickness_hist[k], hist_edges)
+                      for k in torch.nonzero(self.class_count).reshape(-1).tolist()}
+        histograms['hist/cls'] = (self.cls_hist.cpu().numpy(), np.linspace(0., 1., self.cls_bins + 1))
+        return scalars, histograms
@@ -6,6 +6,9 @@ import torch.nn.functional as F
 import pytorch_lightning as pl, matplotlib.pyplot as plt
 from collections import OrderedDict
 from pytorch_lightning.loggers import WandbLogger
+from utils.local_logger import log_histograms
+from model.metrics import BruceValidationMetrics
+from utils.stats import NormStats
 
 
 def SMAPE_loss(output, target):
@@ -231,10 +234,12 @@ class BruceModel(pl.LightningModule):
 
         # FCN Layer
         act_fn = nn.Tanh if self.act == 'tanh' else nn.GELU
+        # Expansion width, smaller than core_out * 4 in pruned models
+        intermediate_size = getattr(self, 'intermediate_size', None) or self.core_out * 4
         self.intermediate_layer = nn.Sequential(
-            nn.Linear(self.core_out, self.core_out * 4),
+            nn.Linear(self.core_out, intermediate_size),
             act_fn(),
-            nn.Linear(self.core_out * 4, self.core_out),
+            nn.Linear(intermediate_size, self.core_out),
             act_fn(),
             nn.Dropout(0.1),
         )
@@ -251,6 +256,9 @@ class BruceModel(pl.LightningModule):
         # self.dt_out = nn.Linear(self.core_out, 1)
         # self.id_out = nn.Linear(self.core_out, 1)
 
+        # Streaming validation metrics
+        self.val_metrics = BruceValidationMetrics()
+
         # Loss function
         self.cls_loss_fn = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([self.pos_weight]))
         self.rgs_loss_fn = nn.L1Loss() if self.rgs_loss == 'mae' else SMAPE_loss
@@ -264,6 +272,15 @@ class BruceModel(pl.LightningModule):
         # Init weights
         self.apply(self._init_weights)
 
+    def on_save_checkpoint(self, checkpoint):
+        # Normalization stats of the training data travel with the weights (see utils.stats)
+        if getattr(self, 'norm_stats', None) is not None:
+            checkpoint['norm_stats'] = self.norm_stats.to_dict()
+
+    def on_load_checkpoint(self, checkpoint):
+        if 'norm_stats' in checkpoint:
+            self.norm_stats = NormStats.from_dict(checkpoint['norm_stats'])
+
     def _init_weights(self, module: nn.Module):
         if isinstance(module, nn.Linear) or isinstance(module, nn.Conv1d):
             module.weight.data.normal_(mean=0.0, std=self.initializer_range)
@@ -285,6 +302,9 @@ class BruceModel(pl.LightningModule):
 
     def forward(self, inputs):
         b, f = inputs.shape
+        if self.backbone != 'lstm' and f > 524 and not isinstance(self.core, DumpCore):
+            # Only the LSTM block uses the full 600 readings, the other backbones take the first 524
+            inputs = inputs[:, :524]
 
         # Core forward
         x = self.core(inputs)
@@ -292,8 +312,8 @@ class BruceModel(pl.LightningModule):
         # FCN
         x = self.intermediate_layer(x)
 
-        # Classification output
-        outputs = self.output_layer(x).unsqueeze(0)
+        # Classification output, always returned in fp32 (bf16 autocast)
+        outputs = self.output_layer(x).float().unsqueeze(0)
         cls_out, dt_out, id_out = outputs.T
 
         # # Regression output
@@ -311,7 +331,7 @@ class BruceModel(pl.LightningModule):
                self.rgs_loss_fn(id_out, id_labels)
 
     def training_step(self, batch, batch_idx):
-        if self.trainer.global_step == 0:
+        if self.trainer.global_step == 0 and wandb.run is not None:
             wandb.define_metric('train/rgs_loss', summary='min', goal='minimize')
             wandb.define_metric('train/cls_loss', summary='min', goal='minimize')
         inputs, cls_labels, dt_labels, id_labels = batch
@@ -323,10 +343,10 @@ class BruceModel(pl.LightningModule):
 
         cls_loss, rgs_loss, id_loss = self.loss(cls_out, dt_out, id_out, cls_labels, dt_labels, id_labels)
 
-        # Log loss
-        self.log('train/cls_loss', cls_loss.item(), prog_bar=False)
-        self.log('train/rgs_loss', rgs_loss.item(), prog_bar=True)
-        self.log('train/id_loss', id_loss.item(), prog_bar=False)
+        # Log loss, detached tensors are only synchronized when the logger actually writes
+        self.log('train/cls_loss', cls_loss.detach(), prog_bar=False)
+        self.log('train/rgs_loss', rgs_loss.detach(), prog_bar=True)
+        self.log('train/id_loss', id_loss.detach(), prog_bar=False)
 
         # Log learning rate to progress bar
         cur_lr = self.trainer.optimizers[0].param_groups[0]['lr']
@@ -350,7 +370,7 @@ class BruceModel(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         # Track best rgs loss
-        if self.trainer.global_step == 0:
+        if self.trainer.global_step == 0 and wandb.run is not None:
             wandb.define_metric('val/rgs_loss', summary='min', goal='minimize')
             wandb.define_metric('val/cls_loss', summary='min', goal='minimize')
         inputs, cls_labels, dt_labels, id_labels = batch
@@ -369,9 +389,9 @@ class BruceModel(pl.LightningModule):
             loss = cls_loss + rgs_loss + id_loss
 
         # Log loss
-        self.log('val/cls_loss', cls_loss.item(), prog_bar=False)
-        self.log('val/rgs_loss', rgs_loss.item(), prog_bar=True)
-        self.log('val/id_loss', id_loss.item(), prog_bar=False)
+        self.log('val/cls_loss', cls_loss.detach(), prog_bar=False, sync_dist=True)
+        self.log('val/rgs_loss', rgs_loss.detach(), prog_bar=True, sync_dist=True)
+        self.log('val/id_loss', id_loss.detach(), prog_bar=False, sync_dist=True)
 
         '''
         # Calculate train metrics
@@ -380,40 +400,24 @@ class BruceModel(pl.LightningModule):
         '''
 
         # Log train metrics
-        self.log('val/loss', loss.item())
+        self.log('val/loss', loss.detach(), sync_dist=True)
         # self.log('val/acc', self.val_acc, prog_bar=False)
         # self.log('val/auc', self.val_auc, prog_bar=False)
 
-        # Processing outputs
-        self.cls_outs.extend(cls_out.cpu().reshape(-1).tolist())
-        self.true_values.extend(dt_labels.cpu().reshape(-1).tolist())
-        self.predicted_values.extend(dt_out.cpu().reshape(-1).tolist())
+        # Processing outputs, accumulated on device
+        self.val_metrics.update(cls_out, dt_out, dt_labels, cls_labels)
 
     def on_validation_epoch_start(self) -> None:
-        self.true_values = []
-        self.predicted_values = []
-        self.cls_outs = []
+        self.val_metrics.reset()
 
     def on_validation_epoch_end(self) -> None:
-        self.df = pd.DataFrame({
-            'y_true': torch.tensor(self.true_values).numpy(),
-            'y_predict': torch.tensor(self.predicted_values).numpy(),
-        })
-
-        possible_true = self.df.y_true.unique()
-        log_dict = {}
-
-        for k in possible_true:
-            hist_data = np.histogram(self.df[self.df.y_true == k].y_predict.values, range=(0.0, 0.4), bins=8)
-            log_dict[f'hist/{str(k)}'] = wandb.Histogram(np_histogram=hist_data)
-
-        log_dict['hist/cls'] = wandb.Histogram(
-            np_histogram=np.histogram(np.array(self.cls_outs), bins=4, range=(0.0, 1.0))
-        )
-
-        log_dict['epoch'] = self.trainer.current_epoch
+        self.val_metrics.sync(lambda t: self.trainer.training_type_plugin.reduce(t, reduce_op='sum'))
+        scalars, histograms = self.val_metrics.compute()
+        for k, v in scalars.items():
+            self.log(f'val/{k}', v)
 
-        self.logger.experiment.log(log_dict)
+        # wandb.Histogram or local binary files depending on the logger, nothing without logger (sweeps)
+        log_histograms(self.logger, histograms, self.trainer.global_step, self.trainer.current_epoch)
 
         # df.to_csv('temp_prediction.csv', index=False) # Save as csv
 
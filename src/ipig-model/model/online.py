@@ -0,0 +1,186 @@
+import os, copy, time, logging, threading, numpy as np
+import torch
+import pytorch_lightning as pl
+
+
+logger = logging.getLogger('model')
+
+
+class ReplayBuffer:
+    # Fixed-size ring of the most recent labeled frames, preallocated, thread-safe
+    def __init__(self, capacity, num_feature):
+        self.inputs = np.zeros((capacity, num_feature), dtype=np.float32)
+        self.targets = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def add(self, inputs, target):
+        # Returns the (inputs, target) it overwrites once full, None before
+        with self._lock:
+            evicted = (self.inputs[self._next].copy(), self.targets[self._next]) if self.size == self.capacity else None
+            self.inputs[self._next] = inputs
+            self.targets[self._next] = target
+            self._next = (self._next + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+        return evicted
+
+    def sample(self, batch_size, rng):
+        with self._lock:
+            idx = rng.integers(0, self.size, min(batch_size, self.size))
+            return self.inputs[idx], self.targets[idx]
+
+    def snapshot(self):
+        with self._lock:
+            return self.inputs[:self.size].copy(), self.targets[:self.size].copy()
+
+
+class BruceOnlineLearner:
+    """
+    Fine-tunes a copy of the served BruceModel on the labeled frames of the stream, in a background thread.
+
+    The newest `holdout_size` records are a held-out window that is never trained on, records only move to the replay
+    buffer when they leave it (deposits are constant over hundreds of frames, an interleaved split would evaluate on
+    near copies of the training frames). After every round of `steps_per_round` steps the copy is compared with the
+    served model on the held-out window and replaces it only if its thickness MAE is lower by `min_improvement`
+    (relative), training then restarts from the promoted model with a fresh optimizer.
+    The thread trains at most `max_busy` of the wall time (it sleeps in between steps), torch intra-op threads being
+    shared with the predictor.
+    Stream records only carry the thickness: the cls label is thickness > 0 and the id head is not trained.
+    """
+
+    def __init__(self, model, capacity=50000, holdout_size=5000, batch_size=128, lr=1e-5,
+                 steps_per_round=200, min_samples=2000, min_improvement=0.02, max_busy=0.25, save_dir=None,
+                 seed=42):
+        self.model = model.eval()
+        num_feature = 600 if model.hparams.backbone == 'lstm' else 524
+        self.replay = ReplayBuffer(capacity, num_feature)
+        self.holdout = ReplayBuffer(holdout_size, num_feature)
+        self.batch_size = batch_size
+        self.lr = lr
+        self.steps_per_round = steps_per_round
+        self.min_samples = min_samples
+        self.min_improvement = min_improvement
+        self.max_busy = max_busy
+        self.save_dir = save_dir
+        self.rng = np.random.default_rng(seed)
+        self.num_records = 0
+        self.num_promotions = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, inputs, target):
+        # Called by the predictor for every labeled record, O(frame size)
+        inputs = np.asarray(inputs, dtype=np.float32)[:self.replay.inputs.shape[1]]
+        self.num_records += 1
+        evicted = self.holdout.add(inputs, target)
+        if evicted is not None:
+            self.replay.add(*evicted)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='online-learner', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @staticmethod
+    @torch.no_grad()
+    def evaluate(model, inputs, targets, threshold=0.5):
+        with torch.inference_mode():
+            cls_out, dt_out, _ = model(torch.from_numpy(inputs))
+        final = (torch.sigmoid(cls_out.reshape(-1)) >= threshold) * dt_out.reshape(-1)
+        return float((final - torch.from_numpy(targets)).abs().mean())
+
+    def _train_step(self, candidate, optimizer):
+        inputs, targets = self.replay.sample(self.batch_size, self.rng)
+        inputs, dt_labels = torch.from_numpy(inputs), torch.from_numpy(targets).reshape(-1, 1)
+        cls_labels = (dt_labels > 0).float()
+
+        # Same objective as BruceModel.training_step, without the id head
+        cls_out, dt_out, _ = candidate(inputs)
+        cls_out = torch.sigmoid(cls_out)
+        dt_out = dt_out * (cls_out >= 0.5)
+        loss = candidate.cls_loss_fn(cls_out, cls_labels) + candidate.rgs_loss_fn(dt_out, dt_labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return float(loss)
+
+    def _throttle(self, busy):
+        # Sleep so that training takes at most max_busy of the wall time
+        self._stop.wait(busy * (1 / self.max_busy - 1))
+
+    def _throttled_mae(self, model, inputs, targets, batch_size=512):
+        # Held-out MAE in batches, each one followed by its share of sleep: evaluation counts toward max_busy too
+        total = 0.
+        for s in range(0, len(targets), batch_size):
+            if self._stop.is_set():
+                return None
+            t0 = time.perf_counter()
+            total += self.evaluate(model, inputs[s: s + batch_size], targets[s: s + batch_size]) * \
+                len(targets[s: s + batch_size])
+            self._throttle(time.perf_counter() - t0)
+        return total / max(len(targets), 1)
+
+    def _round(self, candidate, optimizer):
+        losses = []
+        for _ in range(self.steps_per_round):
+            if self._stop.is_set():
+                return None
+            t0 = time.perf_counter()
+            losses.append(self._train_step(candidate, optimizer))
+            self._throttle(time.perf_counter() - t0)
+        return float(np.mean(losses))
+
+    def _promote(self, candidate, served_mae, candidate_mae):
+        promoted = copy.deepcopy(candidate).eval()
+        self.model = promoted
+        self.num_promotions += 1
+        logger.info(f'Online model v{self.num_promotions} promoted, held-out MAE {served_mae:.4f} -> {candidate_mae:.4f}')
+        if self.save_dir is not None:
+            os.makedirs(self.save_dir, exist_ok=True)
+            checkpoint = {'state_dict': promoted.state_dict(), 'hyper_parameters': dict(promoted.hparams),
+                          'pytorch-lightning_version': pl.__version__, 'epoch': self.num_promotions,
+                          'online_records': self.num_records}
+            if getattr(promoted, 'norm_stats', None) is not None:
+                checkpoint['norm_stats'] = promoted.norm_stats.to_dict()
+            torch.save(checkpoint, os.path.join(self.save_dir, f'online-v{self.num_promotions}.ckpt'))
+
+    def _candidate(self):
+        candidate = copy.deepcopy(self.model).train()
+        # Registry models are loaded frozen
+        for p in candidate.parameters():
+            p.requires_grad_(True)
+        return candidate, torch.optim.AdamW(candidate.parameters(), lr=self.lr)
+
+    def _run(self):
+        candidate, optimizer = self._candidate()
+        while not self._stop.is_set():
+            if len(self.replay) < self.min_samples:
+                self._stop.wait(1.0)
+                continue
+
+            loss = self._round(candidate, optimizer)
+            if loss is None:
+                break
+
+            inputs, targets = self.holdout.snapshot()
+            candidate.eval()
+            served_mae = self._throttled_mae(self.model, inputs, targets)
+            candidate_mae = self._throttled_mae(candidate, inputs, targets)
+            candidate.train()
+            if served_mae is None or candidate_mae is None:
+                break
+            logger.debug(f'Online round: loss {loss:.4f}, held-out MAE served {served_mae:.4f}, '
+                         f'candidate {candidate_mae:.4f}')
+            if candidate_mae < served_mae * (1 - self.min_improvement):
+                self._promote(candidate, served_mae, candidate_mae)
+                candidate, optimizer = self._candidate()
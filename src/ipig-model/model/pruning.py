@@ -0,0 +1,73 @@
+import torch
+
+
+def _norm(w, dims):
+    return w.float().pow(2).sum(dims).sqrt()
+
+
+def keep_top(importance, sparsity, min_keep=1):
+    # Indices of the most important units, in their original order
+    k = max(min_keep, int(round(importance.numel() * (1 - sparsity))))
+    return importance.topk(k).indices.sort().values
+
+
+def intermediate_importance(model):
+    # A hidden unit of intermediate_layer matters as much as its input row times its output column
+    first, second = model.intermediate_layer[0], model.intermediate_layer[2]
+    return _norm(first.weight, 1) * _norm(second.weight, 0)
+
+
+def conv_importance(model, i):
+    # Output channel of the i-th conv of BruceCNNCell: its filter times the weights reading it downstream
+    core = model.core
+    conv = core.cnn_layers[i][0]
+    if i + 1 < len(core.cnn_layers):
+        consumer = _norm(core.cnn_layers[i + 1][0].weight, (0, 2))
+    else:
+        w = core.cnn_out.weight
+        consumer = _norm(w.reshape(w.shape[0], conv.out_channels, -1), (0, 2))
+    return _norm(conv.weight, (1, 2)) * consumer
+
+
+@torch.no_grad()
+def prune_model(model, sparsity, prune_conv=True):
+    """
+    Physically smaller copy of a BruceModel: the `sparsity` fraction of least important intermediate units (and
+    BruceCNNCell conv channels, which also shrinks the input of cnn_out) are removed. The result is a plain model
+    with updated hparams (intermediate_size, output_channel), saved and loaded like any other checkpoint.
+    """
+    hparams = dict(model.hparams)
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+
+    keep = keep_top(intermediate_importance(model), sparsity)
+    for k in ('intermediate_layer.0.weight', 'intermediate_layer.0.bias'):
+        state[k] = state[k][keep]
+    state['intermediate_layer.2.weight'] = state['intermediate_layer.2.weight'][:, keep]
+    hparams['intermediate_size'] = len(keep)
+
+    if prune_conv and hparams['backbone'] == 'cnn':
+        channels = list(hparams['output_channel'])
+        for i in range(hparams['num_cnn']):
+            keep = keep_top(conv_importance(model, i), sparsity)
+            prefix = f'core.cnn_layers.cnn_{i}.0'
+            state[f'{prefix}.weight'] = state[f'{prefix}.weight'][keep]
+            state[f'{prefix}.bias'] = state[f'{prefix}.bias'][keep]
+            if i + 1 < hparams['num_cnn']:
+                k = f'core.cnn_layers.cnn_{i + 1}.0.weight'
+                state[k] = state[k][:, keep]
+            else:
+                w = state['core.cnn_out.weight']
+                state['core.cnn_out.weight'] = w.reshape(w.shape[0], channels[i], -1)[:, keep].reshape(w.shape[0], -1)
+            channels[i] = len(keep)
+        hparams['output_channel'] = channels
+
+    pruned = type(model)(**hparams)
+    pruned.load_state_dict(state)
+    if getattr(model, 'norm_stats', None) is not None:
+        pruned.norm_stats = model.norm_stats
+    return pruned
+
+
+def pareto_front(points):
+    # points: [(latency, error)], True where no other point is at least as good on both and better on one
+    return [not any(l2 <= l1 and e2 <= e1 and (l2, e2) != (l1, e1) for l2, e2 in points) for l1, e1 in points]
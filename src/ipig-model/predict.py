@@ -5,6 +5,10 @@ import torch.nn.functional as F
 import pytorch_lightning as pl
 
 from model import BruceModel
+from model.inference import optimize_for_inference
+from utils.cache import BruceDataCache
+from utils.preprocessing import get_pipeline
+from utils.scoring import BruceScorer, ColumnarWriter
 from torch.utils.data import DataLoader, Dataset, TensorDataset
 
 from sklearn.model_selection import train_test_split
@@ -37,17 +41,57 @@ def read_data(path):
 def preprocessing_data(arr, normalize=True):
     if normalize:
         # Data normalization
-        return (arr - arr.min()) / (arr.max() - arr.min())
+        return get_pipeline('samples-big-minmax').fit_transform(arr)[0]
     else:
         # Data standardlization
-        return (arr - arr.mean()) / arr.std()
+        return get_pipeline('samples-big-dense').fit_transform(arr)[0]
 
 
 def split_data(x, y1, y2):
     return train_test_split(x, y1, y2, test_size=0.2, stratify=y1)
 
 
-def get_data(path, no_sample):
+def get_cached_data(path, no_sample, cache_dir, norm_stats=None, chunk_rows=65536):
+    # Normalized inputs (model stats, min/max otherwise) and labels of 'Samples_big', as memory-mapped .npy files
+    cache = BruceDataCache(cache_dir)
+    with h5py.File(path, 'r') as f:
+        n = f['Samples_big'].shape[0]
+    stop = n if no_sample else min(n, 2000)
+    key = cache.key(path, norm_stats.pipeline if norm_stats is not None else 'samples-big-minmax',
+                    dataset='Samples_big', slice=[0, stop],
+                    normalize=norm_stats.to_dict() if norm_stats is not None else 'minmax')
+
+    def specs():
+        return {'inputs': ((stop, 524), np.float32), 'cls_labels': ((stop, 1), np.float32),
+                'rgs_labels': ((stop, 1), np.float32)}
+
+    def fill(writers):
+        with h5py.File(path, 'r') as f:
+            data = f['Samples_big']
+            if norm_stats is not None:
+                pipeline, (arr_min, arr_range) = get_pipeline(norm_stats.pipeline), (norm_stats.mean, norm_stats.std)
+            else:
+                pipeline, stats = get_pipeline('samples-big-minmax'), None
+                for start in range(0, stop, chunk_rows):
+                    stats = pipeline.partial_fit(data[start: min(start + chunk_rows, stop), :524], stats)
+                arr_min, arr_range = stats.result()
+
+            for start in range(0, stop, chunk_rows):
+                end = min(start + chunk_rows, stop)
+                chunk = data[start:end]
+                writers['inputs'][start:end] = pipeline.transform(chunk[:, :524], arr_min, arr_range)
+                writers['rgs_labels'][start:end] = chunk[:, 526].reshape(-1, 1)
+                writers['cls_labels'][start:end] = chunk[:, 526].reshape(-1, 1) > 0
+        return {'center': arr_min, 'scale': arr_range}
+
+    arrays, _ = cache.load_or_build(key, specs, fill)
+    return arrays['inputs'], arrays['cls_labels'], arrays['rgs_labels']
+
+
+def get_data(path, no_sample, cache_dir=None, norm_stats=None):
+    if cache_dir is not None:
+        return get_cached_data(path, no_sample, cache_dir, norm_stats)
+
     f = read_data(path)
     if no_sample:
         data = f['Samples_big'][:]
@@ -56,7 +100,11 @@ def get_data(path, no_sample):
 
     train_rgs_labels = data[:, 526].reshape(-1, 1)
     train_cls_labels = (train_rgs_labels > 0).reshape(-1, 1)
-    train_inputs = preprocessing_data(data[:, :524], True)
+    if norm_stats is not None:
+        # Same normalization as the training data of the model
+        train_inputs = norm_stats.transform(data[:, :524])
+    else:
+        train_inputs = preprocessing_data(data[:, :524], True)
 
     return train_inputs, train_cls_labels, train_rgs_labels
 
@@ -70,6 +118,7 @@ def get_args():
     model_parser.add_argument('--rgs_loss', default='mae', type=str, help="Regression loss, default is MAE")
     model_parser.add_argument('--data_path', default='data.mat', type=str, help='Data path')
     model_parser.add_argument('--no_sample', action='store_true', help='Sample to test data and model')
+    model_parser.add_argument('--cache_dir', default=None, type=str, help='Memory-mapped cache of the preprocessed data')
     model_parser.add_argument('--bi_di', action='store_true', help='Bi-directional for RNN')
     model_parser.add_argument('--hidden_size', default=256, type=int, help='Hidden size')
     model_parser.add_argument('--num_lstm_layer', default=1, type=int, help='Number of LSTM layer')
@@ -81,27 +130,24 @@ def get_args():
     model_parser.add_argument('--log_step', default=100, type=int, help='Steps per log')
     model_parser.add_argument('--gpu', default=0, type=int, help='Use GPUs')
     model_parser.add_argument('--num_epoch', default=10, type=int, help='Number of epoch')
+    model_parser.add_argument('--num_workers', default=1, type=int, help='Scoring threads')
+    model_parser.add_argument('--optimize', action='store_true', help='Fold BatchNorm and strip Dropout for scoring')
+    model_parser.add_argument('--strict_stats', action='store_true', help='Fail when data and model stats differ')
+    model_parser.add_argument('--predict_format', default='h5', type=str, help='Prediction file: h5 (columnar) or csv')
 
     args = model_parser.parse_args()
     return args
 
 
-def get_predict(model, dataloader):
-    y_trues = []
-    predicts = []
-    cls = []
-
-    for batch in dataloader:
-        inputs, cls_labels, rgs_labels = batch
-        cls_out, rgs_out = model(inputs)
-
-        y_trues.extend(rgs_labels.reshape(-1).tolist())
-        cls.extend(torch.sigmoid(cls_out.reshape(-1)).tolist())
-        predicts.extend(rgs_out.reshape(-1).tolist())
-
-    final_predicts = (np.array(cls) >= 0.5) * np.array(predicts)
-
-    return y_trues, cls, predicts, final_predicts
+def get_predict(model, inputs, rgs_labels, path, batch_size=1024, num_workers=1, chunk_rows=1 << 18):
+    # Score chunk by chunk (threads split each chunk) and stream the columns to disk
+    scorer = BruceScorer(model)
+    with ColumnarWriter(path) as writer:
+        for start in range(0, inputs.shape[0], chunk_rows):
+            end = min(start + chunk_rows, inputs.shape[0])
+            out = scorer.score(inputs[start:end], batch_size, num_workers, names=('cls', 'rgs', 'id', 'final'))
+            writer.append({'y_true': np.asarray(rgs_labels[start:end], dtype=np.float32).reshape(-1), **out})
+        return writer.num_rows
 
 
 if __name__ == '__main__':
@@ -113,20 +159,18 @@ if __name__ == '__main__':
 
     # Generate model
     model = BruceModel.load_from_checkpoint(args.model_path)
+    if args.optimize:
+        model = optimize_for_inference(model)
+
+    # Get data, normalized with the stats stored with the model when it has them
+    norm_stats = getattr(model, 'norm_stats', None)
+    if norm_stats is not None:
+        with h5py.File(args.data_path, 'r') as f:
+            norm_stats.check(f['Samples_big'][:10000, :524], strict=args.strict_stats)
+    else:
+        logger.warning('Model has no normalization stats, falling back to min/max normalization of the data')
+    train_inputs, train_cls_labels, train_rgs_labels = get_data(args.data_path, args.no_sample, args.cache_dir,
+                                                                norm_stats)
 
-    # Get data
-    train_inputs, train_cls_labels, train_rgs_labels = get_data(args.data_path, args.no_sample)
-
-    # Create Dataloader
-    train_dataset = TensorDataset(torch.FloatTensor(train_inputs),
-                                  torch.FloatTensor(train_cls_labels),
-                                  torch.FloatTensor(train_rgs_labels))
-
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size)
-
-    y_trues, cls, predicts, final_predicts = get_predict(model, train_dataloader)
-    df = pd.DataFrame(np.array([y_trues, cls, predicts, final_predicts]).T, columns=['y_true', 'cls', 'rgs', 'final'])
-    df.to_csv(f'./predicts/predicted.csv', index=False)
-
-
-
+    get_predict(model, train_inputs, train_rgs_labels, f'./predicts/predicted.{args.predict_format}',
+                args.batch_size, args.num_workers)
@@ -1,6 +1,12 @@
 import torch
-import json, threading, argparse, datetime, platform
-from model import BruceModel
+import os, json, logging, threading, argparse, datetime, platform
+from utils.registry import load_inference_model
+from model.cascade import BruceGateModel
+from model.online import BruceOnlineLearner
+from model.inference import optimize_for_inference
+from utils.drift import ChannelSketch, DriftMonitor
+from utils.local_logger import BruceLocalLogger
+from utils.precision import autocast, resolve_precision
 from ctypes import *
 
 if platform.system() == 'Windows':
@@ -12,9 +18,15 @@ from confluent_kafka.schema_registry import SchemaRegistryClient
 from confluent_kafka.schema_registry.avro import AvroSerializer, AvroDeserializer
 
 
-model = BruceModel.load_from_checkpoint('./model_checkpoint/LSTM.ckpt')
+model = None
+# Optional first stage of the cascade, frames it rejects skip the model
+gate = None
+# Optional online fine-tuning, serves its latest promoted copy of the model
+learner = None
+# Optional input drift monitor, compares windows of served frames with the training frames
+drift_monitor = None
 device = 'cpu'
-model.eval()
+precision = 'fp32'
 
 
 class PigData(object):
@@ -40,11 +52,19 @@ def prediction_to_dict(obj: PigPrediction, ctx):
 
 
 def predict_inputs(inputs):
-    with torch.no_grad():
-        cls_out, dt_out, id_out = model(torch.FloatTensor(inputs).unsqueeze(0).to(device))
+    if gate is not None:
+        with torch.no_grad():
+            if torch.sigmoid(gate(torch.FloatTensor(inputs).unsqueeze(0))).item() < gate.hparams.gate_threshold:
+                return 0.
+    served = learner.model if learner is not None else model
+    with torch.no_grad(), autocast(precision):
+        cls_out, dt_out, id_out = served(torch.FloatTensor(inputs).unsqueeze(0).to(device))
     cls_out = torch.sigmoid(cls_out.flatten()).cpu()
     # prediction = dt_out.flatten().item() if cls_out > 0.5 else 0
     prediction = dt_out.flatten().cpu().item()
+    if gate is not None and cls_out.item() < 0.5:
+        # The cascade serves the cls-gated thickness (final_predicts), the gate was calibrated on it
+        prediction = 0.
     return prediction
 
 
@@ -116,6 +136,10 @@ def consuming(args):
             data = msg.value()
             prediction = predict_inputs(data.inputs)
             update_prediction(msg.key(), data.target, prediction)
+            if learner is not None:
+                learner.add(data.inputs, data.target)
+            if drift_monitor is not None:
+                drift_monitor.update(data.inputs)
             if data is not None:
                 print("User record {}\tTarget: {}\tPrediction: {}".format(msg.key(), round(data.target, 2), prediction))
                 if prediction != data.target:
@@ -180,12 +204,59 @@ def update_prediction(request_id, target, prediction):
     producer.flush()
 
 
+def drift_reporter(args):
+    # Drift scores go to local metric files and, as JSON, to their own topic
+    metrics = BruceLocalLogger(save_dir=args.log_dir, name='drift')
+    producer = SerializingProducer({'bootstrap.servers': args.bootstrap_servers,
+                                    'key.serializer': StringSerializer('utf_8'),
+                                    'value.serializer': StringSerializer('utf_8')})
+
+    def report(scores):
+        metrics.log_metrics({k: v for k, v in scores.items() if k.startswith('drift/')}, step=scores['window'])
+        producer.produce(topic=args.drift_topic, key=str(scores['window']), value=json.dumps(scores))
+        producer.poll(0.0)
+
+    return report
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', dest='bootstrap_servers', default='localhost:9092', type=str, help='Kafka Host')
     parser.add_argument('-s', dest="schema_registry", default='http://127.0.0.1:8081', help="Schema Registry")
     parser.add_argument('-t', dest="topic", default='pig-push-data', help="Topic name")
     parser.add_argument('-g', dest="group", default="data-consuming1", help="Consumer group")
+    parser.add_argument('-p', dest="precision", default='fp32', help="fp32 or bf16")
+    parser.add_argument('-m', dest="model", default='./model_checkpoint/LSTM.ckpt',
+                        help="Checkpoint path or registry reference (name, name:version, digest)")
+    parser.add_argument('-r', dest="registry", default='./model_registry', help="Model registry folder")
+    parser.add_argument('-c', dest="gate", default=None,
+                        help="Gate checkpoint (cascade.py), no cascade if not given. Thickness is 0 when cls < 0.5")
+    parser.add_argument('--drift', default=None, help="Drift reference, the one of the model by default")
+    parser.add_argument('--drift_window', default=5000, type=int, help="Frames per drift window")
+    parser.add_argument('--drift_topic', default='pig-drift', help="Topic of the drift reports")
+    parser.add_argument('--log_dir', default='./logs', help="Folder of the drift metrics")
+    parser.add_argument('-o', dest="optimize", action='store_true', help="Fold BatchNorm, strip Dropout (verified)")
+    parser.add_argument('--online', action='store_true', help="Fine-tune the model on the labeled stream")
+    parser.add_argument('--online_dir', default='./model_checkpoint/online', help="Promoted online checkpoints")
+    parser.add_argument('--online_busy', default=0.25, type=float, help="Max fraction of time spent training")
     args = parser.parse_args()
+    if args.gate is not None:
+        gate = BruceGateModel.load_from_checkpoint(args.gate).eval()
+    # Registry models are memory-mapped, predictors on one host share the weight pages
+    model = load_inference_model(args.model, args.registry)
+    if args.optimize and not args.online:
+        # The online learner fine-tunes a copy of the model, it needs the trainable layout
+        model = optimize_for_inference(model)
+    if args.online:
+        learner = BruceOnlineLearner(model, max_busy=args.online_busy, save_dir=args.online_dir).start()
+    precision = resolve_precision(args.precision, model.hparams.backbone)
+
+    # <checkpoint>.drift.npz, or the copy stored with the registry object
+    reference_path = args.drift or getattr(model, 'drift_reference', None)
+    if reference_path is None or not os.path.exists(reference_path):
+        logging.getLogger('model').warning(f'No drift reference for {args.model}, drift monitoring is off')
+    else:
+        drift_monitor = DriftMonitor(ChannelSketch.load(reference_path), window=args.drift_window,
+                                     on_report=drift_reporter(args))
 
     consuming(args)
@@ -0,0 +1,93 @@
+import os, logging, argparse, numpy as np, pandas as pd
+import torch
+import pytorch_lightning as pl
+
+from model import BruceModel
+from model.pruning import pareto_front, prune_model
+from train import get_data
+from utils.loader import get_batch_loader
+from utils.profiling import measure_latency
+from utils.scoring import BruceScorer
+from utils.stats import stats_path
+
+
+logger = logging.getLogger('model')
+
+
+def evaluate(model, inputs, dt_labels, threshold=0.5):
+    out = BruceScorer(model, threshold).score(inputs)
+    return float(np.abs(out['final_predicts'] - np.asarray(dt_labels, dtype=np.float32).reshape(-1)).mean())
+
+
+def fine_tune(model, train_loader, max_steps, lr):
+    # Short recovery training of the pruned model, no scheduler, no validation, no checkpointing
+    model.lr, model.scheduler = lr, False
+    trainer = pl.Trainer(logger=False, enable_checkpointing=False, max_steps=max_steps, enable_progress_bar=False,
+                         enable_model_summary=False)
+    trainer.fit(model, train_loader)
+    return trainer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--checkpoint', required=True, type=str, help='Trained model checkpoint')
+    parser.add_argument('--sparsities', default='0.25,0.5,0.75,0.9', type=str, help='Fractions of units removed')
+    parser.add_argument('--no_conv', action='store_true', help='Only prune the intermediate layer')
+    parser.add_argument('--finetune_steps', default=2000, type=int, help='Fine-tuning steps after pruning')
+    parser.add_argument('--lr', default=1e-4, type=float, help='Fine-tuning learning rate')
+    parser.add_argument('--batch_size', default=128, type=int, help='Fine-tuning batch size')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
+    parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path')
+    parser.add_argument('--no_sample', action='store_true', help='Use the full data')
+    parser.add_argument('--cache_dir', default=None, type=str, help='Memory-mapped cache of the preprocessed data')
+    parser.add_argument('--output_dir', default='./pruned', type=str, help='Pruned checkpoints and Pareto report')
+    parser.add_argument('--logging_level', default='INFO', type=str, help='Set logging level')
+    args = parser.parse_args()
+    args.sparsities = [float(s) for s in args.sparsities.split(',')]
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.logging_level)
+    torch.manual_seed(42)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    model = BruceModel.load_from_checkpoint(args.checkpoint)
+    stats = getattr(model, 'norm_stats', None)
+    MEAN, STD = (stats.mean, stats.std) if stats is not None else (None, None)
+    train_inputs, train_cls, train_dt, train_id, MEAN, STD = get_data(args.train_path, args.no_sample, MEAN=MEAN,
+                                                                      STD=STD, cache_dir=args.cache_dir)
+    val_inputs, _, val_dt, _, _, _ = get_data(args.val_path, args.no_sample, MEAN=MEAN, STD=STD,
+                                              cache_dir=args.cache_dir)
+    train_loader = get_batch_loader([torch.as_tensor(x, dtype=torch.float32) for x in
+                                     (train_inputs, train_cls, train_dt, train_id)],
+                                    batch_size=args.batch_size, shuffle=True)
+
+    name = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    rows = []
+    for sparsity in [0.] + args.sparsities:
+        if sparsity == 0:
+            pruned, path = model, args.checkpoint
+        else:
+            pruned = prune_model(model, sparsity, prune_conv=not args.no_conv)
+            trainer = fine_tune(pruned, train_loader, args.finetune_steps, args.lr)
+            # Smaller hparams (intermediate_size, output_channel) are in the checkpoint, it loads like any other
+            path = os.path.join(args.output_dir, f'{name}-sparsity{int(sparsity * 100):02d}.ckpt')
+            trainer.save_checkpoint(path, weights_only=True)
+            if stats is not None:
+                stats.save(stats_path(path))
+
+        row = {'sparsity': sparsity, 'checkpoint': path, 'num_params': sum(p.numel() for p in pruned.parameters()),
+               'intermediate_size': pruned.intermediate_layer[0].out_features,
+               'output_channel': str(pruned.hparams.get('output_channel')),
+               'val_mae': evaluate(pruned, val_inputs, val_dt)}
+        row.update(measure_latency(pruned, val_inputs.shape[1]))
+        logger.info(row)
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    report['pareto'] = pareto_front(list(zip(report['latency_ms_b1'], report['val_mae'])))
+    report.to_csv(os.path.join(args.output_dir, f'{name}-pareto.csv'), index=False)
+    print(report[['sparsity', 'num_params', 'latency_ms_b1', 'latency_ms_b128', 'val_mae', 'pareto']]
+          .to_string(index=False))
@@ -1,6 +1,8 @@
-import numpy as np
+import h5py, numpy as np
 import pandas as pd, uuid, json, datetime, time, argparse, os, platform
 from train import get_data
+from utils.preprocessing import get_pipeline
+from utils.stats import NormStats, load_stats
 from ctypes import *
 
 if platform.system() == 'Windows':
@@ -37,24 +39,30 @@ def process_data(path, MEAN=None, STD=None):
         files = os.listdir(path + folder + '/ect_1/data1/2022/2022-11/2022-11-17')
         for f in files:
             df = pd.read_csv(path + folder + '/ect_1/data1/2022/2022-11/2022-11-17/' + f, sep='\t', index_col=0, header=None)
-            inputs.append(df.iloc[:, :600].values)
+            inputs.append(df.iloc[:, :600].values.astype(np.float32))
 
-    inputs = np.vstack(inputs)
-    inputs[inputs > 1] = 0
+    # Clip saturated readings, standardize and flip the sign in place
+    inputs, MEAN, STD = get_pipeline('ect-raw-csv').fit_transform(np.vstack(inputs), MEAN, STD)
+    labels = np.zeros(inputs.shape[0], dtype=np.int64)
 
-    if MEAN is None:
-        MEAN = inputs.mean()
-        STD = inputs.std()
+    return inputs, labels
 
-    inputs = (inputs - MEAN)/STD
-    labels = np.array([0] * inputs.shape[0])
 
-    return -inputs, labels
+# Stats of train_new.h5, only used for models trained before the stats were saved with the checkpoint
+LEGACY_STATS = NormStats(-0.5485341293039697, 0.901363162490852, pipeline='ipig-h5', source='train_new.h5')
 
 
 def producing(args):
-    MEAN = -0.5485341293039697
-    STD = 0.901363162490852
+    norm_stats = load_stats(args.checkpoint)
+    if norm_stats is None:
+        print(f'No normalization stats for {args.checkpoint}, using the train_new.h5 values')
+        norm_stats = LEGACY_STATS
+    MEAN, STD = norm_stats.mean, norm_stats.std
+
+    # Raw frames must look like the training data
+    with h5py.File(args.path, 'r') as f:
+        norm_stats.check(f['inputs'][:10000])
+
     train_inputs, train_cls_label, train_deposit_thickness, train_inner_diameter, _, _ = get_data(args.path,
                                                                                                   True,
                                                                                                   True,
@@ -141,6 +149,7 @@ if __name__ == '__main__':
     parser.add_argument('-s', dest="schema_registry", default='http://127.0.0.1:8081', help="Schema Registry")
     parser.add_argument('-t', dest="topic", default='pig-push-data', help="Topic name")
     parser.add_argument('-f', dest="path", default='val_new.h5', help="Topic name")
+    parser.add_argument('-m', dest="checkpoint", default='./model_checkpoint/LSTM.ckpt', help="Served model checkpoint")
     # parser.add_argument('-f', dest="path",
     #                     default=r'C:\Users\BruceNguyen\Documents\Github\rocsole_dili\data\pipe_2mm_oil\\',
     #                     help="Topic name")
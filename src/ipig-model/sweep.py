@@ -0,0 +1,178 @@
+import os, json, time, random, logging, argparse, itertools, multiprocessing as mp, numpy as np, pandas as pd
+import torch
+import pytorch_lightning as pl
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from model import BruceModel
+from train import get_args as get_train_args, get_data
+from utils.loader import get_batch_loader
+from utils.profiling import measure_latency
+
+
+logger = logging.getLogger('model')
+
+# Validation metrics of the leaderboard (last epoch, best epoch for val/rgs_loss), higher is better for HIGHER_BETTER
+METRICS = ('val/rgs_loss', 'val/cls_loss', 'val/mae', 'val/auroc', 'val/accuracy')
+HIGHER_BETTER = ('val/auroc', 'val/accuracy')
+
+# Hyperparameters taken as list of ints by train.py
+LIST_PARAMS = ('kernel_size', 'output_channel')
+
+
+class MedianPruning(pl.Callback):
+    """
+    Median stopping rule on the val/rgs_loss curves of all trials: after `warmup` epochs a trial stops when its best
+    loss so far is worse than the median best loss of the other trials at the same epoch.
+    """
+
+    def __init__(self, trial_id, curves, monitor='val/rgs_loss', warmup=1, min_trials=3):
+        super().__init__()
+        self.trial_id = trial_id
+        self.curves = curves
+        self.monitor = monitor
+        self.warmup = warmup
+        self.min_trials = min_trials
+        self.pruned = False
+        self.history = []
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking or self.monitor not in trainer.callback_metrics:
+            return
+        self.history.append(float(trainer.callback_metrics[self.monitor]))
+        self.curves[self.trial_id] = list(self.history)
+
+        epoch = len(self.history) - 1
+        others = [min(c[:epoch + 1]) for k, c in self.curves.items() if k != self.trial_id and len(c) > epoch]
+        if epoch >= self.warmup and len(others) + 1 >= self.min_trials and min(self.history) > np.median(others):
+            self.pruned = True
+            trainer.should_stop = True
+
+
+def sample_space(space, num_trials, seed=42):
+    # Lists are choices, {"low", "high", "log"} dicts are continuous ranges. Full grid when num_trials is None
+    if num_trials is None:
+        assert all(isinstance(v, list) for v in space.values()), 'Grid search needs lists of choices only'
+        keys = list(space)
+        return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = {}
+        for k, v in space.items():
+            if isinstance(v, list):
+                trial[k] = rng.choice(v)
+            elif v.get('log'):
+                trial[k] = float(np.exp(rng.uniform(np.log(v['low']), np.log(v['high']))))
+            else:
+                trial[k] = rng.uniform(v['low'], v['high'])
+        trials.append(trial)
+    return trials
+
+
+def get_hparams(overrides, base_argv):
+    hparams = get_train_args(base_argv).__dict__
+    hparams.update(overrides)
+    for k in LIST_PARAMS:
+        if not isinstance(hparams[k], list):
+            hparams[k] = [hparams[k]]
+        # One kernel size / channel per CNN layer, repeat the last one if the space has shorter lists
+        hparams[k] = hparams[k] + hparams[k][-1:] * (hparams['num_cnn'] - len(hparams[k]))
+    return hparams
+
+
+def run_trial(trial_id, overrides, args, curves, num_threads):
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(args.seed)
+    hparams = get_hparams(overrides, args.base_args)
+
+    # Cache hits: every trial maps the same preprocessed files
+    train_inputs, train_cls, train_dt, train_id, MEAN, STD = get_data(args.train_path, args.no_sample,
+                                                                      cache_dir=args.cache_dir)
+    val_inputs, val_cls, val_dt, val_id, _, _ = get_data(args.val_path, args.no_sample, MEAN=MEAN, STD=STD,
+                                                         cache_dir=args.cache_dir)
+    as_tensors = lambda *xs: [torch.as_tensor(x, dtype=torch.float32) for x in xs]
+    train_loader = get_batch_loader(as_tensors(train_inputs, train_cls, train_dt, train_id),
+                                    batch_size=hparams['batch_size'], shuffle=True)
+    val_loader = get_batch_loader(as_tensors(val_inputs, val_cls, val_dt, val_id),
+                                  batch_size=hparams['batch_size'], shuffle=False)
+    hparams['total_training_step'] = len(train_loader) * args.num_epoch
+
+    model = BruceModel(**hparams)
+    pruning = MedianPruning(trial_id, curves, warmup=args.prune_warmup)
+    trainer = pl.Trainer(logger=False, enable_checkpointing=False, callbacks=[pruning], max_epochs=args.num_epoch,
+                         limit_train_batches=args.limit_train_batches, enable_progress_bar=False,
+                         enable_model_summary=False)
+    t0 = time.perf_counter()
+    trainer.fit(model, train_loader, val_loader)
+    train_time = time.perf_counter() - t0
+
+    result = {'trial': trial_id, **{k: json.dumps(v) if isinstance(v, list) else v for k, v in overrides.items()},
+              'val/rgs_loss': min(pruning.history) if pruning.history else float('nan'),
+              **{k: float(trainer.callback_metrics.get(k, float('nan'))) for k in METRICS if k != 'val/rgs_loss'},
+              'epochs': len(pruning.history), 'pruned': pruning.pruned, 'train_time_s': train_time,
+              'num_params': sum(p.numel() for p in model.parameters())}
+    result.update(measure_latency(model, val_inputs.shape[1]))
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--space', required=True, type=str, help='Search space, JSON file or inline JSON')
+    parser.add_argument('--num_trials', default=None, type=int, help='Random trials, full grid if not given')
+    parser.add_argument('--num_workers', default=max(1, (os.cpu_count() or 1) // 4), type=int,
+                        help='Concurrent trials')
+    parser.add_argument('--num_epoch', default=5, type=int, help='Epochs per trial')
+    parser.add_argument('--limit_train_batches', default=1.0, type=float, help='Fraction of train batches per epoch')
+    parser.add_argument('--prune_warmup', default=1, type=int, help='Epochs before a trial can be pruned')
+    parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
+    parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path')
+    parser.add_argument('--no_sample', action='store_true', help='Use the full data')
+    parser.add_argument('--cache_dir', default='./data_cache', type=str, help='Shared preprocessed data cache')
+    parser.add_argument('--base_args', default='', type=str, help='Extra train.py arguments for every trial')
+    parser.add_argument('--sort_by', default='val/rgs_loss', type=str, choices=METRICS,
+                        help='Leaderboard metric, pruned trials are listed last')
+    parser.add_argument('--output', default='./sweeps/leaderboard.csv', type=str, help='Leaderboard path')
+    parser.add_argument('--seed', default=42, type=int, help='Random seed')
+    parser.add_argument('--logging_level', default='INFO', type=str, help='Set logging level')
+    args = parser.parse_args()
+    args.base_args = args.base_args.split()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.logging_level)
+
+    space = json.load(open(args.space)) if os.path.exists(args.space) else json.loads(args.space)
+    trials = sample_space(space, args.num_trials, args.seed)
+    logger.info(f'{len(trials)} trials, {args.num_workers} at a time')
+
+    # Build the memory-mapped cache once before the workers start
+    _, _, _, _, MEAN, STD = get_data(args.train_path, args.no_sample, cache_dir=args.cache_dir)
+    get_data(args.val_path, args.no_sample, MEAN=MEAN, STD=STD, cache_dir=args.cache_dir)
+
+    num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+    ctx = mp.get_context('spawn')
+    results = []
+    with ctx.Manager() as manager, ProcessPoolExecutor(args.num_workers, mp_context=ctx) as pool:
+        curves = manager.dict()
+        futures = {pool.submit(run_trial, i, t, args, curves, num_threads): i for i, t in enumerate(trials)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception(f'Trial {futures[future]} failed')
+                continue
+            logger.info(result)
+            results.append(result)
+
+    if not results:
+        logger.error(f'All {len(trials)} trials failed, see the errors above')
+        raise SystemExit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    leaderboard = pd.DataFrame(results).sort_values(['pruned', args.sort_by],
+                                                    ascending=[True, args.sort_by not in HIGHER_BETTER])
+    leaderboard.to_csv(args.output, index=False)
+    print(leaderboard.to_string(index=False))
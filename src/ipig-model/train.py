@@ -1,4 +1,4 @@
-import h5py, logging, argparse, getpass, pandas as pd, numpy as np
+import h5py, logging, argparse, getpass, itertools, json, os, pandas as pd, numpy as np
 import matplotlib.pyplot as plt
 import torch, torchmetrics
 import torch.nn as nn
@@ -8,9 +8,22 @@ import wandb
 
 from torch.utils.data import DataLoader, Dataset, TensorDataset
 from model import BruceModel
+from model.distill import TEACHER_KEYS, BruceDistillModel, compute_teacher_outputs, distillation_report
+from utils.h5_dataset import H5_KEYS, BruceH5IterableDataset, compute_h5_stats, h5_stop
+from utils.cache import BruceDataCache, file_digest
+from utils.preprocessing import get_pipeline
+from utils.loader import get_batch_loader
+from utils.sequence import BruceSequenceDataset
+from utils.precision import resolve_precision, trainer_precision
+from utils.callbacks import GradientStatsMonitor, ThroughputMonitor
+from utils.local_logger import BruceLocalLogger
+from utils.scoring import BruceScorer, read_columns
+from utils.stats import NormStats, stats_path
+from utils.registry import load_inference_model
+from utils.drift import build_reference, drift_path
+from utils.autotune import autotune
 from sklearn.model_selection import train_test_split
 from pytorch_lightning.loggers import WandbLogger
-from pytorch_lightning.profiler import AdvancedProfiler
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping, LearningRateMonitor
 from datetime import datetime
 from weakref import ReferenceType
@@ -21,7 +34,8 @@ EPOCH = 100
 SCHEDULER_EPOCH = 20
 SCHEDULER_RATE = 0.9
 CLASS_W = [{0: 0.85, 1: 0.15}, None]
-DATETIME_NOW = datetime.now().strftime('%Y%m%d_%H%M')
+# DDP re-launches this script for every local rank, they must agree on the run name
+DATETIME_NOW = os.environ.setdefault('BRUCE_RUN_TIME', datetime.now().strftime('%Y%m%d_%H%M'))
 
 
 class ParseAction(argparse.Action):
@@ -31,24 +45,8 @@ class ParseAction(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
-class BruceDataset(Dataset):
-    def __init__(self, inputs, cls_labels=None, rgs_labels=None, seq_len=32):
-        super().__init__()
-        self.inputs = inputs
-        self.cls_labels = cls_labels
-        self.rgs_labels = rgs_labels
-        self.seq_len = seq_len
-
-    def __len__(self):
-        return self.inputs.shape[0] - self.seq_len
-
-    def __getitem__(self, idx):
-        if self.cls_labels is None:
-            return torch.tensor(self.inputs[idx: idx + self.seq_len])
-        else:
-            return torch.tensor(self.inputs[idx: idx + self.seq_len]), \
-                   torch.tensor(self.cls_labels[idx: idx + self.seq_len]), \
-                   torch.tensor(self.rgs_labels[idx: idx + self.seq_len])
+# Sliding windows are strided views over one buffer, kept under the old name
+BruceDataset = BruceSequenceDataset
 
 
 class BruceModelCheckpoint(ModelCheckpoint):
@@ -58,7 +56,12 @@ class BruceModelCheckpoint(ModelCheckpoint):
 
     def _update_best_and_save(self, current, trainer: pl.Trainer, monitor_candidates):
         super(BruceModelCheckpoint, self)._update_best_and_save(current, trainer, monitor_candidates)
-        trainer.model.save_df(trainer.logger, trainer.current_epoch)
+        trainer.lightning_module.save_df(trainer.logger, trainer.current_epoch)
+
+        # Stats sidecar next to the best checkpoint, consumers read it without loading the weights
+        norm_stats = getattr(trainer.lightning_module, 'norm_stats', None)
+        if norm_stats is not None and trainer.is_global_zero and self.best_model_path:
+            norm_stats.save(stats_path(self.best_model_path))
 
 
 def preprocessing_data(arr, MEAN, STD, normalize=True):
@@ -67,20 +70,44 @@ def preprocessing_data(arr, MEAN, STD, normalize=True):
     #     return (arr - arr.min()) / (arr.max() - arr.min())
     # else:
 
-    # Data standardization
-    if MEAN is None:
-        MEAN = arr[arr != 0].mean()
-        STD = arr[arr != 0].std()
-    # return (arr - MEAN) / STD, MEAN, STD
+    # Data standardization of non-zero readings, in place and chunk-wise in float32
+    return get_pipeline('ipig-h5').fit_transform(arr, MEAN, STD)
+
+
+def get_cached_data(path, no_sample, MEAN=None, STD=None, cache_dir='./data_cache', chunk_rows=65536):
+    # Standardized float32 arrays materialized once, later runs and DataLoader workers share the mapped pages
+    cache = BruceDataCache(cache_dir)
+    stop = h5_stop(path, no_sample)
+    key = cache.key(path, 'ipig-h5', slice=[0, stop], mean=MEAN, std=STD)
+
+    def specs():
+        with h5py.File(path, 'r') as f:
+            return {name: ((stop,) + f[name].shape[1:], np.float32) for name in H5_KEYS}
 
-    arr[arr != 0] = (arr[arr != 0] - MEAN) / STD
-    return arr, MEAN, STD
+    def fill(writers):
+        mean, std = (MEAN, STD) if MEAN is not None else compute_h5_stats(path, stop, chunk_rows)
+        with h5py.File(path, 'r') as f:
+            for start in range(0, stop, chunk_rows):
+                end = min(start + chunk_rows, stop)
+                inputs = f['inputs'][start:end].astype(np.float32)
+                inputs, _, _ = preprocessing_data(inputs, mean, std)
+                writers['inputs'][start:end] = inputs
+                writers['cls_label'][start:end] = f['cls_label'][start:end]
+                writers['deposit_thickness'][start:end] = f['deposit_thickness'][start:end] / 10
+                writers['inner_diameter'][start:end] = f['inner_diameter'][start:end]
+        return {'MEAN': mean, 'STD': std}
 
+    arrays, meta = cache.load_or_build(key, specs, fill)
+    return arrays['inputs'], arrays['cls_label'], arrays['deposit_thickness'].reshape(-1), \
+           arrays['inner_diameter'], meta['MEAN'], meta['STD']
 
-def get_data(path, no_sample, normalize=True, MEAN=None, STD=None):
+
+def get_data(path, no_sample, normalize=True, MEAN=None, STD=None, cache_dir=None):
     file_type = path[-2:]
 
-    if file_type == 'h5':
+    if file_type == 'h5' and cache_dir is not None:
+        return get_cached_data(path, no_sample, MEAN, STD, cache_dir)
+    elif file_type == 'h5':
         f = h5py.File(path, 'r')
         idx = -1 if no_sample else 10000
 
@@ -100,13 +127,17 @@ def get_data(path, no_sample, normalize=True, MEAN=None, STD=None):
     return inputs, cls_label, deposit_thickness.flatten(), inner_diameter, MEAN, STD
 
 
-def get_args():
+def get_args(argv=None):
     model_parser = argparse.ArgumentParser()
 
     # ENVIRONMENT ARGUMENTS
     model_parser.add_argument('--train_path', default='train_new.h5', type=str, help='Train data path')
     model_parser.add_argument('--val_path', default='val_new.h5', type=str, help='Validation data path')
     model_parser.add_argument('--no_sample', action='store_true', help='Sample to test data and model')
+    model_parser.add_argument('--stream', action='store_true', help='Stream HDF5 chunks instead of loading data in RAM')
+    model_parser.add_argument('--buffer_size', default=65536, type=int, help='Rows kept in the shuffle buffer when streaming')
+    model_parser.add_argument('--num_workers', default=0, type=int, help='Number of DataLoader workers')
+    model_parser.add_argument('--cache_dir', default=None, type=str, help='Memory-mapped cache of the preprocessed data')
 
     # MODEL ARGUMENTS
     model_parser.add_argument('--rgs_loss', default='mape', type=str, help="Regression loss, default is MAE")
@@ -120,8 +151,16 @@ def get_args():
     model_parser.add_argument('-sl', '--seq_len', default=32, type=int, help='Sequence len')
     model_parser.add_argument('-co', '--core_out', default=256, type=int, help='Core output channel')
     model_parser.add_argument('--act', default='tanh', type=str, help='Activation of intermediate layer')
+    model_parser.add_argument('--intermediate_size', default=None, type=int,
+                              help='Width of the intermediate layer, core_out * 4 by default')
     model_parser.add_argument('--initializer_range', default=0.02, type=float, help='Initializer range')
 
+    ## Distillation args, the student is the model described by the other arguments
+    model_parser.add_argument('--teacher', default=None, type=str,
+                              help='Teacher checkpoint or registry reference, enables distillation')
+    model_parser.add_argument('--distill_alpha', default=0.5, type=float, help='Weight of the teacher (soft) loss')
+    model_parser.add_argument('--distill_temperature', default=2.0, type=float, help='Temperature of the cls logits')
+
     ## CNN args
     model_parser.add_argument('-nc', '--num_cnn', default=1, type=int, help='Number of CNN Layer')
     model_parser.add_argument('-ks', '--kernel_size', default=[3], action=ParseAction,
@@ -142,34 +181,44 @@ def get_args():
     model_parser.add_argument('--lr', default=1e-4, type=float, help='Learning rate')
     model_parser.add_argument('--find_lr', action='store_true', help='Find best learning rate')
     model_parser.add_argument('--batch_size', default=128, type=int, help='Batch size per device')
+    model_parser.add_argument('--drop_last', action='store_true', help='Drop the last incomplete training batch')
+    model_parser.add_argument('--pin_memory', action='store_true', help='Gather batches into pinned buffers')
+    model_parser.add_argument('--auto_tune', action='store_true',
+                              help='Probe batch size, DataLoader workers and threads, keep the fastest (single process only)')
+    model_parser.add_argument('--auto_tune_steps', default=20, type=int, help='Timed training steps per probe')
+    model_parser.add_argument('--memory_budget_mb', default=None, type=float,
+                              help='Memory allowed to the tuned configuration, 75%% of the available memory by default')
     model_parser.add_argument('--log_step', default=100, type=int, help='Steps per log')
+    model_parser.add_argument('--profile', action='store_true', help='Profile a few training steps and stop')
+    model_parser.add_argument('--profile_steps', default=100, type=int, help='Number of profiled steps')
+    model_parser.add_argument('--profile_dir', default='./profile', type=str, help='Profiling report and trace folder')
+    model_parser.add_argument('--logger', default='wandb', type=str, help='wandb or local (offline binary files)')
+    model_parser.add_argument('--log_dir', default='./logs', type=str, help='Folder of the local logger')
+    model_parser.add_argument('--log_flush_every', default=1000, type=int, help='Metric records buffered before a write')
+    model_parser.add_argument('--grad_log_every', default=500, type=int,
+                              help='Steps between gradient/parameter histograms, 0 to disable')
     model_parser.add_argument('--gpu', default=0, type=int, help='Use GPUs')
+    model_parser.add_argument('--precision', default='fp32', type=str, help='fp32 or bf16 (CPU autocast, fp32 weights)')
+    model_parser.add_argument('--force_bf16', action='store_true', help='Use bf16 even without native CPU support')
     model_parser.add_argument('--num_epoch', default=10, type=int, help='Number of epoch')
+    model_parser.add_argument('--predict_format', default='h5', type=str, help='Prediction file: h5 (columnar) or csv')
 
-    args = model_parser.parse_args()
-    return args
-
-
-def get_predict(model, dataloaders):
-    dt_trues, id_trues = [], []
-    dt_predicts, id_predicts = [], []
-    cls = []
+    ## Distributed CPU args, multi-node runs also need MASTER_ADDR, MASTER_PORT and NODE_RANK in the environment
+    model_parser.add_argument('--num_processes', default=1, type=int, help='Training processes per node (gloo DDP)')
+    model_parser.add_argument('--num_nodes', default=1, type=int, help='Number of nodes')
+    model_parser.add_argument('--scale_lr', action='store_true', help='Scale learning rate by the number of processes')
+    model_parser.add_argument('--baseline_throughput', default=None, type=float,
+                              help='Samples/sec of a single process, to log scaling efficiency')
 
-    for dataloader in dataloaders:
-        for batch in dataloader:
-            inputs, cls_labels, dt_labels, id_labels = batch
-            cls_out, dt_out, id_out = model(inputs)
-
-            dt_trues.extend(dt_labels.reshape(-1).tolist())
-            id_trues.extend(id_labels.reshape(-1).tolist())
-
-            cls.extend(torch.sigmoid(cls_out.reshape(-1)).tolist())
-            dt_predicts.extend(dt_out.reshape(-1).tolist())
-            id_predicts.extend(id_out.reshape(-1).tolist())
+    args = model_parser.parse_args(argv)
+    return args
 
-    final_predicts = (np.array(cls) >= 0.5) * np.array(dt_predicts)
 
-    return dt_trues, id_trues, cls, dt_predicts, id_predicts, final_predicts
+def get_predict(model, dataloaders, path, precision='fp32'):
+    # Batched inference streamed to a columnar file (.h5, or .csv), nothing accumulates in Python lists
+    scorer = BruceScorer(model, precision=precision)
+    batches = itertools.chain.from_iterable(dataloaders)
+    return scorer.score_to_file(batches, path, label_columns={'dt_trues': 2, 'id_trues': 3})
 
 
 if __name__ == '__main__':
@@ -180,49 +229,112 @@ if __name__ == '__main__':
     logger = logging.getLogger('model')
     logger.info(args.__dict__)
 
-    # Get data
-    train_inputs, train_cls_label, train_deposit_thickness, train_inner_diameter, MEAN, STD = get_data(args.train_path,
-                                                                                                       args.no_sample,
-                                                                                                       args.normalize)
-    val_inputs, val_cls_label, val_deposit_thickness, val_inner_diameter, _, _ = get_data(args.val_path,
-                                                                                          args.no_sample,
-                                                                                          args.normalize,
-                                                                                          MEAN,
-                                                                                          STD)
-
-    # Create Dataloader
-
-    train_dataset = TensorDataset(torch.FloatTensor(train_inputs),
-                                  torch.FloatTensor(train_cls_label),
-                                  torch.FloatTensor(train_deposit_thickness),
-                                  torch.FloatTensor(train_inner_diameter))
-    val_dataset = TensorDataset(torch.FloatTensor(val_inputs),
-                                torch.FloatTensor(val_cls_label),
-                                torch.FloatTensor(val_deposit_thickness),
-                                torch.FloatTensor(val_inner_diameter))
-    '''
-    train_dataset = BruceDataset(inputs=train_x, cls_labels=train_y_cls, rgs_labels=train_y_rgs)
-    '''
-
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False)
-
-    # Calculate training steps for learning rate scheduler
-    steps_per_epoch = int(train_inputs.shape[0] // args.batch_size + 1)
+    if args.stream and args.auto_tune:
+        logger.warning('--auto_tune probes the in-memory loaders, it is ignored with --stream')
+        args.auto_tune = False
+
+    if args.auto_tune and args.num_processes * args.num_nodes > 1:
+        # Every DDP rank would probe on its own (and slow the others down) and could pick a different batch size
+        raise ValueError('--auto_tune runs in a single process, tune with --num_processes 1 and pass the tuned '
+                         '--batch_size and --num_workers to the DDP run')
+
+    if args.stream and args.teacher is not None:
+        raise ValueError('Distillation caches the teacher outputs of the training set, it does not work with --stream')
+
+    if args.stream:
+        # Out-of-core data, memory is bounded by the shuffle buffer
+        train_stop, val_stop = h5_stop(args.train_path, args.no_sample), h5_stop(args.val_path, args.no_sample)
+        MEAN, STD = compute_h5_stats(args.train_path, train_stop)
+        train_dataset = BruceH5IterableDataset(args.train_path, MEAN, STD, batch_size=args.batch_size,
+                                               stop=train_stop, buffer_size=args.buffer_size, shuffle=True,
+                                               num_workers=args.num_workers)
+        val_dataset = BruceH5IterableDataset(args.val_path, MEAN, STD, batch_size=args.batch_size,
+                                             stop=val_stop, buffer_size=args.buffer_size, shuffle=False,
+                                             num_workers=args.num_workers)
+        num_train = train_stop
+
+        train_dataloader = DataLoader(train_dataset, batch_size=None, num_workers=args.num_workers,
+                                      persistent_workers=args.num_workers > 0)
+        val_dataloader = DataLoader(val_dataset, batch_size=None, num_workers=args.num_workers,
+                                    persistent_workers=args.num_workers > 0)
+    else:
+        # Get data
+        train_inputs, train_cls_label, train_deposit_thickness, train_inner_diameter, MEAN, STD = \
+            get_data(args.train_path, args.no_sample, args.normalize, cache_dir=args.cache_dir)
+        val_inputs, val_cls_label, val_deposit_thickness, val_inner_diameter, _, _ = \
+            get_data(args.val_path, args.no_sample, args.normalize, MEAN, STD, cache_dir=args.cache_dir)
+
+        # Create Dataloader, as_tensor does not copy float32 (memory-mapped) arrays
+        train_tensors = [torch.as_tensor(x, dtype=torch.float32) for x in
+                         (train_inputs, train_cls_label, train_deposit_thickness, train_inner_diameter)]
+        val_tensors = [torch.as_tensor(x, dtype=torch.float32) for x in
+                       (val_inputs, val_cls_label, val_deposit_thickness, val_inner_diameter)]
+        num_train = train_inputs.shape[0]
+
+        if args.teacher is not None:
+            # Teacher outputs are computed once (or read from the cache) and travel with the training batches
+            teacher = load_inference_model(args.teacher)
+            teacher_stats = getattr(teacher, 'norm_stats', None)
+            if teacher_stats is not None and not np.allclose([teacher_stats.mean, teacher_stats.std], [MEAN, STD]):
+                logger.warning(f'Teacher was trained with {teacher_stats}, the data is normalized with '
+                               f'mean={MEAN}, std={STD}')
+            cache, key = None, None
+            if args.cache_dir is not None:
+                cache = BruceDataCache(args.cache_dir)
+                teacher_id = getattr(teacher, 'model_digest', None) or file_digest(args.teacher, args.cache_dir)
+                key = cache.key(args.train_path, 'ipig-h5', teacher=teacher_id, slice=[0, num_train], mean=MEAN,
+                                std=STD)
+            teacher_outputs = compute_teacher_outputs(teacher, train_inputs, cache=cache, key=key)
+            train_tensors += [torch.as_tensor(teacher_outputs[k]) for k in TEACHER_KEYS]
+
+        if args.auto_tune:
+            # Probes train copies of a throwaway model, the RNG is restored so the real initialization does not change
+            rng_state = torch.random.get_rng_state()
+            model_class = BruceDistillModel if args.teacher is not None else BruceModel
+            tuned = autotune(model_class(**args.__dict__), train_tensors, steps=args.auto_tune_steps,
+                             memory_budget_mb=args.memory_budget_mb)
+            torch.random.set_rng_state(rng_state)
+            # Same warmup in samples, total_training_step is computed from the new batch size below
+            args.warming_step = int(args.warming_step * args.batch_size / tuned['batch_size'])
+            args.batch_size, args.num_workers = tuned['batch_size'], tuned['num_workers']
+            args.num_threads = tuned['num_threads']
+            logger.info(f'Auto-tuned: batch_size={args.batch_size}, num_workers={args.num_workers}, '
+                        f'num_threads={args.num_threads}, {tuned["samples_per_sec"]:.0f} samples/s, '
+                        f'{tuned["memory_mb"]:.0f} MB')
+
+        # Whole batches are gathered with one index_select per tensor instead of per-sample collation
+        train_dataloader = get_batch_loader(train_tensors, batch_size=args.batch_size, shuffle=True,
+                                            drop_last=args.drop_last, pin_memory=args.pin_memory,
+                                            num_workers=args.num_workers)
+        val_dataloader = get_batch_loader(val_tensors, batch_size=args.batch_size, shuffle=False,
+                                          pin_memory=args.pin_memory, num_workers=args.num_workers)
+
+    # Calculate training steps for learning rate scheduler, every process sees 1 / world_size of the data
+    world_size = args.num_processes * args.num_nodes
+    steps_per_epoch = int(num_train // (args.batch_size * world_size) + 1)
     args.total_training_step = steps_per_epoch * args.num_epoch
+    if args.scale_lr:
+        args.lr *= world_size
+
+    # bf16 only where the backbone and the CPU support it
+    args.precision = resolve_precision(args.precision, args.backbone, args.force_bf16)
 
     # Generate model
     MODEL_NAME = f'{args.backbone.upper()}-{DATETIME_NOW}_{getpass.getuser()}'
-    wandb_logger = WandbLogger(project='Rocsole_DILI_Bruce', name=MODEL_NAME, log_model=True, entity='duyduc1110')
-    model = BruceModel(**args.__dict__)
+    model = (BruceDistillModel if args.teacher is not None else BruceModel)(**args.__dict__)
+    model.norm_stats = NormStats(MEAN, STD, pipeline='ipig-h5', source=os.path.abspath(args.train_path),
+                                 num_frames=num_train)
     logger.info(model)
 
-    # Init Logger
-    wandb_logger.watch(model, log='all')
-    wandb_logger.experiment.log_code('.')
+    # Init Logger, gradient/parameter histograms are sampled by GradientStatsMonitor for both backends
+    if args.logger == 'wandb':
+        pl_logger = WandbLogger(project='Rocsole_DILI_Bruce', name=MODEL_NAME, log_model=True, entity='duyduc1110')
+        pl_logger.experiment.log_code('.')
+    else:
+        pl_logger = BruceLocalLogger(save_dir=args.log_dir, name=MODEL_NAME, flush_every=args.log_flush_every)
+    grad_monitor = GradientStatsMonitor(every_n_steps=args.grad_log_every)
 
     # Init Callbacks
-    profiler = AdvancedProfiler()
     lr_monitor = LearningRateMonitor(logging_interval='step')
     early_stop_callback = EarlyStopping(monitor='val/rgs_loss' if not args.cls_only else 'val/cls_loss',
                                         mode='min',
@@ -235,12 +347,28 @@ if __name__ == '__main__':
                                          save_top_k=1,
                                          verbose=False)
 
+    throughput_monitor = ThroughputMonitor(log_every=args.log_step, baseline=args.baseline_throughput)
+
+    # CPU data parallel: gloo process group, the loaders shard the data themselves
+    distributed = {}
+    if world_size > 1:
+        os.environ.setdefault('PL_TORCH_DISTRIBUTED_BACKEND', 'gloo')
+        distributed = dict(strategy='ddp', num_processes=args.num_processes, num_nodes=args.num_nodes,
+                           replace_sampler_ddp=False)
+
+    callbacks = [lr_monitor, early_stop_callback, model_checker, throughput_monitor, grad_monitor]
+    if args.profile:
+        # Fixed number of profiled steps, then the training stops
+        from utils.profiling import BruceProfilerCallback
+        callbacks.append(BruceProfilerCallback(output_dir=args.profile_dir, num_steps=args.profile_steps))
+
     # Init Pytorch Lightning Profiler
     trainer = pl.Trainer(
-        logger=wandb_logger,
-        callbacks=[lr_monitor, early_stop_callback, model_checker],
-        # profiler=profiler,
+        logger=pl_logger,
+        callbacks=callbacks,
         gpus=args.gpu,
+        **distributed,
+        precision=trainer_precision(args.precision),
         log_every_n_steps=args.log_step,
         max_epochs=args.num_epoch,
         deterministic=True,
@@ -259,14 +387,33 @@ if __name__ == '__main__':
 
     # Fit training data
     trainer.fit(model, train_dataloader, val_dataloader)
-    model.load_from_checkpoint(model_checker.best_model_path)  # load best model checkpoint
+    if args.profile:
+        raise SystemExit(0)
+    model = BruceModel.load_from_checkpoint(model_checker.best_model_path)  # load best model checkpoint
+
+    # Only one process writes predictions
+    if not trainer.is_global_zero:
+        raise SystemExit(0)
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        # The loaders shard while a process group exists, scoring must see all the train and validation frames
+        torch.distributed.destroy_process_group()
+
+    # Per-channel sketch of the training frames next to the checkpoint, serving compares its input windows with it
+    if args.train_path.endswith('h5'):
+        build_reference(args.train_path, model.norm_stats, num_train).save(drift_path(model_checker.best_model_path))
 
     # Store prediction from best model
-    dt_trues, id_trues, cls, dt_predicts, id_predicts, final_predicts = get_predict(model,
-                                                                                    (train_dataloader, val_dataloader))
-    df = pd.DataFrame(np.array([dt_trues, id_trues, cls, dt_predicts, id_predicts, final_predicts]).T,
-                      columns=['dt_trues', 'id_trues', 'cls', 'dt_predicts', 'id_predicts', 'final_predicts'])
-    df.to_csv(f'./predicts/{MODEL_NAME}.csv', index=False)
-
-    wandb.Table.MAX_ROWS = 1000000
-    wandb_logger.experiment.log({'predictions': wandb.Table(dataframe=df)})
+    predict_path = f'./predicts/{MODEL_NAME}.{args.predict_format}'
+    get_predict(model, (train_dataloader, val_dataloader), predict_path, args.precision)
+
+    if args.teacher is not None:
+        # Student against teacher on the validation set
+        report = distillation_report(teacher, model, val_inputs, val_deposit_thickness, val_cls_label)
+        logger.info(report)
+        pl_logger.log_metrics({f'distill/{k}': v for k, v in report.items()})
+        with open(f'./predicts/{MODEL_NAME}.distill.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.logger == 'wandb':
+        wandb.Table.MAX_ROWS = 1000000
+        pl_logger.experiment.log({'predictions': wandb.Table(dataframe=read_columns(predict_path))})
@@ -0,0 +1,112 @@
+import os, copy, time, logging, psutil
+import torch
+
+from utils.loader import get_batch_loader
+
+
+logger = logging.getLogger('model')
+
+BATCH_SIZES = (64, 128, 256, 512, 1024, 2048, 4096)
+NUM_WORKERS = (0, 1, 2, 4)
+
+
+def _rss_mb(proc):
+    # Main process and DataLoader workers, shared pages are counted once per process (an upper bound)
+    rss = proc.memory_info().rss
+    for child in proc.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 2 ** 20
+
+
+def _step_loss(model, batch):
+    # Same computation as the training_step of the model, without the logging (no trainer here)
+    if hasattr(model, 'distill_losses'):
+        return model.distill_losses(batch)[0]
+    inputs, cls_labels, dt_labels, id_labels = batch[:4]
+    cls_out, dt_out, id_out = model(inputs)
+    cls_out = torch.sigmoid(cls_out)
+    dt_out = dt_out * (cls_out >= 0.5)
+    return sum(model.loss(cls_out, dt_out, id_out, cls_labels, dt_labels, id_labels))
+
+
+def probe(model, tensors, batch_size, num_workers, num_threads, steps=20, warmup=3):
+    """
+    samples/sec of `steps` full training steps (forward, backward, AdamW) on a copy of the model, and the peak RSS
+    seen meanwhile.
+    """
+    torch.set_num_threads(num_threads)
+    model = copy.deepcopy(model).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loader = get_batch_loader(tensors, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=num_workers)
+    proc, peak, num_samples, t0 = psutil.Process(), 0., 0, None
+
+    it = iter(loader)
+    for i in range(warmup + steps):
+        if i == warmup:
+            num_samples, t0 = 0, time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            it = iter(loader)
+            batch = next(it)
+        loss = _step_loss(model, batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        num_samples += batch[0].shape[0]
+        peak = max(peak, _rss_mb(proc))
+    elapsed = time.perf_counter() - t0
+    del it, loader
+    return {'samples_per_sec': num_samples / elapsed, 'memory_mb': peak}
+
+
+def autotune(model, tensors, batch_sizes=BATCH_SIZES, num_workers=NUM_WORKERS, num_threads=None, steps=20, warmup=3,
+             memory_budget_mb=None, patience=0.05):
+    """
+    Coordinate search of the training configuration with the highest samples/sec within the memory budget (75% of the
+    available memory by default): batch size first (stops once the throughput falls `patience` below the best or the
+    budget is exceeded), then DataLoader workers, then intra-op threads. A few hundred steps in total.
+    Returns the best configuration, the probes are in its 'probes' entry. Intra-op threads are left at the best value.
+    """
+    cpu = os.cpu_count() or 1
+    num_threads = num_threads or sorted({max(1, cpu // 4), max(1, cpu // 2), cpu})
+    if memory_budget_mb is None:
+        memory_budget_mb = 0.75 * (psutil.virtual_memory().available + psutil.Process().memory_info().rss) / 2 ** 20
+    probes = []
+
+    def run(batch_size, workers, threads):
+        result = probe(model, tensors, batch_size, workers, threads, steps, warmup)
+        result.update(batch_size=batch_size, num_workers=workers, num_threads=threads,
+                      fits=result['memory_mb'] <= memory_budget_mb)
+        logger.info(f'Auto-tune probe {result}')
+        probes.append(result)
+        return result
+
+    def best():
+        fitting = [p for p in probes if p['fits']] or probes[:1]
+        return max(fitting, key=lambda p: p['samples_per_sec'])
+
+    threads = torch.get_num_threads()
+    for b in batch_sizes:
+        if b > tensors[0].shape[0]:
+            break
+        result = run(b, 0, threads)
+        if not result['fits'] or result['samples_per_sec'] < best()['samples_per_sec'] * (1 - patience):
+            break
+
+    batch_size = best()['batch_size']
+    for w in num_workers:
+        if w > 0:
+            run(batch_size, w, threads)
+
+    workers = best()['num_workers']
+    for t in num_threads:
+        if t != threads:
+            run(batch_size, workers, t)
+
+    chosen = dict(best(), probes=probes, memory_budget_mb=memory_budget_mb)
+    torch.set_num_threads(chosen['num_threads'])
+    return chosen
@@ -0,0 +1,105 @@
+import os, json, hashlib, shutil, uuid, numpy as np
+
+from utils.preprocessing import get_pipeline
+
+
+# Bump when the layout of the entries or the way get_data fills them changes, older entries are then ignored
+CACHE_VERSION = 2
+
+
+def file_digest(path, cache_dir=None, chunk_bytes=1 << 24):
+    # Hashing a multi-GB HDF5 file takes a while, remember the digest as long as size and mtime do not change
+    st = os.stat(path)
+    stamp = f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'
+    index_path = os.path.join(cache_dir, 'digests.json') if cache_dir else None
+
+    index = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if stamp in index:
+            return index[stamp]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_bytes), b''):
+            h.update(block)
+    digest = h.hexdigest()
+
+    if index_path:
+        index[stamp] = digest
+        tmp_path = f'{index_path}.{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return digest
+
+
+class BruceDataCache:
+    """
+    Preprocessed arrays materialized as .npy files and re-opened with np.load(mmap_mode=...).
+
+    An entry is keyed by the content hash of the source file, the preprocessing pipeline (its full configuration),
+    CACHE_VERSION and the other parameters (slice, stats, ...).
+    Entries are written in a temporary folder and renamed when complete, so concurrent runs never read half a cache.
+    """
+
+    def __init__(self, cache_dir='./data_cache', mmap_mode='c'):
+        self.cache_dir = cache_dir
+        # 'c' (copy-on-write) keeps the pages shared but lets torch.from_numpy wrap the arrays without a warning
+        self.mmap_mode = mmap_mode
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path, pipeline=None, **params):
+        payload = {'source': file_digest(path, self.cache_dir), 'version': CACHE_VERSION,
+                   'pipeline': repr(get_pipeline(pipeline)) if pipeline is not None else None, **params}
+        payload = json.dumps(payload, sort_keys=True, default=float)
+        return hashlib.sha1(payload.encode()).hexdigest()[:20]
+
+    def load(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None, None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode=self.mmap_mode)
+                  for name in meta['arrays']}
+        return arrays, meta
+
+    def build(self, key, specs, fill_fn, meta=None):
+        """
+        specs: {name: (shape, dtype)}, fill_fn(writers) fills the memory-mapped writers and can return extra meta.
+        """
+        tmp_dir = os.path.join(self.cache_dir, f'.{key}.{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        try:
+            writers = {name: np.lib.format.open_memmap(os.path.join(tmp_dir, f'{name}.npy'), mode='w+',
+                                                       dtype=dtype, shape=shape)
+                       for name, (shape, dtype) in specs.items()}
+            meta = dict(meta or {})
+            meta.update(fill_fn(writers) or {})
+            meta['arrays'] = list(specs)
+            for w in writers.values():
+                w.flush()
+            del writers
+
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f, default=float)
+            try:
+                os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+            except OSError:
+                # Another process finished the same entry first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        return self.load(key)
+
+    def load_or_build(self, key, specs_fn, fill_fn, meta=None):
+        arrays, meta_out = self.load(key)
+        if arrays is None:
+            arrays, meta_out = self.build(key, specs_fn(), fill_fn, meta)
+        return arrays, meta_out
@@ -0,0 +1,101 @@
+import time, logging, numpy as np, torch
+import pytorch_lightning as pl
+
+from utils.local_logger import log_histograms
+
+
+logger = logging.getLogger('model')
+
+
+class ThroughputMonitor(pl.Callback):
+    """
+    Logs global training samples/sec every `log_every` steps. With `baseline` (samples/sec of a single process)
+    it also logs the scaling efficiency: throughput / (world_size * baseline).
+    """
+
+    def __init__(self, log_every=100, baseline=None):
+        super().__init__()
+        self.log_every = log_every
+        self.baseline = baseline
+        self._samples, self._elapsed, self._t0 = 0, 0., None
+        self.history = []
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # Validation runs between epochs, a window never spans it
+        self._samples, self._t0 = 0, None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+        if self._t0 is None:
+            self._t0 = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        self._samples += batch[0].shape[0]
+        if (batch_idx + 1) % self.log_every:
+            return
+        # Wall time of the window, dataloader wait and Lightning overhead between the steps included. The next window
+        # starts now, so the wait for its first batch is counted too
+        now = time.perf_counter()
+        self._elapsed, self._t0 = now - self._t0, now
+
+        # Every rank measures its own shard, the global throughput is the sum
+        sps = torch.tensor(self._samples / max(self._elapsed, 1e-9))
+        sps = float(trainer.training_type_plugin.reduce(sps, reduce_op='sum'))
+        metrics = {'perf/samples_per_sec': sps}
+        if self.baseline:
+            metrics['perf/scaling_efficiency'] = sps / (trainer.world_size * self.baseline)
+        pl_module.log_dict(metrics, on_step=True, on_epoch=False, rank_zero_only=True)
+        self.history.append(metrics)
+        self._samples, self._elapsed = 0, 0.
+
+    def on_train_end(self, trainer, pl_module):
+        if trainer.is_global_zero and self.history:
+            mean_sps = sum(m['perf/samples_per_sec'] for m in self.history) / len(self.history)
+            message = f'Training throughput: {mean_sps:.0f} samples/sec over {trainer.world_size} process(es)'
+            if self.baseline:
+                message += f', scaling efficiency {mean_sps / (trainer.world_size * self.baseline):.2%}'
+            logger.info(message)
+
+
+class GradientStatsMonitor(pl.Callback):
+    """
+    Histograms and norms of gradients and parameters every `every_n_steps` steps. Histograms are computed on the
+    parameter's device with torch.histc, only the bin counts are copied back.
+    """
+
+    def __init__(self, every_n_steps=500, bins=32, log_params=True):
+        super().__init__()
+        self.every_n_steps = every_n_steps
+        self.bins = bins
+        self.log_params = log_params
+        self.overhead = 0.
+
+    def _histogram(self, t):
+        t = t.detach().float()
+        lo, hi = float(t.min()), float(t.max())
+        if lo == hi:
+            lo, hi = lo - 1e-12, hi + 1e-12
+        counts = torch.histc(t, bins=self.bins, min=lo, max=hi).cpu().numpy()
+        return counts, np.linspace(lo, hi, self.bins + 1)
+
+    def on_after_backward(self, trainer, pl_module):
+        step = trainer.global_step
+        if self.every_n_steps <= 0 or step % self.every_n_steps or not trainer.is_global_zero:
+            return
+
+        t0 = time.perf_counter()
+        histograms, norms = {}, {}
+        for name, p in pl_module.named_parameters():
+            if p.grad is not None:
+                histograms[f'gradients/{name}'] = self._histogram(p.grad)
+                norms[f'grad_norm/{name}'] = float(p.grad.detach().norm())
+            if self.log_params:
+                histograms[f'parameters/{name}'] = self._histogram(p)
+        # Only the computation, BruceLocalLogger already counts the time of its own log calls
+        elapsed = time.perf_counter() - t0
+        self.overhead += elapsed
+        if hasattr(trainer.logger, 'overhead'):
+            trainer.logger.overhead += elapsed
+
+        log_histograms(trainer.logger, histograms, step, trainer.current_epoch)
+        if trainer.logger is not None:
+            trainer.logger.log_metrics(norms, step)
@@ -0,0 +1,164 @@
+import os, h5py, logging, numpy as np
+
+from utils.preprocessing import get_pipeline
+
+
+logger = logging.getLogger('model')
+
+
+def drift_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + '.drift.npz'
+
+
+class ChannelSketch:
+    """
+    Per-channel streaming summary of normalized frames: count, sum and sum of squares of the non-zero readings, number
+    of zero readings (dead channels) and a fixed-bin histogram over [lo, hi) used as quantile sketch.
+    update() is a few vectorized numpy ops per frame, whatever the number of frames seen.
+    """
+
+    def __init__(self, num_channels, bins=32, lo=-5., hi=5.):
+        self.num_channels, self.bins, self.lo, self.hi = num_channels, bins, float(lo), float(hi)
+        self._offsets = np.arange(num_channels, dtype=np.int64) * bins
+        self.reset()
+
+    def reset(self):
+        c = self.num_channels
+        self.num_frames = 0
+        self.count = np.zeros(c, dtype=np.int64)
+        self.zeros = np.zeros(c, dtype=np.int64)
+        self.total = np.zeros(c, dtype=np.float64)
+        self.total_sq = np.zeros(c, dtype=np.float64)
+        self.hist = np.zeros(c * self.bins, dtype=np.int64)
+        return self
+
+    def update(self, frames):
+        x = np.atleast_2d(np.asarray(frames, dtype=np.float32))[:, :self.num_channels]
+        nz = x != 0
+        v = np.where(nz, x, 0).astype(np.float64)
+        self.num_frames += x.shape[0]
+        self.zeros += x.shape[0] - nz.sum(0)
+        self.count += nz.sum(0)
+        self.total += v.sum(0)
+        self.total_sq += (v * v).sum(0)
+
+        idx = np.clip(((x - self.lo) * (self.bins / (self.hi - self.lo))).astype(np.int64), 0, self.bins - 1)
+        idx = (idx + self._offsets)[nz]
+        if x.shape[0] == 1:
+            # One frame: every channel hits a different bin, the fancy increment is exact
+            self.hist[idx] += 1
+        else:
+            self.hist += np.bincount(idx, minlength=self.hist.size)
+        return self
+
+    def mean(self):
+        return self.total / np.maximum(self.count, 1)
+
+    def std(self):
+        return np.sqrt(np.maximum(self.total_sq / np.maximum(self.count, 1) - self.mean() ** 2, 0))
+
+    def zero_fraction(self):
+        return self.zeros / max(self.num_frames, 1)
+
+    def distribution(self):
+        hist = self.hist.reshape(self.num_channels, self.bins).astype(np.float64)
+        return hist / np.maximum(hist.sum(1, keepdims=True), 1)
+
+    def quantiles(self, qs=(0.05, 0.5, 0.95)):
+        # Upper bin edge where the cumulative distribution reaches q, (num_channels, len(qs))
+        cdf = np.cumsum(self.distribution(), 1)
+        edges = np.linspace(self.lo, self.hi, self.bins + 1)[1:]
+        return np.stack([edges[np.argmax(cdf >= q, 1)] for q in qs], 1)
+
+    def save(self, path):
+        np.savez(path, num_frames=self.num_frames, count=self.count, zeros=self.zeros, total=self.total,
+                 total_sq=self.total_sq, hist=self.hist, range=[self.bins, self.lo, self.hi])
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        bins, lo, hi = data['range']
+        sketch = cls(data['count'].shape[0], int(bins), lo, hi)
+        for k in ('count', 'zeros', 'total', 'total_sq', 'hist'):
+            setattr(sketch, k, data[k])
+        sketch.num_frames = int(data['num_frames'])
+        return sketch
+
+
+def build_reference(path, norm_stats, stop=None, num_channels=600, chunk_rows=65536, **sketch_kwargs):
+    # Sketch of the normalized training frames, the reference the serving windows are compared with
+    pipeline = get_pipeline(norm_stats.pipeline)
+    with h5py.File(path, 'r') as f:
+        dset = f['inputs']
+        stop = dset.shape[0] if stop is None else stop
+        sketch = ChannelSketch(min(num_channels, dset.shape[1]), **sketch_kwargs)
+        for start in range(0, stop, chunk_rows):
+            chunk = dset[start: min(start + chunk_rows, stop)]
+            sketch.update(pipeline.transform(chunk, norm_stats.mean, norm_stats.std))
+    return sketch
+
+
+def drift_scores(window, reference, eps=1e-4):
+    """
+    Per-channel drift of a window against the reference: mean shift in reference std, |log std ratio|, change of the
+    fraction of zero readings and population stability index (PSI) of the histograms. Summarized over channels.
+    """
+    ref_std = np.maximum(reference.std(), eps)
+    shift = np.abs(window.mean() - reference.mean()) / ref_std
+    spread = np.abs(np.log(np.maximum(window.std(), eps) / ref_std))
+    zeros = np.abs(window.zero_fraction() - reference.zero_fraction())
+    p, q = window.distribution() + eps, reference.distribution() + eps
+    psi = ((p - q) * np.log(p / q)).sum(1)
+
+    # Channels that are dead in both are not informative
+    live = (window.count > 0) | (reference.count > 0)
+    shift, spread, psi = shift[live], spread[live], psi[live]
+    return {'drift/mean_shift_max': float(shift.max(initial=0)), 'drift/mean_shift_mean': float(shift.mean()),
+            'drift/std_log_ratio_max': float(spread.max(initial=0)), 'drift/zero_fraction_max': float(zeros.max()),
+            'drift/psi_max': float(psi.max(initial=0)), 'drift/psi_mean': float(psi.mean()),
+            'drift/worst_channel': int(np.flatnonzero(live)[np.argmax(psi)]) if psi.size else -1,
+            'psi': psi}
+
+
+class DriftMonitor:
+    """
+    Sketches the served frames in tumbling windows of `window` frames and compares every full window with the
+    training reference. on_report(report) receives the summary scores and an `alert` flag, raised when more than
+    `alert_channels` of the channels have PSI > psi_threshold, or any channel mean moved by more than shift_threshold
+    reference std, or the zero fraction of a channel changed by more than zero_threshold.
+    """
+
+    def __init__(self, reference, window=5000, psi_threshold=0.2, shift_threshold=3., zero_threshold=0.2,
+                 alert_channels=0.05, on_report=None):
+        self.reference = reference
+        self.sketch = ChannelSketch(reference.num_channels, reference.bins, reference.lo, reference.hi)
+        self.window = window
+        self.psi_threshold = psi_threshold
+        self.shift_threshold = shift_threshold
+        self.zero_threshold = zero_threshold
+        self.alert_channels = alert_channels
+        self.on_report = on_report
+        self.num_windows = 0
+
+    def update(self, frame):
+        self.sketch.update(frame)
+        if self.sketch.num_frames >= self.window:
+            report = self.check()
+            self.sketch.reset()
+            return report
+        return None
+
+    def check(self):
+        scores = drift_scores(self.sketch, self.reference)
+        psi = scores.pop('psi')
+        scores['drift/psi_channels'] = float((psi > self.psi_threshold).mean()) if psi.size else 0.
+        scores['drift/alert'] = int(scores['drift/psi_channels'] > self.alert_channels
+                                    or scores['drift/mean_shift_max'] > self.shift_threshold
+                                    or scores['drift/zero_fraction_max'] > self.zero_threshold)
+        scores['window'] = self.num_windows
+        self.num_windows += 1
+        if scores['drift/alert']:
+            logger.warning(f'Input drift in window {scores["window"]}: {scores}')
+        if self.on_report is not None:
+            self.on_report(scores)
+        return scores
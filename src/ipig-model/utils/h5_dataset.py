@@ -0,0 +1,167 @@
+import h5py, math, itertools, numpy as np
+import torch
+
+from torch.utils.data import IterableDataset, get_worker_info
+from utils.preprocessing import get_pipeline
+from utils.loader import dist_info
+
+
+H5_KEYS = ('inputs', 'cls_label', 'deposit_thickness', 'inner_diameter')
+
+
+def h5_stop(path, no_sample):
+    # Same slicing as get_data: [:-1] for the full file, [:10000] for the sample run
+    with h5py.File(path, 'r') as f:
+        n = f['inputs'].shape[0]
+    return n - 1 if no_sample else min(n, 10000)
+
+
+def compute_h5_stats(path, stop=None, chunk_rows=65536, pipeline='ipig-h5'):
+    # Streaming stats, same values as preprocessing_data without loading the whole set
+    pipeline = get_pipeline(pipeline)
+    stats = None
+    with h5py.File(path, 'r') as f:
+        dset = f['inputs']
+        stop = dset.shape[0] if stop is None else stop
+        for start in range(0, stop, chunk_rows):
+            stats = pipeline.partial_fit(dset[start: min(start + chunk_rows, stop)], stats)
+    return stats.result()
+
+
+class BruceH5IterableDataset(IterableDataset):
+    """
+    Stream (inputs, cls_label, deposit_thickness, inner_diameter) batches out of an HDF5 file.
+
+    Rows are read block by block, a buffer of `buffer_size` rows is shuffled in memory and cut into batches,
+    so peak memory is bounded by `buffer_size` (plus one block) whatever the size of the file.
+    Use it with DataLoader(dataset, batch_size=None, num_workers=...) and the same `num_workers` here. Every worker
+    opens its own file handle and reads a disjoint set of blocks, and emits its own last partial batch: __len__ counts
+    them, the partial tail block always goes to the same shard so the count does not change between epochs.
+    """
+
+    def __init__(self, path, MEAN, STD, batch_size=128, start=0, stop=None, block_rows=None, buffer_size=65536,
+                 shuffle=True, drop_last=False, seed=42, pipeline='ipig-h5', num_workers=0):
+        super().__init__()
+        self.path = path
+        self.pipeline = get_pipeline(pipeline)
+        self.MEAN = MEAN
+        self.STD = STD
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_workers = num_workers
+
+        with h5py.File(path, 'r') as f:
+            dset = f['inputs']
+            self.start = start
+            self.stop = dset.shape[0] if stop is None else stop
+            # Align blocks on the HDF5 chunk layout so a block never decompresses a chunk twice
+            if block_rows is None:
+                block_rows = dset.chunks[0] if dset.chunks is not None else 4096
+                block_rows *= max(1, 4096 // block_rows)
+        self.block_rows = block_rows
+        self.buffer_size = max(buffer_size, batch_size)
+        self.blocks = [(s, min(s + block_rows, self.stop)) for s in range(self.start, self.stop, block_rows)]
+        self._file = None
+        self._epoch = 0
+
+    def _shard_rows(self, num_shards):
+        # Shard k reads blocks k, k + num_shards, ... of the order, the tail block is always last in the order
+        rows = [len(range(k, len(self.blocks), num_shards)) * self.block_rows for k in range(num_shards)]
+        if self.blocks:
+            rows[(len(self.blocks) - 1) % num_shards] -= self.block_rows - (self.blocks[-1][1] - self.blocks[-1][0])
+        return rows
+
+    def __len__(self):
+        _, world_size = dist_info()
+        num_workers = max(1, self.num_workers)
+        rows = self._shard_rows(world_size * num_workers)
+        if world_size > 1:
+            return num_workers * (min(rows) // self.batch_size)
+        if self.drop_last:
+            return sum(r // self.batch_size for r in rows)
+        return sum(math.ceil(r / self.batch_size) for r in rows)
+
+    def _open(self):
+        # h5py handles can not be shared across processes, open lazily inside each worker
+        if self._file is None:
+            self._file = h5py.File(self.path, 'r')
+        return self._file
+
+    def _read_block(self, f, start, end):
+        inputs = self.pipeline.transform(f['inputs'][start:end], self.MEAN, self.STD)
+        return [inputs,
+                f['cls_label'][start:end].astype(np.float32, copy=False),
+                (f['deposit_thickness'][start:end] / 10).reshape(-1).astype(np.float32, copy=False),
+                f['inner_diameter'][start:end].astype(np.float32, copy=False)]
+
+    def _worker_blocks(self):
+        rank, world_size = dist_info()
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            base_seed = self.seed + int(torch.randint(0, 2 ** 31 - 1, (1,)).item())
+        else:
+            # worker_info.seed = base_seed + worker_id, base_seed changes every epoch and is the same for all workers
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            base_seed = worker_info.seed - worker_id
+        if world_size > 1:
+            # Ranks do not share a DataLoader seed, use the same block order on all of them
+            base_seed = self.seed + self._epoch
+        self._epoch += 1
+
+        order = np.arange(len(self.blocks))
+        rng = np.random.default_rng(base_seed)
+        if self.shuffle:
+            # The tail block (partial or not) stays last, the rows of every shard are then the same each epoch
+            rng.shuffle(order[:-1])
+
+        shard, num_shards = rank * num_workers + worker_id, world_size * num_workers
+        max_batches = None
+        if world_size > 1:
+            # DDP hangs if ranks run a different number of steps, every shard stops after the full batches of the
+            # smallest shard (the partial tail block included)
+            max_batches = min(self._shard_rows(num_shards)) // self.batch_size
+        rng = np.random.default_rng([base_seed, rank])
+        return [self.blocks[i] for i in order[shard::num_shards]], rng, max_batches
+
+    def _emit(self, buffer, rng, final=False):
+        arrays = [np.concatenate(a) if len(a) > 1 else a[0] for a in zip(*buffer)]
+        n = arrays[0].shape[0]
+        if self.shuffle:
+            perm = rng.permutation(n)
+            arrays = [a[perm] for a in arrays]
+
+        n_full = n - n % self.batch_size
+        for s in range(0, n_full, self.batch_size):
+            yield tuple(torch.from_numpy(a[s: s + self.batch_size]) for a in arrays)
+
+        rest = [a[n_full:] for a in arrays]
+        if final:
+            if n_full < n and not self.drop_last:
+                yield tuple(torch.from_numpy(a) for a in rest)
+            return []
+        return [rest] if n_full < n else []
+
+    def _iter_batches(self, f, blocks, rng):
+        buffer, buffered = [], 0
+        for start, end in blocks:
+            buffer.append(self._read_block(f, start, end))
+            buffered += end - start
+            if buffered >= self.buffer_size:
+                buffer = yield from self._emit(buffer, rng)
+                buffered = buffer[0][0].shape[0] if buffer else 0
+
+        if buffer:
+            yield from self._emit(buffer, rng, final=True)
+
+    def __iter__(self):
+        f = self._open()
+        blocks, rng, max_batches = self._worker_blocks()
+        yield from itertools.islice(self._iter_batches(f, blocks, rng), max_batches)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
@@ -0,0 +1,136 @@
+import torch
+
+from torch.utils.data import DataLoader, Dataset, Sampler, get_worker_info
+
+
+def _identity(batch):
+    return batch
+
+
+def dist_info():
+    # (rank, world_size), read lazily because Lightning initializes the process group after the loaders are built
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class BruceBatchSampler(Sampler):
+    # Yields whole index batches (1-D LongTensors) cut out of a single permutation per epoch.
+    # contiguous=True only shuffles the order of the batches, every batch is a run of consecutive indices.
+    # Under torch.distributed every rank takes an equal-size shard of the same permutation (seed + epoch)
+    # indices restricts the sampler to a subset of the dataset (a cross-validation fold), num_samples is then its size
+    def __init__(self, num_samples, batch_size=128, shuffle=True, drop_last=False, generator=None, contiguous=False,
+                 seed=42, indices=None):
+        super().__init__(None)
+        self.num_samples = num_samples if indices is None else len(indices)
+        self.indices = None if indices is None else torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.contiguous = contiguous
+        self.seed = seed
+        self.epoch = 0
+
+    def _shard_size(self):
+        _, world_size = dist_info()
+        if self.drop_last:
+            return self.num_samples // world_size
+        return (self.num_samples + world_size - 1) // world_size
+
+    def __len__(self):
+        shard_size = self._shard_size()
+        if self.drop_last:
+            return shard_size // self.batch_size
+        return (shard_size + self.batch_size - 1) // self.batch_size
+
+    def _generator(self, world_size):
+        if self.generator is not None or world_size == 1:
+            return self.generator
+        # Every rank must draw the same permutation
+        return torch.Generator().manual_seed(self.seed + self.epoch)
+
+    def __iter__(self):
+        rank, world_size = dist_info()
+        generator = self._generator(world_size)
+        self.epoch += 1
+
+        if self.shuffle and not self.contiguous:
+            order = torch.randperm(self.num_samples, generator=generator)
+        else:
+            order = torch.arange(self.num_samples)
+
+        if world_size > 1:
+            # Pad by wrapping around (or truncate with drop_last) so every rank runs the same number of steps
+            shard_size = self._shard_size()
+            total = shard_size * world_size
+            if total > self.num_samples:
+                order = torch.cat([order, order[:total - self.num_samples]])
+            order = order[:total].view(-1, world_size)[:, rank] if not self.contiguous else \
+                order[:total].view(world_size, -1)[rank]
+
+        if self.indices is not None:
+            order = self.indices[order]
+        batches = order[:len(self) * self.batch_size if self.drop_last else None].split(self.batch_size)
+
+        if self.shuffle and self.contiguous:
+            yield from (batches[i] for i in torch.randperm(len(batches), generator=generator).tolist())
+        else:
+            yield from batches
+
+
+class BruceBatchDataset(Dataset):
+    """
+    Map-style dataset indexed by a whole batch of indices: one index_select per tensor instead of
+    one __getitem__ per sample plus default_collate.
+
+    In the main process the batches are written into a ring of preallocated (optionally pinned) buffers that are
+    reused across steps, `num_buffers` must be larger than the number of batches alive at the same time
+    (Lightning keeps one prefetched batch, hence the default of 3).
+    """
+
+    def __init__(self, *tensors, batch_size=128, pin_memory=False, reuse_buffers=True, num_buffers=3):
+        super().__init__()
+        assert all(t.shape[0] == tensors[0].shape[0] for t in tensors)
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.reuse_buffers = reuse_buffers
+        self.num_buffers = num_buffers
+        self._buffers = None
+        self._step = 0
+
+    def __len__(self):
+        return self.tensors[0].shape[0]
+
+    def _alloc(self):
+        return [torch.empty((self.batch_size,) + t.shape[1:], dtype=t.dtype, pin_memory=self.pin_memory)
+                for t in self.tensors]
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        b = indices.shape[0]
+
+        # Workers send batches through shared memory anyway, only reuse buffers in the main process
+        if not self.reuse_buffers or b > self.batch_size or get_worker_info() is not None:
+            return [torch.index_select(t, 0, indices) for t in self.tensors]
+
+        if self._buffers is None:
+            self._buffers = [self._alloc() for _ in range(self.num_buffers)]
+        buffers = self._buffers[self._step % self.num_buffers]
+        self._step += 1
+        return [torch.index_select(t, 0, indices, out=buf[:b]) for t, buf in zip(self.tensors, buffers)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buffers'] = None
+        return state
+
+
+def get_batch_loader(tensors, batch_size=128, shuffle=True, drop_last=False, pin_memory=False, num_workers=0,
+                     reuse_buffers=True, generator=None, indices=None):
+    dataset = BruceBatchDataset(*tensors, batch_size=batch_size, pin_memory=pin_memory, reuse_buffers=reuse_buffers)
+    sampler = BruceBatchSampler(len(dataset), batch_size, shuffle, drop_last, generator, indices=indices)
+    # batch_size=None turns off auto-collation, the sampler output goes straight to dataset[indices]
+    return DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=_identity, num_workers=num_workers,
+                      persistent_workers=num_workers > 0)
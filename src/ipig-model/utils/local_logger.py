@@ -0,0 +1,163 @@
+import os, json, time, logging, numpy as np
+
+from argparse import Namespace
+from pytorch_lightning.loggers.base import LightningLoggerBase, rank_zero_experiment
+from pytorch_lightning.utilities import rank_zero_only
+
+
+logger = logging.getLogger('model')
+
+METRIC_DTYPE = np.dtype([('step', '<i8'), ('value', '<f8')])
+
+
+def _file_name(name):
+    return name.replace('/', '.').replace(os.sep, '.')
+
+
+def read_metrics(log_dir):
+    # {metric: structured array (step, value)} from the append-only files
+    metric_dir = os.path.join(log_dir, 'metrics')
+    return {f[:-4]: np.fromfile(os.path.join(metric_dir, f), dtype=METRIC_DTYPE)
+            for f in sorted(os.listdir(metric_dir)) if f.endswith('.bin')}
+
+
+def read_histograms(log_dir):
+    # {name: (steps, counts, edges)}
+    hist_dir = os.path.join(log_dir, 'histograms')
+    with open(os.path.join(hist_dir, 'index.json')) as f:
+        index = json.load(f)
+    out = {}
+    for name, bins in index.items():
+        rows = np.fromfile(os.path.join(hist_dir, f'{_file_name(name)}.bin'), dtype='<f8').reshape(-1, 2 * bins + 2)
+        out[name] = rows[:, 0].astype(np.int64), rows[:, 1: bins + 1], rows[:, bins + 1:]
+    return out
+
+
+class BruceLocalLogger(LightningLoggerBase):
+    """
+    Offline logger writing append-only binary files, one per metric (int64 step, float64 value) and one per
+    histogram. Metrics are buffered in memory and flushed every `flush_every` records or `flush_secs` seconds.
+    The time spent inside the logger is tracked and reported per training step.
+    """
+
+    def __init__(self, save_dir='./logs', name='bruce', version=None, flush_every=1000, flush_secs=30.):
+        super().__init__()
+        self._save_dir = save_dir
+        self._name = name
+        self._version = version
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+
+        self._buffer = {}
+        self._buffered = 0
+        self._last_flush = time.perf_counter()
+        self._hist_index = {}
+        self.overhead = 0.
+        self.max_step = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def version(self):
+        if self._version is None:
+            root = os.path.join(self._save_dir, self._name)
+            existing = [d for d in os.listdir(root) if d.startswith('version_')] if os.path.isdir(root) else []
+            self._version = max([int(d.split('_')[1]) for d in existing] + [-1]) + 1
+        return self._version
+
+    @property
+    def log_dir(self):
+        return os.path.join(self._save_dir, self._name, f'version_{self.version}')
+
+    @property
+    def save_dir(self):
+        return self._save_dir
+
+    @property
+    @rank_zero_experiment
+    def experiment(self):
+        # Code written for wandb calls logger.experiment.log(dict)
+        return self
+
+    def log(self, metrics, step=None):
+        self.log_metrics({k: v for k, v in metrics.items() if np.isscalar(v)}, step)
+
+    @rank_zero_only
+    def log_hyperparams(self, params):
+        params = vars(params) if isinstance(params, Namespace) else dict(params)
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(os.path.join(self.log_dir, 'hparams.json'), 'w') as f:
+            json.dump(params, f, default=str, indent=2)
+
+    @rank_zero_only
+    def log_metrics(self, metrics, step=None):
+        t0 = time.perf_counter()
+        step = self.max_step if step is None else step
+        self.max_step = max(self.max_step, step)
+        for k, v in metrics.items():
+            self._buffer.setdefault(k, []).append((step, float(v)))
+        self._buffered += len(metrics)
+        if self._buffered >= self.flush_every or t0 - self._last_flush >= self.flush_secs:
+            self._flush()
+        self.overhead += time.perf_counter() - t0
+
+    @rank_zero_only
+    def log_histogram(self, name, counts, edges, step=None):
+        t0 = time.perf_counter()
+        step = self.max_step if step is None else step
+        counts, edges = np.asarray(counts, dtype='<f8'), np.asarray(edges, dtype='<f8')
+        hist_dir = os.path.join(self.log_dir, 'histograms')
+        if name not in self._hist_index:
+            os.makedirs(hist_dir, exist_ok=True)
+            self._hist_index[name] = counts.shape[0]
+            with open(os.path.join(hist_dir, 'index.json'), 'w') as f:
+                json.dump(self._hist_index, f)
+        with open(os.path.join(hist_dir, f'{_file_name(name)}.bin'), 'ab') as f:
+            np.concatenate([[step], counts, edges]).astype('<f8').tofile(f)
+        self.overhead += time.perf_counter() - t0
+
+    def _flush(self):
+        metric_dir = os.path.join(self.log_dir, 'metrics')
+        os.makedirs(metric_dir, exist_ok=True)
+        for k, records in self._buffer.items():
+            with open(os.path.join(metric_dir, f'{_file_name(k)}.bin'), 'ab') as f:
+                np.array(records, dtype=METRIC_DTYPE).tofile(f)
+        self._buffer, self._buffered = {}, 0
+        self._last_flush = time.perf_counter()
+
+    @rank_zero_only
+    def save(self):
+        super().save()
+        self._flush()
+
+    @rank_zero_only
+    def finalize(self, status):
+        self._flush()
+        if self.max_step:
+            report = {'logger_overhead_s': self.overhead, 'steps': self.max_step,
+                      'logger_overhead_ms_per_step': self.overhead / self.max_step * 1e3}
+            with open(os.path.join(self.log_dir, 'overhead.json'), 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f'Logging overhead: {report["logger_overhead_ms_per_step"]:.3f} ms/step')
+
+
+def log_histograms(pl_logger, histograms, step=None, epoch=None):
+    # histograms: {name: (counts, edges)}, written natively by BruceLocalLogger, as wandb.Histogram otherwise.
+    # epoch is logged with them so they can be plotted against it
+    if pl_logger is None or not histograms:
+        return
+    if isinstance(pl_logger, BruceLocalLogger):
+        for name, (counts, edges) in histograms.items():
+            pl_logger.log_histogram(name, counts, edges, step)
+        if epoch is not None:
+            pl_logger.log_metrics({'epoch': epoch}, step)
+        return
+
+    import wandb
+    log_dict = {name: wandb.Histogram(np_histogram=(np.asarray(counts), np.asarray(edges)))
+                for name, (counts, edges) in histograms.items()}
+    if epoch is not None:
+        log_dict['epoch'] = epoch
+    pl_logger.experiment.log(log_dict, commit=False)
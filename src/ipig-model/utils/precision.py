@@ -0,0 +1,46 @@
+import logging, platform, torch
+
+from contextlib import nullcontext
+
+
+# LSTM kernels have no bf16 CPU autocast path in torch 1.10, the block would just bounce between dtypes
+BF16_BACKBONES = ('cnn', 'unet', 'mlp')
+
+logger = logging.getLogger('model')
+
+
+def cpu_supports_bf16():
+    # Native bf16 dot products (AVX512-BF16 / AMX), without them bf16 is emulated and slower than fp32
+    if platform.system() != 'Linux':
+        return False
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def resolve_precision(precision, backbone, force=False):
+    # Returns 'bf16' or 'fp32', falling back to fp32 (with a warning) where bf16 is not worth it
+    if precision != 'bf16':
+        return 'fp32'
+    backbone = backbone if backbone in ('cnn', 'lstm', 'unet') else 'mlp'
+    if backbone not in BF16_BACKBONES:
+        logger.warning(f'bf16 is not supported for the {backbone} backbone, using fp32')
+        return 'fp32'
+    if not force and not cpu_supports_bf16():
+        logger.warning('CPU has no native bf16 support, using fp32')
+        return 'fp32'
+    return 'bf16'
+
+
+def trainer_precision(precision):
+    # pytorch_lightning keeps fp32 weights (and optimizer states) and runs the forward under CPU autocast for 'bf16'
+    return 'bf16' if precision == 'bf16' else 32
+
+
+def autocast(precision):
+    if precision == 'bf16':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return nullcontext()
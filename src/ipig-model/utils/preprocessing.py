@@ -0,0 +1,151 @@
+import os, numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_ROWS = 16384
+# Below this number of values threading costs more than it saves
+PARALLEL_MIN_SIZE = 1 << 22
+
+
+def _num_threads(arr, num_threads):
+    if num_threads is None:
+        num_threads = min(8, os.cpu_count() or 1)
+    return num_threads if arr.size >= PARALLEL_MIN_SIZE else 1
+
+
+def _chunks(n, chunk_rows):
+    return [(s, min(s + chunk_rows, n)) for s in range(0, n, chunk_rows)]
+
+
+def _map_chunks(fn, arr, chunk_rows, num_threads):
+    # numpy releases the GIL inside ufuncs, so chunks really run in parallel
+    chunks = _chunks(arr.shape[0], chunk_rows)
+    num_threads = _num_threads(arr, num_threads)
+    if num_threads == 1 or len(chunks) == 1:
+        return [fn(arr[s:e]) for s, e in chunks]
+    with ThreadPoolExecutor(num_threads) as pool:
+        return list(pool.map(lambda se: fn(arr[se[0]:se[1]]), chunks))
+
+
+class RunningStats:
+    # float64 accumulators, can be fed chunk by chunk (HDF5 streaming) or merged across threads
+    def __init__(self, method='standardize'):
+        self.method = method
+        self.count, self.total, self.total_sq = 0, 0., 0.
+        self.min, self.max = np.inf, -np.inf
+
+    def update(self, values):
+        if values.size == 0:
+            return self
+        if self.method == 'minmax':
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+        else:
+            values = values.astype(np.float64, copy=False)
+            self.total += float(values.sum())
+            self.total_sq += float(np.dot(values.ravel(), values.ravel()))
+        self.count += values.size
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def result(self):
+        # (center, scale) so that every pipeline applies the same (x - center) / scale
+        if self.method == 'minmax':
+            return self.min, self.max - self.min
+        mean = self.total / self.count
+        return mean, float(np.sqrt(max(self.total_sq / self.count - mean ** 2, 0.)))
+
+
+class PreprocessPipeline:
+    """
+    In-place, chunk-wise float32 scaling shared by training, pushing, prediction and the dashboard.
+
+    mask_zeros: zero readings are missing values, they are left out of the stats and stay 0
+    clip_above: readings above this value are set to 0 before anything else
+    negate: flip the sign after scaling (raw ECT csv exports are inverted)
+    """
+
+    def __init__(self, name, method='standardize', mask_zeros=False, clip_above=None, negate=False):
+        self.name = name
+        self.method = method
+        self.mask_zeros = mask_zeros
+        self.clip_above = clip_above
+        self.negate = negate
+
+    def __repr__(self):
+        return f'PreprocessPipeline({self.name!r}, method={self.method!r}, mask_zeros={self.mask_zeros}, ' \
+               f'clip_above={self.clip_above}, negate={self.negate})'
+
+    def _clip_(self, chunk):
+        if self.clip_above is not None:
+            chunk[chunk > self.clip_above] = 0
+        return chunk
+
+    def partial_fit(self, chunk, stats=None):
+        # Does not modify chunk, used when data come in pieces (HDF5 blocks)
+        stats = stats if stats is not None else RunningStats(self.method)
+        if self.clip_above is not None:
+            chunk = np.where(chunk > self.clip_above, 0, chunk)
+        return stats.update(chunk[chunk != 0] if self.mask_zeros else chunk)
+
+    def fit(self, arr, chunk_rows=CHUNK_ROWS, num_threads=None):
+        parts = _map_chunks(self.partial_fit, arr, chunk_rows, num_threads)
+        stats = parts[0]
+        for p in parts[1:]:
+            stats.merge(p)
+        return stats.result()
+
+    def _transform_chunk_(self, chunk, center, scale):
+        self._clip_(chunk)
+        mask = chunk == 0 if self.mask_zeros else None
+        chunk -= center
+        chunk *= (-1. if self.negate else 1.) / scale
+        if mask is not None:
+            chunk[mask] = 0
+        return None
+
+    def transform(self, arr, center, scale, chunk_rows=CHUNK_ROWS, num_threads=None):
+        # In place when arr is already float32, otherwise a single float32 copy is made
+        arr = np.asarray(arr)
+        if arr.dtype != np.float32 or not arr.flags.writeable:
+            arr = arr.astype(np.float32)
+        center, scale = np.float32(center), np.float32(scale)
+        _map_chunks(lambda c: self._transform_chunk_(c, center, scale), arr, chunk_rows, num_threads)
+        return arr
+
+    def fit_transform(self, arr, center=None, scale=None, chunk_rows=CHUNK_ROWS, num_threads=None):
+        arr = np.asarray(arr)
+        if arr.dtype != np.float32 or not arr.flags.writeable:
+            arr = arr.astype(np.float32)
+        if center is None:
+            # Clip first so the stats see the same values as the transform
+            if self.clip_above is not None:
+                _map_chunks(self._clip_, arr, chunk_rows, num_threads)
+            center, scale = self.fit(arr, chunk_rows, num_threads)
+        return self.transform(arr, center, scale, chunk_rows, num_threads), center, scale
+
+
+PIPELINES = {
+    # train_new.h5/val_new.h5 frames, zeros are dead channels
+    'ipig-h5': PreprocessPipeline('ipig-h5', mask_zeros=True),
+    # Dashboard model, every reading is standardized
+    'ipig-h5-dense': PreprocessPipeline('ipig-h5-dense'),
+    # Raw ECT exports (tab separated), saturated readings > 1 are dropped and the sign is flipped
+    'ect-raw-csv': PreprocessPipeline('ect-raw-csv', clip_above=1, negate=True),
+    # 'Samples_big' matrices used by predict.py
+    'samples-big-minmax': PreprocessPipeline('samples-big-minmax', method='minmax'),
+    'samples-big-dense': PreprocessPipeline('samples-big-dense'),
+}
+
+
+def get_pipeline(name):
+    if name not in PIPELINES:
+        raise KeyError(f'Unknown preprocessing pipeline {name!r}, choose from {list(PIPELINES)}')
+    return PIPELINES[name]
@@ -0,0 +1,235 @@
+import os, json, time, logging, functools, psutil, numpy as np
+import torch
+import pytorch_lightning as pl
+
+
+logger = logging.getLogger('model')
+
+
+def measure_latency(model, num_feature, batch_sizes=(1, 128), repeat=50, warmup=1, percentiles=(50,)):
+    # Forward latency per batch size on random frames after `warmup` untimed calls: {'latency_ms_b<batch>': median}
+    # plus {'latency_ms_b<batch>_p<q>': ms} for the other percentiles
+    latencies = {}
+    model.eval()
+    with torch.inference_mode():
+        for b in batch_sizes:
+            x = torch.randn(b, num_feature)
+            for _ in range(warmup):
+                model(x)
+            times = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                model(x)
+                times.append(time.perf_counter() - t0)
+            for q in percentiles:
+                key = f'latency_ms_b{b}' if q == 50 else f'latency_ms_b{b}_p{q}'
+                latencies[key] = float(np.percentile(times, q) * 1e3)
+    return latencies
+
+
+def max_rss_mb():
+    # Process lifetime peak RSS: ru_maxrss (KB on Linux) on Unix, peak working set on Windows (no resource module)
+    try:
+        import resource
+    except ImportError:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', float('nan')) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def profiled_modules(pl_module):
+    # The core, its direct children (CNN layers, UNet blocks, LSTM cell, ...) and the FCN heads
+    modules = {'core': pl_module.core}
+    modules.update({f'core.{name}': m for name, m in pl_module.core.named_children()})
+    modules['intermediate_layer'] = pl_module.intermediate_layer
+    modules['output_layer'] = pl_module.output_layer
+    return modules
+
+
+class BruceProfilerCallback(pl.Callback):
+    """
+    Profiles `num_steps` training steps after `warmup_steps`, then stops the training.
+
+    - forward/backward time per module: forward pre/post hooks, and for backward a hook on the module output gradient
+      (start) and a full backward hook (end). Modules fed with the raw frames (the core and its first layer) have no
+      input gradient, their full backward hook fires too early under torch 1.10: their backward ends with the
+      backward pass (on_after_backward) instead
+    - sections are nested: modules, loss and logging run inside the step, core.<child> inside core, the report
+      indents them under their parent and their share is of the parent
+    - dataloader wait: time between the end of a step and the start of the next one
+    - loss and logging time: BruceModel.loss and BruceModel.log are wrapped while profiling
+    - samples/sec and peak RSS, plus a Chrome trace (chrome://tracing, Perfetto) from torch.profiler
+    """
+
+    def __init__(self, output_dir='./profile', num_steps=100, warmup_steps=5):
+        super().__init__()
+        self.output_dir = output_dir
+        self.num_steps = num_steps
+        self.warmup_steps = warmup_steps
+
+        self.times = {}
+        self._starts = {}
+        self._handles = []
+        self._originals = {}
+        self._step = 0
+        self._last_end = None
+        self._step_start = None
+        self._samples = 0
+        self._peak_rss = 0
+        self._profiler = None
+        self._record_functions = {}
+        # Modules whose input does not require grad, their backward is closed in on_after_backward
+        self._no_input_grad = set()
+
+    @property
+    def active(self):
+        return self.warmup_steps <= self._step < self.warmup_steps + self.num_steps
+
+    def _add(self, key, elapsed):
+        if self.active:
+            self.times[key] = self.times.get(key, 0.) + elapsed
+
+    # Module hooks
+    def _forward_pre(self, name):
+        def hook(module, inputs):
+            if not any(isinstance(i, torch.Tensor) and i.requires_grad for i in inputs):
+                self._no_input_grad.add(name)
+            self._starts[f'{name}/forward'] = time.perf_counter()
+            rf = torch.autograd.profiler.record_function(f'## {name} ##')
+            rf.__enter__()
+            self._record_functions[name] = rf
+        return hook
+
+    def _forward_post(self, name):
+        def hook(module, inputs, output):
+            self._add(f'{name}/forward', time.perf_counter() - self._starts.pop(f'{name}/forward'))
+            rf = self._record_functions.pop(name, None)
+            if rf is not None:
+                rf.__exit__(None, None, None)
+            outputs = output if isinstance(output, tuple) else (output,)
+            for o in outputs:
+                if isinstance(o, torch.Tensor) and o.requires_grad:
+                    o.register_hook(lambda grad: self._starts.__setitem__(f'{name}/backward', time.perf_counter()))
+                    break
+        return hook
+
+    def _backward_end(self, name):
+        def hook(module, grad_input, grad_output):
+            if name in self._no_input_grad:
+                return
+            start = self._starts.pop(f'{name}/backward', None)
+            if start is not None:
+                self._add(f'{name}/backward', time.perf_counter() - start)
+        return hook
+
+    def _wrap(self, pl_module, attr, key):
+        original = getattr(pl_module, attr)
+        self._originals[attr] = original
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            out = original(*args, **kwargs)
+            self._add(key, time.perf_counter() - t0)
+            return out
+        setattr(pl_module, attr, timed)
+
+    def on_train_start(self, trainer, pl_module):
+        for name, m in profiled_modules(pl_module).items():
+            self._handles += [m.register_forward_pre_hook(self._forward_pre(name)),
+                              m.register_forward_hook(self._forward_post(name)),
+                              m.register_full_backward_hook(self._backward_end(name))]
+        self._wrap(pl_module, 'loss', 'loss')
+        self._wrap(pl_module, 'log', 'logging')
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            schedule=torch.profiler.schedule(wait=0, warmup=self.warmup_steps, active=self.num_steps),
+            on_trace_ready=lambda p: p.export_chrome_trace(os.path.join(self.output_dir, 'trace.json')),
+            profile_memory=True,
+        )
+        self._profiler.__enter__()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+        now = time.perf_counter()
+        if self._last_end is not None:
+            self._add('dataloader_wait', now - self._last_end)
+        self._step_start = now
+
+    def on_after_backward(self, trainer, pl_module):
+        now = time.perf_counter()
+        for name in self._no_input_grad:
+            start = self._starts.pop(f'{name}/backward', None)
+            if start is not None:
+                self._add(f'{name}/backward', now - start)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        now = time.perf_counter()
+        self._add('step', now - self._step_start)
+        if self.active:
+            self._samples += batch[0].shape[0]
+            self._peak_rss = max(self._peak_rss, psutil.Process().memory_info().rss)
+        self._last_end = now
+        self._step += 1
+        self._profiler.step()
+
+        if self._step >= self.warmup_steps + self.num_steps:
+            self._finish(trainer, pl_module)
+            trainer.should_stop = True
+
+    def _finish(self, trainer, pl_module):
+        if self._profiler is None:
+            return
+        self._profiler.__exit__(None, None, None)
+        self._profiler = None
+        for h in self._handles:
+            h.remove()
+        for attr, original in self._originals.items():
+            setattr(pl_module, attr, original)
+
+        if trainer.is_global_zero:
+            self.write_report()
+
+    def on_train_end(self, trainer, pl_module):
+        self._finish(trainer, pl_module)
+
+    @staticmethod
+    def parent(section):
+        # step and dataloader_wait make the wall time, core.<child>/<pass> is inside core/<pass>, the rest inside step
+        if section in ('step', 'dataloader_wait'):
+            return None
+        if section.startswith('core.'):
+            return 'core/' + section.rpartition('/')[2]
+        return 'step'
+
+    def write_report(self):
+        num_steps = max(1, min(self._step - self.warmup_steps, self.num_steps))
+        total = self.times.get('step', 0.) + self.times.get('dataloader_wait', 0.)
+        ms = {k: v / num_steps * 1e3 for k, v in sorted(self.times.items(), key=lambda kv: -kv[1])}
+        report = {
+            'steps': num_steps,
+            'samples_per_sec': self._samples / total if total else float('nan'),
+            'peak_rss_mb': self._peak_rss / 2 ** 20,
+            'max_rss_mb': max_rss_mb(),
+            'ms_per_step': ms,
+            'parent': {k: self.parent(k) for k in ms},
+        }
+        with open(os.path.join(self.output_dir, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+        lines = [f'Profiled {num_steps} steps: {report["samples_per_sec"]:.0f} samples/sec, '
+                 f'peak RSS {report["peak_rss_mb"]:.0f} MB',
+                 f'{"section (share of the parent)":<40}{"ms/step":>10}{"share":>8}']
+
+        def add_lines(parent, depth):
+            for k, v in ms.items():
+                if self.parent(k) != parent:
+                    continue
+                base = total / num_steps * 1e3 if parent is None else ms.get(parent, 0.)
+                share = v / base if base else 0.
+                lines.append(f'{"  " * depth + k:<40}{v:>10.3f}{share:>8.1%}')
+                add_lines(k, depth + 1)
+        add_lines(None, 0)
+        with open(os.path.join(self.output_dir, 'report.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        logger.info('\n'.join(lines))
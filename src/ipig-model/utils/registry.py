@@ -0,0 +1,230 @@
+import os, json, time, hashlib, shutil, uuid, numpy as np
+import torch
+import torch.nn as nn
+
+from utils.drift import drift_path
+from utils.stats import NormStats
+
+
+DTYPES = {'fp32': np.float32, 'fp16': np.float16}
+# Tensors start on a 64 bytes boundary of the blob
+ALIGN = 64
+CHECKPOINT_EXT = ('.ckpt', '.pt', '.pth')
+
+
+def slim_state_dict(checkpoint, dtype='fp32'):
+    # Only the weights of a Lightning checkpoint, floating point tensors cast to dtype (integers are kept as is)
+    out = {}
+    for name, t in checkpoint['state_dict'].items():
+        arr = t.detach().cpu().numpy()
+        if np.issubdtype(arr.dtype, np.floating):
+            arr = arr.astype(DTYPES[dtype])
+        out[name] = np.ascontiguousarray(arr)
+    return out
+
+
+def write_blob(path, arrays):
+    # One flat file, the manifest keeps (dtype, shape, offset) so any tensor is a view of a single np.memmap
+    tensors, offset = {}, 0
+    with open(path, 'wb') as f:
+        for name, arr in arrays.items():
+            pad = -offset % ALIGN
+            f.write(b'\0' * pad)
+            offset += pad
+            f.write(arr.tobytes())
+            tensors[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+            offset += arr.nbytes
+    return tensors
+
+
+def read_blob(path, tensors, mmap_mode='c'):
+    # 'c' (copy-on-write) keeps the pages shared between processes mapping the same file, like BruceDataCache
+    blob = np.memmap(path, dtype=np.uint8, mode=mmap_mode)
+    out = {}
+    for name, spec in tensors.items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arr = blob[spec['offset']: spec['offset'] + count * dtype.itemsize].view(dtype)
+        out[name] = arr.reshape(spec['shape'])
+    return out
+
+
+def _set_tensor(model, name, tensor):
+    # Swap the parameter/buffer for the mapped tensor instead of copying it (load_state_dict would copy)
+    module_name, _, attr = name.rpartition('.')
+    module = model.get_submodule(module_name) if module_name else model
+    if attr in module._parameters:
+        module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+    elif attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        raise KeyError(f'{name} is neither a parameter nor a buffer of {type(model).__name__}')
+
+
+class BruceModelRegistry:
+    """
+    Local, content-addressed store of inference weights.
+
+    objects/<digest>/ holds weights.bin (every tensor of the state dict in one flat, memory-mappable file) and
+    manifest.json (hparams, tensor layout, normalization stats), plus drift.npz when the checkpoint has a drift
+    reference sidecar. The digest is the sha256 of the blob, publishing the same weights twice stores them once.
+    models/<name>.json lists the versions of a name, newest last.
+    Predictors on one host map the same file, so the weights are read from disk once and share the page cache.
+    """
+
+    def __init__(self, root='./model_registry'):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.models_dir = os.path.join(root, 'models')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.models_dir, exist_ok=True)
+
+    def _index_path(self, name):
+        return os.path.join(self.models_dir, f'{name}.json')
+
+    def versions(self, name):
+        path = self._index_path(name)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def names(self):
+        return sorted(os.path.splitext(p)[0] for p in os.listdir(self.models_dir) if p.endswith('.json'))
+
+    def _write_object(self, arrays, manifest):
+        tmp_dir = os.path.join(self.objects_dir, f'.{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        try:
+            blob_path = os.path.join(tmp_dir, 'weights.bin')
+            manifest['tensors'] = write_blob(blob_path, arrays)
+            h = hashlib.sha256()
+            with open(blob_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 24), b''):
+                    h.update(block)
+            digest = h.hexdigest()
+            manifest['digest'] = digest
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2, default=str)
+
+            if os.path.exists(os.path.join(self.objects_dir, digest)):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                try:
+                    os.rename(tmp_dir, os.path.join(self.objects_dir, digest))
+                except OSError:
+                    # Another process published the same weights first
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return digest
+
+    def _copy_drift_reference(self, checkpoint_path, digest):
+        source, target = drift_path(checkpoint_path), os.path.join(self.objects_dir, digest, 'drift.npz')
+        if os.path.exists(source) and not os.path.exists(target):
+            tmp_path = f'{target}.{uuid.uuid4().hex}'
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, target)
+
+    def publish(self, checkpoint_path, name=None, dtype='fp32', note=None):
+        """
+        Strip a Lightning checkpoint (optimizer, callbacks and loop states are dropped) and add it as the next
+        version of `name` (the backbone by default). Returns the version entry.
+        """
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        hparams = dict(checkpoint.get('hyper_parameters', {}))
+        name = name or hparams.get('backbone', 'model')
+        manifest = {'hparams': hparams, 'dtype': dtype, 'norm_stats': checkpoint.get('norm_stats')}
+        digest = self._write_object(slim_state_dict(checkpoint, dtype), manifest)
+        self._copy_drift_reference(checkpoint_path, digest)
+
+        versions = self.versions(name)
+        entry = {'version': len(versions) + 1, 'digest': digest, 'dtype': dtype,
+                 'source': os.path.abspath(checkpoint_path), 'epoch': checkpoint.get('epoch'),
+                 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'note': note,
+                 'size_bytes': os.path.getsize(os.path.join(self.objects_dir, digest, 'weights.bin'))}
+        versions.append(entry)
+        tmp_path = f'{self._index_path(name)}.{uuid.uuid4().hex}'
+        with open(tmp_path, 'w') as f:
+            json.dump(versions, f, indent=2)
+        os.replace(tmp_path, self._index_path(name))
+        return entry
+
+    def resolve(self, ref):
+        # 'name', 'name:latest', 'name:<version>' or a digest (prefix)
+        name, _, version = ref.partition(':')
+        versions = self.versions(name)
+        if versions:
+            if version in ('', 'latest'):
+                return versions[-1]['digest']
+            for entry in versions:
+                if str(entry['version']) == version:
+                    return entry['digest']
+            raise KeyError(f'{name} has no version {version}, available: {[e["version"] for e in versions]}')
+
+        matches = [d for d in os.listdir(self.objects_dir) if not d.startswith('.') and d.startswith(ref)]
+        if len(matches) != 1:
+            raise KeyError(f'Unknown model {ref!r}' if not matches else f'Ambiguous digest prefix {ref!r}')
+        return matches[0]
+
+    def manifest(self, ref):
+        with open(os.path.join(self.objects_dir, self.resolve(ref), 'manifest.json')) as f:
+            return json.load(f)
+
+    def load(self, ref, mmap_mode='c'):
+        """
+        BruceModel in eval mode. fp32 weights are views of the mapped file (no copy, pages shared between
+        processes), fp16 weights are half the size on disk and upcast to fp32 once at load.
+        """
+        from model import BruceModel
+
+        digest = self.resolve(ref)
+        manifest = self.manifest(digest)
+        arrays = read_blob(os.path.join(self.objects_dir, digest, 'weights.bin'), manifest['tensors'], mmap_mode)
+
+        model = BruceModel(**manifest['hparams'])
+        # Same check as a strict load_state_dict, a partial manifest would serve randomly initialized weights
+        expected, stored = set(model.state_dict().keys()), set(arrays)
+        if expected != stored:
+            raise KeyError(f'Manifest of {digest[:12]} does not match {type(model).__name__}: '
+                           f'missing {sorted(expected - stored)}, unexpected {sorted(stored - expected)}')
+        for name, arr in arrays.items():
+            tensor = torch.from_numpy(arr)
+            if tensor.is_floating_point() and tensor.dtype != torch.float32:
+                tensor = tensor.float()
+            _set_tensor(model, name, tensor)
+        if manifest.get('norm_stats'):
+            model.norm_stats = NormStats.from_dict(manifest['norm_stats'])
+        model.model_digest = digest
+        reference = os.path.join(self.objects_dir, digest, 'drift.npz')
+        model.drift_reference = reference if os.path.exists(reference) else None
+        return model.eval()
+
+    @torch.no_grad()
+    def verify(self, checkpoint_path, ref, batch_size=64, seed=0):
+        """
+        Round trip of a published version: the checkpoint and the registry model must give the same outputs on random
+        frames (within fp16 rounding for fp16 versions). Raises ValueError otherwise.
+        """
+        from model import BruceModel
+
+        original, loaded = BruceModel.load_from_checkpoint(checkpoint_path).eval(), self.load(ref)
+        atol = 1e-2 if self.manifest(ref)['dtype'] == 'fp16' else 1e-5
+        num_feature = 600 if original.hparams.backbone == 'lstm' else 524
+        x = torch.randn(batch_size, num_feature, generator=torch.Generator().manual_seed(seed))
+        for name, a, b in zip(('cls', 'dt', 'id'), original(x), loaded(x)):
+            if not torch.allclose(a, b, atol=atol, rtol=atol):
+                raise ValueError(f'{ref} differs from {checkpoint_path} on {name}: '
+                                 f'max abs diff {(a - b).abs().max().item()}')
+        return True
+
+
+def load_inference_model(ref, registry_dir='./model_registry'):
+    # Lightning checkpoint path (legacy) or registry reference
+    if ref.endswith(CHECKPOINT_EXT) and os.path.exists(ref):
+        from model import BruceModel
+        model = BruceModel.load_from_checkpoint(ref).eval()
+        model.drift_reference = drift_path(ref) if os.path.exists(drift_path(ref)) else None
+        return model
+    return BruceModelRegistry(registry_dir).load(ref)
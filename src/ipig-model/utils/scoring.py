@@ -0,0 +1,118 @@
+import os, h5py, numpy as np, pandas as pd
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from utils.precision import autocast
+
+
+OUTPUT_COLUMNS = ('cls', 'dt_predicts', 'id_predicts', 'final_predicts')
+
+
+class ColumnarWriter:
+    # Appends column chunks to resizable HDF5 datasets (one per column), or to a CSV for small exports
+    def __init__(self, path, chunk_rows=1 << 16):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.is_csv = path.endswith('.csv')
+        self.num_rows = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = None if self.is_csv else h5py.File(path, 'w')
+
+    def append(self, columns):
+        n = len(next(iter(columns.values())))
+        if self.is_csv:
+            pd.DataFrame(columns).to_csv(self.path, mode='w' if self.num_rows == 0 else 'a',
+                                         header=self.num_rows == 0, index=False)
+        else:
+            for name, values in columns.items():
+                if name not in self._file:
+                    self._file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=values.dtype,
+                                              chunks=(self.chunk_rows,))
+                dset = self._file[name]
+                dset.resize((self.num_rows + n,))
+                dset[self.num_rows:] = values
+        self.num_rows += n
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columns(path):
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    with h5py.File(path, 'r') as f:
+        return pd.DataFrame({k: f[k][:] for k in f.keys()})
+
+
+class BruceScorer:
+    """
+    Batched inference for BruceModel: eval mode, inference_mode, outputs written into preallocated float32 arrays.
+
+    score() splits an in-memory (or memory-mapped) array across threads, score_to_file() consumes batches from a
+    DataLoader and streams fixed-size chunks to a ColumnarWriter, so memory does not grow with the data.
+    """
+
+    def __init__(self, model, threshold=0.5, precision='fp32', num_threads=None):
+        self.model = model.eval()
+        self.threshold = threshold
+        self.precision = precision
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def predict_batch(self, inputs):
+        with torch.inference_mode(), autocast(self.precision):
+            cls_out, dt_out, id_out = self.model(torch.as_tensor(inputs, dtype=torch.float32))
+        cls = torch.sigmoid(cls_out.reshape(-1).float())
+        dt, id_ = dt_out.reshape(-1).float(), id_out.reshape(-1).float()
+        return cls, dt, id_, (cls >= self.threshold) * dt
+
+    def _score_into(self, inputs, out, start, end, batch_size):
+        for s in range(start, end, batch_size):
+            e = min(s + batch_size, end)
+            for column, values in zip(out.values(), self.predict_batch(inputs[s:e])):
+                column[s:e] = values.numpy()
+
+    def score(self, inputs, batch_size=1024, num_workers=1, names=OUTPUT_COLUMNS):
+        n = inputs.shape[0]
+        out = {name: np.empty(n, dtype=np.float32) for name in names}
+        if num_workers <= 1:
+            self._score_into(inputs, out, 0, n, batch_size)
+            return out
+
+        # Each thread scores a contiguous slice, torch ops release the GIL
+        per_worker = -(-n // num_workers)
+        with ThreadPoolExecutor(num_workers) as pool:
+            list(pool.map(lambda s: self._score_into(inputs, out, s, min(s + per_worker, n), batch_size),
+                          range(0, n, per_worker)))
+        return out
+
+    def score_to_file(self, batches, path, label_columns=None, names=OUTPUT_COLUMNS, chunk_rows=1 << 18):
+        # label_columns: {column name: position of the tensor in the batch tuple}, written next to the predictions
+        label_columns = label_columns or {}
+        columns = list(label_columns) + list(names)
+        chunk = {name: np.empty(chunk_rows, dtype=np.float32) for name in columns}
+        filled = 0
+
+        with ColumnarWriter(path) as writer:
+            for batch in batches:
+                inputs = batch[0] if isinstance(batch, (list, tuple)) else batch
+                values = [batch[i].reshape(-1) for i in label_columns.values()] + list(self.predict_batch(inputs))
+                b, offset = inputs.shape[0], 0
+                while offset < b:
+                    take = min(b - offset, chunk_rows - filled)
+                    for name, v in zip(columns, values):
+                        chunk[name][filled: filled + take] = v[offset: offset + take].numpy()
+                    filled, offset = filled + take, offset + take
+                    if filled == chunk_rows:
+                        writer.append(chunk)
+                        filled = 0
+            if filled:
+                writer.append({name: v[:filled] for name, v in chunk.items()})
+            return writer.num_rows
@@ -0,0 +1,59 @@
+import numbers, torch
+
+from torch.utils.data import DataLoader, Dataset
+from utils.loader import BruceBatchSampler, _identity
+
+
+def sliding_windows(t, seq_len, stride=1, dilation=1):
+    # (num_windows, seq_len, *feature) strided view over t, nothing is copied
+    t = t.contiguous()
+    span = (seq_len - 1) * dilation + 1
+    num_windows = max(0, (t.shape[0] - span) // stride + 1)
+    return t.as_strided((num_windows, seq_len) + tuple(t.shape[1:]),
+                        (stride * t.stride(0), dilation * t.stride(0)) + tuple(t.stride()[1:]),
+                        t.storage_offset())
+
+
+class BruceSequenceDataset(Dataset):
+    """
+    Windows of `seq_len` frames (every `dilation` frames, one window every `stride` frames) over one contiguous buffer.
+
+    dataset[i] returns views. dataset[indices] gathers a batch with one advanced-indexing op per tensor, and a run of
+    consecutive indices (see BruceBatchSampler(contiguous=True)) is served as a single strided view with no copy.
+    """
+
+    def __init__(self, inputs, cls_labels=None, rgs_labels=None, seq_len=32, stride=1, dilation=1):
+        super().__init__()
+        self.seq_len = seq_len
+        self.stride = stride
+        self.dilation = dilation
+
+        self.tensors = [torch.as_tensor(inputs)]
+        if cls_labels is not None:
+            self.tensors += [torch.as_tensor(cls_labels), torch.as_tensor(rgs_labels)]
+        self.windows = [sliding_windows(t, seq_len, stride, dilation) for t in self.tensors]
+
+    def __len__(self):
+        return self.windows[0].shape[0]
+
+    def _gather(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        start = int(indices[0])
+        if indices.numel() == 1 or bool((indices[1:] - indices[:-1] == 1).all()):
+            return [w[start: start + indices.numel()] for w in self.windows]
+        return [w[indices] for w in self.windows]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, numbers.Integral):
+            out = [w[idx] for w in self.windows]
+        else:
+            out = self._gather(idx)
+        return out[0] if len(out) == 1 else tuple(out)
+
+
+def get_sequence_loader(inputs, cls_labels=None, rgs_labels=None, seq_len=32, stride=1, dilation=1, batch_size=128,
+                        shuffle=True, contiguous=True, drop_last=False, num_workers=0, generator=None):
+    dataset = BruceSequenceDataset(inputs, cls_labels, rgs_labels, seq_len, stride, dilation)
+    sampler = BruceBatchSampler(len(dataset), batch_size, shuffle, drop_last, generator, contiguous=contiguous)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=_identity, num_workers=num_workers,
+                      persistent_workers=num_workers > 0)
@@ -0,0 +1,79 @@
+import os, json, logging, numpy as np
+
+from utils.preprocessing import get_pipeline
+
+
+logger = logging.getLogger('model')
+
+CHECKPOINT_KEY = 'norm_stats'
+
+
+class StatsMismatchError(ValueError):
+    pass
+
+
+class NormStats:
+    # Normalization stats of the training data, saved in the checkpoint and in a small JSON sidecar next to it
+    def __init__(self, mean, std, pipeline='ipig-h5', source=None, num_frames=None):
+        self.mean = float(mean)
+        self.std = float(std)
+        self.pipeline = pipeline
+        self.source = source
+        self.num_frames = num_frames
+
+    def __repr__(self):
+        return f'NormStats(mean={self.mean}, std={self.std}, pipeline={self.pipeline!r}, source={self.source!r})'
+
+    def to_dict(self):
+        return {'mean': self.mean, 'std': self.std, 'pipeline': self.pipeline, 'source': self.source,
+                'num_frames': self.num_frames}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def transform(self, arr):
+        return get_pipeline(self.pipeline).transform(arr, self.mean, self.std)
+
+    def check(self, raw, tolerance=0.25, max_rows=10000, strict=False):
+        """
+        Compare the stats of (a sample of) raw, not yet normalized, data with the model stats. The shift of the mean
+        and the relative change of the std must stay within `tolerance` (in units of the model std).
+        """
+        raw = np.asarray(raw[:max_rows], dtype=np.float32)
+        mean, std = get_pipeline(self.pipeline).fit(raw)
+        shift, spread = abs(mean - self.mean) / self.std, abs(std / self.std - 1)
+        if shift > tolerance or spread > tolerance:
+            message = f'Data stats (mean={mean:.4f}, std={std:.4f}) do not match the model stats ' \
+                      f'(mean={self.mean:.4f}, std={self.std:.4f}): mean shift {shift:.2f} std, std change {spread:.0%}'
+            if strict:
+                raise StatsMismatchError(message)
+            logger.warning(message)
+            return False
+        return True
+
+
+def stats_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + '.stats.json'
+
+
+def load_stats(checkpoint_path):
+    # The sidecar is read in milliseconds, the checkpoint is only opened when the sidecar is missing
+    sidecar = stats_path(checkpoint_path)
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return NormStats.from_dict(json.load(f))
+
+    if not os.path.exists(checkpoint_path):
+        return None
+    import torch
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    if CHECKPOINT_KEY not in checkpoint:
+        return None
+    stats = NormStats.from_dict(checkpoint[CHECKPOINT_KEY])
+    stats.save(sidecar)
+    return stats
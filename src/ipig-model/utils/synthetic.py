@@ -0,0 +1,96 @@
+import os, json, h5py, multiprocessing as mp, numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+NUM_READINGS = 600
+# Deposit levels of the simulator (deposit_thickness is stored x10, as in train_new.h5)
+THICKNESS_LEVELS = (0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5)
+
+
+class SensorProfile:
+    """
+    Fixed part of the synthetic sensor, drawn once from the seed and shared by every chunk: per-channel baseline close
+    to the raw stats of train_new.h5 (mean -0.55, std 0.9 over the live readings), per-channel deposit sensitivity,
+    smooth along each of the 10 rings of 60 electrodes, and the dead channels (always 0).
+    """
+
+    def __init__(self, seed=42, dead_fraction=0.05, noise=0.3):
+        rng = np.random.default_rng([seed, 0])
+        ring = np.linspace(0, 2 * np.pi, 60, endpoint=False)
+        phase = rng.uniform(0, 2 * np.pi, (10, 1))
+        self.baseline = (-0.55 + 0.6 * np.sin(ring + phase)).reshape(-1).astype(np.float32)
+        self.sensitivity = (0.25 + 0.1 * np.cos(2 * ring + phase)).reshape(-1).astype(np.float32)
+        self.live = (rng.random(NUM_READINGS) >= dead_fraction).astype(np.float32)
+        self.noise = noise
+
+
+def thickness_runs(rng, rows, pos_fraction, mean_run, distribution, low, high):
+    # Deposits are constant over runs of frames (geometric lengths), a run is a deposit with probability pos_fraction
+    num_runs = max(1, int(2 * rows / mean_run) + 1)
+    lengths = rng.geometric(1 / mean_run, num_runs)
+    while lengths.sum() < rows:
+        lengths = np.concatenate([lengths, rng.geometric(1 / mean_run, num_runs)])
+    positive = rng.random(len(lengths)) < pos_fraction
+
+    if distribution == 'levels':
+        values = rng.choice(np.asarray(THICKNESS_LEVELS, dtype=np.float32), len(lengths))
+    elif distribution == 'uniform':
+        values = rng.uniform(low, high, len(lengths))
+    elif distribution == 'lognormal':
+        values = np.clip(rng.lognormal(np.log((low + high) / 2), 0.5, len(lengths)), low, high)
+    else:
+        raise ValueError(f'Unknown thickness distribution {distribution!r}, choose from levels, uniform, lognormal')
+    return np.repeat(np.where(positive, values, 0).astype(np.float32), lengths)[:rows]
+
+
+def generate_chunk(seed, chunk_id, rows, profile, pos_fraction=0.3, mean_run=200, distribution='levels', low=0.5,
+                   high=4.0, diameters=(100., 150., 200.)):
+    # Independent stream per chunk (seed, chunk_id): the file is the same whatever the number of processes
+    rng = np.random.default_rng([seed, chunk_id + 1])
+    thickness = thickness_runs(rng, rows, pos_fraction, mean_run, distribution, low, high)
+    diameter = np.repeat(rng.choice(np.asarray(diameters, dtype=np.float32), max(1, rows // 5000 + 1)), 5000)[:rows]
+
+    inputs = rng.standard_normal((rows, NUM_READINGS), dtype=np.float32)
+    inputs *= profile.noise
+    inputs += profile.baseline
+    # Larger pipes spread the same deposit over more of the sensor field
+    inputs += (thickness * (150. / diameter))[:, None] * profile.sensitivity
+    inputs *= profile.live
+    return {'inputs': inputs,
+            'cls_label': (thickness > 0).astype(np.float32).reshape(-1, 1),
+            'deposit_thickness': thickness.reshape(-1, 1),
+            'inner_diameter': diameter.reshape(-1, 1)}
+
+
+def generate_h5(path, num_frames, seed=42, chunk_rows=16384, num_workers=None, h5_chunk_rows=1024,
+                compression=None, dead_fraction=0.05, noise=0.3, **chunk_kwargs):
+    """
+    Write `num_frames` synthetic frames with the train_new.h5 layout (inputs, cls_label, deposit_thickness,
+    inner_diameter) to a chunked HDF5 file. Chunks of `chunk_rows` frames are generated in parallel processes and
+    written in order by this process (h5py has a single writer), at most 2 chunks per worker are in flight.
+    """
+    num_workers = num_workers or max(1, (os.cpu_count() or 1) - 1)
+    profile = SensorProfile(seed, dead_fraction, noise)
+    widths = {'inputs': NUM_READINGS, 'cls_label': 1, 'deposit_thickness': 1, 'inner_diameter': 1}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    with h5py.File(path, 'w') as f:
+        dsets = {name: f.create_dataset(name, shape=(num_frames, w), dtype=np.float32, compression=compression,
+                                        chunks=(min(h5_chunk_rows, max(num_frames, 1)), w))
+                 for name, w in widths.items()}
+        f.attrs['generator'] = json.dumps({'seed': seed, 'chunk_rows': chunk_rows, 'dead_fraction': dead_fraction,
+                                           'noise': noise, **chunk_kwargs}, default=list)
+
+        starts = list(range(0, num_frames, chunk_rows))
+        with ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn')) as pool:
+            pending = deque()
+            for i, start in enumerate(starts):
+                rows = min(chunk_rows, num_frames - start)
+                pending.append((start, pool.submit(generate_chunk, seed, i, rows, profile, **chunk_kwargs)))
+                while len(pending) >= 2 * num_workers or (i == len(starts) - 1 and pending):
+                    s, future = pending.popleft()
+                    for name, values in future.result().items():
+                        dsets[name][s: s + values.shape[0]] = values
+    return path